@@ -0,0 +1,343 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Load test for the Bookshelf app against local stand-ins for each backend.
+
+Seeds a catalog of --books generated books, then drives the list, view,
+search and add pages through the Flask app at a fixed --concurrency and
+reports p50/p95/p99 latency and requests per second for each backend and
+page. Results are written as JSON to --output, and a previous results file
+passed as --compare is diffed against the new run.
+
+The stand-ins are:
+
+    cloudsql    SQLite in a temporary file, or --sql-uri (e.g. a local MySQL)
+    mongodb     mongomock in memory, or a local mongod at --mongo-uri
+    datastore   the Datastore emulator; start it and export DATASTORE_HOST
+                (`gcloud beta emulators datastore env-init`) first
+
+Run from the repository root:
+
+    $ python benchmarks/loadtest.py --backend cloudsql --backend mongodb \\
+        --books 10000 --concurrency 8 --output results.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import bookshelf  # noqa: E402
+import config  # noqa: E402
+
+
+WORDS = """
+    river stone shadow garden winter empire silent glass crown ocean night
+    paper iron summer hidden dragon forest letter mountain golden city road
+    storm house secret island memory fire bridge song wolf harbor moon star
+""".split()
+
+AUTHORS = ['{} {}'.format(first, last) for first in (
+    'Ada', 'Ben', 'Cleo', 'Dev', 'Eve', 'Finn', 'Gus', 'Hana', 'Ivo', 'Jun')
+    for last in ('Adams', 'Brook', 'Chen', 'Diaz', 'Ekwueme', 'Fox', 'Gray',
+                 'Hale', 'Ito', 'Jones')]
+
+PAGES = ('list', 'view', 'search', 'add')
+
+
+def make_book(rng):
+    return {
+        'title': ' '.join(rng.choice(WORDS).title()
+                          for _ in range(rng.randint(1, 4))),
+        'author': rng.choice(AUTHORS),
+        'publishedDate': '{:02d}/{:02d}/{}'.format(
+            rng.randint(1, 12), rng.randint(1, 28), rng.randint(1900, 2020)),
+        'description': ' '.join(rng.choice(WORDS) for _ in range(60)),
+        'rating': rng.randint(1, 5),
+    }
+
+
+def make_app(backend, args):
+    overrides = {'DATA_BACKEND': backend}
+    if backend == 'cloudsql':
+        overrides['SQLALCHEMY_DATABASE_URI'] = args.sql_uri or (
+            'sqlite:///' + os.path.join(args.workdir, 'bookshelf.db'))
+    elif backend == 'mongodb':
+        if args.mongo_uri:
+            overrides['MONGO_URI'] = args.mongo_uri
+        else:
+            _use_mongomock()
+    elif backend == 'datastore' and not os.environ.get('DATASTORE_HOST'):
+        sys.exit("The datastore backend needs the emulator; "
+                 "export DATASTORE_HOST first.")
+
+    app = bookshelf.create_app(
+        config, testing=True, config_overrides=overrides)
+    if backend == 'cloudsql':
+        from bookshelf import model_cloudsql
+        with app.app_context():
+            model_cloudsql.db.create_all()
+    return app
+
+
+def _use_mongomock():
+    import mongomock
+
+    class MockPyMongo(object):
+        """Stands in for flask_pymongo.PyMongo with an in-memory database."""
+
+        def __init__(self, app=None):
+            self.db = mongomock.MongoClient().bookshelf
+
+        def init_app(self, app):
+            pass
+
+    from bookshelf import model_mongodb
+    model_mongodb.PyMongo = MockPyMongo
+
+
+def delete_all(model):
+    while True:
+        books, _ = model.list(limit=500)
+        if not books:
+            return
+        for book in books:
+            model.delete(book['id'])
+
+
+def seed(model, count, rng, batch_size=500):
+    """Creates count books, in batches where the backend supports it, and
+    returns their ids."""
+    ids = []
+    batched = hasattr(model.backend, 'create_many')
+    while len(ids) < count:
+        books = [make_book(rng)
+                 for _ in range(min(batch_size, count - len(ids)))]
+        if batched:
+            created = model.create_many(books)
+        else:
+            created = [model.create(book) for book in books]
+        ids.extend(book['id'] for book in created)
+    return ids
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1,
+                int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def drive(app, request_factory, total, concurrency):
+    """Sends total requests from concurrency threads, each with its own test
+    client, and returns latency percentiles and throughput."""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    remaining = [total]
+
+    def worker(seed):
+        rng = random.Random(seed)
+        client = app.test_client()
+        mine = []
+        failed = 0
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            method, url, data = request_factory(rng)
+            start = time.time()
+            response = client.open(url, method=method, data=data)
+            mine.append(time.time() - start)
+            if response.status_code >= 400:
+                failed += 1
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'seconds': round(elapsed, 3),
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def page_tokens(model, pages):
+    """Collects the cursors of the first few list pages so the load covers
+    deep pages as well as the first."""
+    tokens = [None]
+    cursor = None
+    for _ in range(pages):
+        _, cursor = model.list(cursor=cursor, summary=True)
+        if not cursor:
+            break
+        tokens.append(cursor)
+    return tokens
+
+
+def request_factories(ids, tokens):
+    def list_page(rng):
+        token = rng.choice(tokens)
+        url = '/books/' if token is None else (
+            '/books/?' + _urlencode({'page_token': token}))
+        return 'GET', url, None
+
+    def view(rng):
+        return 'GET', '/books/{}'.format(rng.choice(ids)), None
+
+    def search(rng):
+        return 'POST', '/books/search', {
+            'q': rng.choice(WORDS), 'Category': 'Title'}
+
+    def add(rng):
+        return 'POST', '/books/add', make_book(rng)
+
+    return {'list': list_page, 'view': view, 'search': search, 'add': add}
+
+
+def _urlencode(params):
+    try:
+        from urllib.parse import urlencode
+    except ImportError:
+        from urllib import urlencode
+    return urlencode(params)
+
+
+def run_backend(backend, args):
+    app = make_app(backend, args)
+    rng = random.Random(args.seed)
+    with app.test_request_context():
+        model = bookshelf.get_model()
+        delete_all(model)
+        started = time.time()
+        ids = seed(model, args.books, rng)
+        seed_seconds = time.time() - started
+        tokens = page_tokens(model, args.deep_pages)
+
+    factories = request_factories(ids, tokens)
+    results = {'seed_seconds': round(seed_seconds, 3)}
+    for page in args.pages:
+        # One short untimed pass warms caches and the search index.
+        drive(app, factories[page], args.concurrency, args.concurrency)
+        results[page] = drive(
+            app, factories[page], args.requests, args.concurrency)
+        print('{:10} {:7} {p50_ms:8.2f} {p95_ms:8.2f} {p99_ms:8.2f} '
+              '{rps:9.1f} {errors:6}'.format(backend, page, **results[page]))
+    return results
+
+
+def compare(previous, current):
+    """Prints the change in p95 latency and throughput against an earlier
+    results file."""
+    print('\nChange against {}:'.format(previous['meta']['timestamp']))
+    for backend, pages in sorted(current['results'].items()):
+        for page in PAGES:
+            old = previous['results'].get(backend, {}).get(page)
+            new = pages.get(page)
+            if not old or not new:
+                continue
+            print('{:10} {:7} p95 {:+7.1f}%  rps {:+7.1f}%'.format(
+                backend, page,
+                100.0 * (new['p95_ms'] - old['p95_ms']) / old['p95_ms'],
+                100.0 * (new['rps'] - old['rps']) / old['rps']))
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--backend', action='append', dest='backends',
+        choices=('cloudsql', 'mongodb', 'datastore'),
+        help='Backend to test; repeat for several. Default: cloudsql.')
+    parser.add_argument('--books', type=int, default=10000,
+                        help='Number of books to seed.')
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='Timed requests per page.')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Number of concurrent clients.')
+    parser.add_argument('--page', action='append', dest='pages',
+                        choices=PAGES, help='Page to test; default all.')
+    parser.add_argument('--deep-pages', type=int, default=50,
+                        help='How many list pages deep to spread list load.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed for the generated catalog.')
+    parser.add_argument('--sql-uri', help='SQLAlchemy URI for cloudsql.')
+    parser.add_argument('--mongo-uri', help='Mongo URI for mongodb.')
+    parser.add_argument('--output', help='Write results as JSON here.')
+    parser.add_argument('--compare', help='Earlier results JSON to diff.')
+    args = parser.parse_args(argv)
+    args.backends = args.backends or ['cloudsql']
+    args.pages = args.pages or list(PAGES)
+    args.workdir = tempfile.mkdtemp(prefix='bookshelf-bench-')
+
+    meta = {
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'git_revision': _git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count() if hasattr(os, 'cpu_count') else None,
+        'args': dict((key, value) for key, value in vars(args).items()
+                     if key != 'workdir'),
+    }
+    print('{:10} {:7} {:>8} {:>8} {:>8} {:>9} {:>6}'.format(
+        'backend', 'page', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'errors'))
+    results = dict((backend, run_backend(backend, args))
+                   for backend in args.backends)
+    report = {'meta': meta, 'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Throughput of one gunicorn worker as its thread count grows.
+
+Seeds a cloudsql catalog, then for each --threads value starts gunicorn with
+gunicorn.conf.py, one worker of that many threads (or greenlets, with
+--worker-class gevent), pinned to the first --cores CPUs. It drives the view
+or list page over HTTP from --concurrency keep-alive clients and reports
+requests per second and latency for each thread count.
+
+Requests to a real database spend most of their time waiting on it, which
+is what threads overlap. The SQLite stand-in answers in microseconds, so
+--db-latency-ms adds that wait to every query; pass --sql-uri to measure a
+real MySQL instead.
+
+Run from the repository root (Linux, for the CPU pinning):
+
+    $ python benchmarks/threads.py --threads 1 --threads 2 --threads 4 \\
+        --threads 8 --threads 16 --cores 1 --output threads.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from http.client import HTTPConnection
+except ImportError:
+    from httplib import HTTPConnection
+
+import loadtest
+
+
+def _pin(cores):
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, range(min(cores, os.cpu_count())))
+
+
+def serve(args):
+    """Runs gunicorn in this process until it is terminated."""
+    from gunicorn.app.base import Application
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    def delay(conn, cursor, statement, parameters, context, executemany):
+        time.sleep(args.db_latency_ms / 1000.0)
+
+    class Server(Application):
+        def init(self, parser, opts, positional):
+            pass
+
+        def load_config(self):
+            self.load_config_from_file(
+                os.path.join(os.path.dirname(__file__), '..',
+                             'gunicorn.conf.py'))
+            self.cfg.set('bind', '127.0.0.1:{}'.format(args.port))
+            self.cfg.set('workers', 1)
+            self.cfg.set('threads', args.serve)
+            self.cfg.set('worker_class', args.worker_class)
+            self.cfg.set('worker_connections', args.serve)
+
+        def load(self):
+            app = loadtest.make_app('cloudsql', args)
+            if args.db_latency_ms:
+                event.listen(Engine, 'before_cursor_execute', delay)
+            return app
+
+    _pin(args.cores)
+    sys.argv = sys.argv[:1]
+    Server().run()
+
+
+def _wait_for(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError("gunicorn didn't start on port {}".format(port))
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def drive(port, paths, total, concurrency):
+    """Sends total GET requests over concurrency keep-alive connections and
+    returns latency percentiles and throughput."""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    remaining = [total]
+
+    def worker(seed):
+        rng = random.Random(seed)
+        connection = HTTPConnection('127.0.0.1', port, timeout=60)
+        mine = []
+        failed = 0
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            start = time.time()
+            connection.request('GET', rng.choice(paths))
+            response = connection.getresponse()
+            response.read()
+            mine.append(time.time() - start)
+            if response.status >= 400:
+                failed += 1
+        connection.close()
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'seconds': round(elapsed, 3),
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(loadtest.percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(loadtest.percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(loadtest.percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def run(args, threads, paths):
+    port = _free_port()
+    command = [sys.executable, os.path.abspath(__file__),
+               '--serve', str(threads), '--port', str(port),
+               '--worker-class', args.worker_class,
+               '--cores', str(args.cores or 0),
+               '--db-latency-ms', str(args.db_latency_ms),
+               '--workdir', args.workdir]
+    if args.sql_uri:
+        command += ['--sql-uri', args.sql_uri]
+    server = subprocess.Popen(command)
+    try:
+        _wait_for(port)
+        drive(port, paths, args.concurrency, args.concurrency)
+        return drive(port, paths, args.requests, args.concurrency)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--threads', type=int, action='append',
+                        help='Threads per worker; repeat for several. '
+                             'Default: 1, 2, 4, 8, 16.')
+    parser.add_argument('--worker-class', default='gthread',
+                        choices=('gthread', 'gevent'))
+    parser.add_argument('--cores', type=int, default=1,
+                        help='CPUs the server is pinned to; 0 for all.')
+    parser.add_argument('--db-latency-ms', type=float, default=5.0,
+                        help='Wait added to every SQL statement.')
+    parser.add_argument('--page', default='view', choices=('view', 'list'))
+    parser.add_argument('--books', type=int, default=2000)
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='Timed requests per thread count.')
+    parser.add_argument('--concurrency', type=int, default=32,
+                        help='Number of concurrent clients.')
+    parser.add_argument('--sql-uri', help='SQLAlchemy URI for cloudsql.')
+    parser.add_argument('--output', help='Write results as JSON here.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    args.mongo_uri = None
+
+    if args.serve:
+        return serve(args)
+
+    args.threads = args.threads or [1, 2, 4, 8, 16]
+    args.workdir = tempfile.mkdtemp(prefix='bookshelf-bench-')
+    app = loadtest.make_app('cloudsql', args)
+    with app.test_request_context():
+        model = loadtest.bookshelf.get_model()
+        loadtest.delete_all(model)
+        ids = loadtest.seed(model, args.books, random.Random(args.seed))
+    if args.page == 'view':
+        paths = ['/books/{}'.format(id) for id in ids]
+    else:
+        paths = ['/books/']
+
+    print('{:>8} {:>9} {:>8} {:>8} {:>8} {:>8}'.format(
+        'threads', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'speedup'))
+    results = {}
+    for threads in args.threads:
+        result = results[threads] = run(args, threads, paths)
+        base = results[args.threads[0]]['rps']
+        print('{:8} {rps:9.1f} {p50_ms:8.2f} {p95_ms:8.2f} {p99_ms:8.2f} '
+              '{:8.2f}'.format(threads, result['rps'] / base, **result))
+
+    report = {
+        'meta': {
+            'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+            'git_revision': loadtest._git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'args': dict((key, value) for key, value in vars(args).items()
+                         if key not in ('workdir', 'serve', 'port')),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -14,7 +14,7 @@
 
 import logging
 
-from flask import current_app, Flask, redirect, url_for
+from flask import current_app, Flask, jsonify, redirect, url_for
 
 
 def create_app(config, debug=False, testing=False, config_overrides=None):
@@ -31,20 +31,101 @@ def create_app(config, debug=False, testing=False, config_overrides=None):
     if not app.testing:
         logging.basicConfig(level=logging.INFO)
 
+    # Instrument requests before the data model connects, so that database
+    # clients are created with their monitoring hooks in place.
+    from . import metrics
+    registry = metrics.init_app(app)
+
+    # Turn away requests to expensive endpoints beyond their limits, so they
+    # can't occupy every thread. Installed after the instrumentation, so
+    # that rejected requests are measured too.
+    from . import admission
+    registry.add_collector(metrics.stats_collector(
+        'bookshelf_admission', admission.init_app(app).stats))
+
     # Setup the data model.
     with app.app_context():
         model = get_model()
         model.init_app(app)
+    if hasattr(model, 'pool_stats'):
+        registry.add_collector(metrics.stats_collector(
+            'bookshelf_db_pool', model.pool_stats))
+
+    # From here on get_model() hands out the backend wrapped in a proxy that
+    # tells listeners such as the search index about every book write, and
+    # in the read-through cache on top of that.
+    from .model_proxy import ModelProxy
+    model = ModelProxy(model)
+
+    from . import search
+    search.init_app(app, model)
+
+    from . import suggest
+    suggest.init_app(app, model)
+
+    from . import fuzzy
+    fuzzy.init_app(app, model)
+
+    from . import migrate
+    migrate.init_app(app, model)
+
+    from . import cache
+    model = cache.init_app(app, model)
+    app.extensions['bookshelf.model'] = model
+    if 'bookshelf.cache' in app.extensions:
+        registry.add_collector(metrics.stats_collector(
+            'bookshelf_cache', app.extensions['bookshelf.cache'].stats))
+
+    # Likes and ratings reach the model through a write-behind buffer.
+    from . import votes
+    registry.add_collector(metrics.stats_collector(
+        'bookshelf_votes', votes.init_app(app, model).stats))
+
+    from . import users
+    registry.add_collector(metrics.stats_collector(
+        'bookshelf_users', users.init_app(app, model).stats))
+
+    from . import bulk
+    bulk.init_app(app)
+
+    # Pages run their independent lookups side by side on a thread pool.
+    from . import fanout
+    registry.add_collector(metrics.stats_collector(
+        'bookshelf_fanout', fanout.init_app(app).stats))
 
     # Register the Bookshelf CRUD blueprint.
     from .crud import crud
     app.register_blueprint(crud, url_prefix='/books')
 
+    # And the JSON API for other services.
+    from .api import api
+    app.register_blueprint(api, url_prefix='/api')
+
     # Add a default root route.
     @app.route("/")
     def index():
         return redirect(url_for('crud.list'))
 
+    # Report cache hit, miss and eviction counts so the cache can be sized.
+    @app.route("/_stats/cache")
+    def cache_stats():
+        if 'bookshelf.cache' not in app.extensions:
+            return jsonify({'type': 'none'})
+        return jsonify(app.extensions['bookshelf.cache'].stats())
+
+    # Report connection pool use so the pool can be sized.
+    @app.route("/_stats/pool")
+    def pool_stats():
+        model = get_model()
+        if not hasattr(model, 'pool_stats'):
+            return jsonify({'type': 'none'})
+        return jsonify(model.pool_stats())
+
+    # Report how many requests each admission limit let in and turned away.
+    @app.route("/_stats/admission")
+    def admission_stats():
+        return jsonify(app.extensions['bookshelf.admission'].stats())
+
     # Add an error handler. This is useful for debugging the live application,
     # however, you should disable the output of the exception for production
     # applications.
@@ -59,7 +140,15 @@ def create_app(config, debug=False, testing=False, config_overrides=None):
 
 
 def get_model():
-    model_backend = current_app.config['DATA_BACKEND']
+    model = current_app.extensions.get('bookshelf.model')
+    if model is not None:
+        return model
+
+    return get_backend(current_app.config['DATA_BACKEND'])
+
+
+def get_backend(model_backend):
+    """Returns the model module for a backend name."""
     if model_backend == 'cloudsql':
         from . import model_cloudsql
         model = model_cloudsql
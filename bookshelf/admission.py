@@ -0,0 +1,164 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Admission control for expensive endpoints.
+
+Each worker serves only SERVER_THREADS requests at once. If slow requests,
+such as broad searches or a bulk export, fill them all, cheap page views
+queue behind them until they time out. ADMISSION_LIMITS groups expensive
+endpoints and caps the requests each group serves at once. A request over
+the cap waits in a short queue for a bounded time, and is then answered 503
+with a Retry-After header. So a group under load turns its own excess away
+quickly and leaves threads free for every other endpoint.
+
+Limits are per process, like the thread count they protect.
+"""
+
+import collections
+import threading
+import time
+
+from flask import g, request
+from werkzeug.exceptions import ServiceUnavailable
+
+
+class Limiter(object):
+    """Admits at most concurrency callers at once, queueing up to queue more
+    for at most timeout seconds each, in the order they came."""
+
+    def __init__(self, concurrency, queue=0, timeout=0.0):
+        self.concurrency = concurrency
+        self.queue = queue
+        self.timeout = timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._condition = threading.Condition()
+        self._tickets = collections.deque()
+        self._granted = set()
+        self._next_ticket = 0
+
+    def acquire(self):
+        """Returns True once the caller may proceed, which it must follow
+        with release(), or False if the queue is full or the wait timed
+        out."""
+        with self._condition:
+            # Newcomers don't overtake callers already waiting.
+            if self.in_flight < self.concurrency and not self.waiting:
+                self.in_flight += 1
+                self.admitted += 1
+                return True
+            if self.waiting >= self.queue:
+                self.rejected += 1
+                return False
+
+            # release() hands its place straight to a waiter, taking it off
+            # the queue, so a waiter that hasn't woken yet holds no room a
+            # newcomer could have had.
+            deadline = time.time() + self.timeout
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            self.waiting += 1
+            self._tickets.append(ticket)
+            while ticket not in self._granted:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._tickets.remove(ticket)
+                    self.waiting -= 1
+                    self.rejected += 1
+                    self.timed_out += 1
+                    return False
+                self._condition.wait(remaining)
+            self._granted.discard(ticket)
+            self.admitted += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            if self._tickets:
+                # The place passes to the longest waiting caller; in_flight
+                # stays the same.
+                self._granted.add(self._tickets.popleft())
+                self.waiting -= 1
+                self._condition.notify_all()
+            else:
+                self.in_flight -= 1
+
+    def stats(self):
+        with self._condition:
+            return {
+                'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+            }
+
+
+class AdmissionControl(object):
+    """Holds a Limiter per group of endpoints and applies it around each
+    request to one of them."""
+
+    def __init__(self, limits, retry_after=1):
+        self.retry_after = retry_after
+        self.limiters = {}
+        self._groups = {}
+        for name, limit in limits.items():
+            self.limiters[name] = Limiter(
+                limit['concurrency'], limit.get('queue', 0),
+                limit.get('timeout', 0.0))
+            for endpoint in limit['endpoints']:
+                self._groups[endpoint] = name
+
+    def before_request(self):
+        name = self._groups.get(request.endpoint)
+        if name is None:
+            return
+        limiter = self.limiters[name]
+        if not limiter.acquire():
+            raise ServiceUnavailable(
+                'Too many {} requests; try again shortly.'.format(name),
+                retry_after=self.retry_after)
+        g._bookshelf_admission = limiter
+
+    def teardown_request(self, exception=None):
+        # Streamed responses keep the request context, and so their place,
+        # until the last chunk is sent.
+        limiter = g.pop('_bookshelf_admission', None)
+        if limiter is not None:
+            limiter.release()
+
+    def stats(self):
+        """Returns the counters of every group as <group>_<counter>."""
+        stats = {}
+        for name, limiter in self.limiters.items():
+            for key, value in limiter.stats().items():
+                stats['{}_{}'.format(name, key)] = value
+        return stats
+
+
+def init_app(app):
+    """Limits the endpoints named in the app's ADMISSION_LIMITS."""
+    app.config.setdefault('ADMISSION_LIMITS', {})
+    app.config.setdefault('ADMISSION_RETRY_AFTER', 1)
+    control = AdmissionControl(
+        app.config['ADMISSION_LIMITS'],
+        retry_after=app.config['ADMISSION_RETRY_AFTER'])
+    app.extensions['bookshelf.admission'] = control
+    app.before_request(control.before_request)
+    app.teardown_request(control.teardown_request)
+    return control
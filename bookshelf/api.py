@@ -0,0 +1,216 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Read-only JSON API over the catalog, for services rather than browsers.
+
+    GET /api/books                  a page of books and the next page_token
+    GET /api/books?stream=1         every book from page_token on, streamed
+    GET /api/books/<id>             one book
+    GET /api/books/batch?ids=1,2    several books, null for those not found;
+                                    also POST with a JSON body {"ids": [...]}
+    GET /api/books/search?q=...     a page of search results
+
+The list takes limit and summary=1, for only the fields the list page shows.
+Search takes field, page_token, limit, facets=1 and the filters of
+search.FILTERS, or mode=fuzzy.
+
+Responses are JSON, encoded with orjson when it is installed, or MessagePack
+when the msgpack package is installed and the Accept header prefers
+application/msgpack. Streams are NDJSON, or concatenated MessagePack
+objects, read from the backend BULK_BATCH_SIZE books at a time, so a stream
+of the whole catalog holds only one page in memory.
+"""
+
+import datetime
+import json
+
+from flask import abort, Blueprint, current_app, jsonify, request, \
+    Response, stream_with_context
+
+from . import fuzzy, get_model, search
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+api = Blueprint('api', __name__)
+
+
+JSON = 'application/json'
+NDJSON = 'application/x-ndjson'
+MSGPACK = 'application/msgpack'
+
+# The most books one list page or batch read returns.
+MAX_PAGE_SIZE = 100
+MAX_BATCH_IDS = 100
+
+
+def _default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+
+def _public(book):
+    """Leaves out backend internals such as Mongo's _id."""
+    if book is None:
+        return None
+    return dict((key, value) for key, value in book.items()
+                if not key.startswith('_'))
+
+
+def _mimetype():
+    offered = [JSON, MSGPACK] if msgpack is not None else [JSON]
+    return request.accept_mimetypes.best_match(offered, default=JSON)
+
+
+def _encode(data, mimetype):
+    if mimetype == MSGPACK:
+        return msgpack.packb(data, default=_default, use_bin_type=True)
+    if orjson is not None:
+        return orjson.dumps(data, default=_default)
+    return json.dumps(
+        data, default=_default, separators=(',', ':')).encode('utf-8')
+
+
+def _respond(data):
+    mimetype = _mimetype()
+    return Response(_encode(data, mimetype), mimetype=mimetype)
+
+
+@api.errorhandler(400)
+@api.errorhandler(404)
+@api.errorhandler(503)
+def _error(e):
+    response = jsonify(error=e.description)
+    if getattr(e, 'retry_after', None):
+        response.headers['Retry-After'] = str(e.retry_after)
+    return response, e.code
+
+
+@api.route('/books')
+def list_books():
+    token = request.args.get('page_token')
+    summary = bool(request.args.get('summary', 0, type=int))
+    if request.args.get('stream', 0, type=int):
+        return _stream(token, summary)
+
+    limit = request.args.get('limit', 10, type=int)
+    try:
+        books, next_page_token = get_model().list(
+            limit=max(1, min(limit, MAX_PAGE_SIZE)), cursor=token,
+            summary=summary)
+    except ValueError:
+        abort(400, 'Invalid page_token')
+    return _respond({'books': [_public(book) for book in books],
+                     'next_page_token': next_page_token})
+
+
+def _stream(token, summary):
+    """Streams every book from token on, one encoded book per line, reading
+    from the backend itself so that the pages don't fill the cache."""
+    model = get_model().backend
+    batch_size = current_app.config['BULK_BATCH_SIZE']
+    mimetype = _mimetype()
+    separator = b'' if mimetype == MSGPACK else b'\n'
+    # The first page is read here, so that a bad token is still a 400.
+    try:
+        books, cursor = model.list(
+            limit=batch_size, cursor=token, summary=summary)
+    except ValueError:
+        abort(400, 'Invalid page_token')
+
+    def generate(books, cursor):
+        while True:
+            yield b''.join(_encode(_public(book), mimetype) + separator
+                           for book in books)
+            if not cursor:
+                return
+            books, cursor = model.list(
+                limit=batch_size, cursor=cursor, summary=summary)
+
+    return Response(stream_with_context(generate(books, cursor)),
+                    mimetype=NDJSON if mimetype == JSON else mimetype)
+
+
+@api.route('/books/<id>')
+def read_book(id):
+    # An id the backend can't hold names no book.
+    try:
+        book = get_model().read(id)
+    except ValueError:
+        book = None
+    if book is None:
+        abort(404, 'No such book')
+    return _respond(_public(book))
+
+
+@api.route('/books/batch', methods=['GET', 'POST'])
+def read_books():
+    if request.method == 'POST':
+        ids = (request.get_json(silent=True) or {}).get('ids')
+    else:
+        ids = [id for id in request.args.get('ids', '').split(',') if id]
+    if not isinstance(ids, list) or not ids:
+        abort(400, 'Expected a list of ids')
+    if len(ids) > MAX_BATCH_IDS:
+        abort(400, 'At most {} ids'.format(MAX_BATCH_IDS))
+    # The backends take ids as strings, as they come in URLs.
+    if not all(isinstance(id, (str, int)) and not isinstance(id, bool)
+               for id in ids):
+        abort(400, 'Invalid id')
+    try:
+        books = get_model().read_many([str(id) for id in ids])
+    except ValueError:
+        abort(400, 'Invalid id')
+    return _respond({'books': [_public(book) for book in books]})
+
+
+@api.route('/books/search')
+def search_books():
+    args = request.args
+    text = args.get('q', '')
+    field = args.get('field') or None
+    limit = args.get('limit', 10, type=int)
+    if field is not None and field not in search.FIELD_WEIGHTS:
+        abort(400, 'Unknown field')
+
+    if args.get('mode') == 'fuzzy':
+        books = fuzzy.get_index().search(
+            text, field=field if field in fuzzy.FIELDS else None,
+            limit=limit)
+        return _respond({'books': books, 'next_page_token': None})
+
+    filters = dict((name, args.get(name, type=int))
+                   for name in search.FILTERS if name != 'author')
+    filters['author'] = args.get('author')
+    try:
+        books, next_page_token, facets = search.get_index().query(
+            text, field=field, filters=filters, limit=limit,
+            cursor=args.get('page_token'),
+            facets=bool(args.get('facets', 0, type=int)))
+    except ValueError:
+        abort(400, 'Invalid page_token')
+    data = {'books': books, 'next_page_token': next_page_token}
+    if facets is not None:
+        data['facets'] = facets
+    return _respond(data)
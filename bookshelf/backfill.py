@@ -0,0 +1,104 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Stores publishedYear and publishedOn on books written before they existed.
+
+The job pages through the configured backend and rewrites, a page at a time
+with put_many, every book whose publishedDate parses but which has no
+publishedYear yet. Books are written through the backend module itself, so
+their version is kept and no cache or ETag is invalidated: nothing a page
+shows changes. A book edited between being read and rewritten would lose
+the edit, so run the job while the catalog is quiet. Reruns skip the books
+already done, and a checkpoint file lets an interrupted run resume.
+
+Run from the repository root:
+
+    $ python -m bookshelf.backfill --checkpoint backfill.ckpt
+"""
+
+import argparse
+import logging
+import threading
+
+from flask import current_app
+
+from . import bulk
+from .dates import with_published
+from .migrate import CursorCheckpoint, pages
+
+
+logger = logging.getLogger(__name__)
+
+
+def backfill_published(model, batch_size=None, workers=None,
+                       checkpoint=None):
+    """Parses publishedDate into publishedYear and publishedOn for every book
+    of the backend module model that lacks them. Returns the number of books
+    rewritten by this run.
+
+    Must be called within an app context in which the backend is
+    initialized.
+    """
+    config = current_app.config
+    batch_size = batch_size or config['BULK_BATCH_SIZE']
+    workers = workers or config['BULK_WORKERS']
+    checkpoint = checkpoint or CursorCheckpoint()
+    updated = [0]
+    lock = threading.Lock()
+
+    def write(books):
+        changed = []
+        for book in books:
+            if book.get('publishedYear') is not None:
+                continue
+            data = with_published(dict(book))
+            if data.get('publishedYear') is not None:
+                changed.append(data)
+        if changed:
+            model.put_many(changed)
+        with lock:
+            updated[0] += len(changed)
+
+    bulk.run_batches(pages(model, batch_size, checkpoint.cursor), write,
+                     workers, checkpoint.finished)
+    logger.info("Backfilled %d of %d books", updated[0], checkpoint.rows)
+    return updated[0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Parse the publication dates of existing books.')
+    parser.add_argument('--batch-size', type=int)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--checkpoint', help='Progress file, for resuming.')
+    args = parser.parse_args(argv)
+
+    import bookshelf
+    import config
+    logging.basicConfig(level=logging.INFO)
+    app = bookshelf.create_app(config)
+
+    with app.app_context():
+        checkpoint = CursorCheckpoint(args.checkpoint)
+        if checkpoint.rows:
+            print("Resuming after {} books".format(checkpoint.rows))
+        updated = backfill_published(
+            bookshelf.get_model().backend, args.batch_size, args.workers,
+            checkpoint)
+    print("Backfilled {} books".format(updated))
+
+
+if __name__ == '__main__':
+    main()
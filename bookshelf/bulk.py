@@ -0,0 +1,311 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Bulk import and export of the catalog as CSV or JSON lines.
+
+Both directions stream: an import reads and writes BULK_BATCH_SIZE books at a
+time, with at most two batches per worker in flight, and an export reads one
+page at a time, so memory stays bounded whatever the size of the file.
+
+Imports write each batch with the model's create_many (executemany,
+insert_many or put_multi) from BULK_WORKERS threads. A checkpoint file, if
+given, records which rows are safely stored so that a failed import can be
+resumed without writing any of them twice.
+
+Run from the repository root:
+
+    $ python -m bookshelf.bulk import books.csv --checkpoint books.ckpt
+    $ python -m bookshelf.bulk export books.jsonl
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import io
+import json
+import os
+import threading
+
+from flask import current_app
+
+
+# Fields a book may have; anything else in an imported row is ignored.
+# Imports are stamped and parsed afresh, so the fields from version on are
+# only kept as they are by the migrator.
+BOOK_FIELDS = ('title', 'author', 'publishedDate', 'imageUrl', 'description',
+               'rating', 'createdBy', 'createdById', 'version', 'updatedAt',
+               'publishedYear', 'publishedOn', 'likes', 'ratingCount',
+               'ratingTotal')
+
+FORMATS = ('csv', 'jsonl')
+
+
+def format_for(filename):
+    """Guesses the format of a file from its extension."""
+    return 'csv' if filename.lower().endswith('.csv') else 'jsonl'
+
+
+# [START read]
+def read_rows(stream, format):
+    """Yields one book dict per row of a CSV or JSON lines text stream."""
+    if format == 'csv':
+        rows = csv.DictReader(stream)
+    elif format == 'jsonl':
+        rows = (json.loads(line) for line in stream if line.strip())
+    else:
+        raise ValueError("Unknown format {!r}".format(format))
+
+    for row in rows:
+        yield dict((field, row[field]) for field in BOOK_FIELDS
+                   if row.get(field) not in (None, ''))
+# [END read]
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Checkpoint(object):
+    """Tracks which rows of an import are stored.
+
+    done counts the leading rows that are all stored. Batches may finish out
+    of order, and after a failure some batches beyond done may be stored
+    while an earlier one isn't, so those are kept as (start, count) ranges
+    of their own, and a resumed import skips them too. With a path the
+    checkpoint is saved there after each batch, atomically, and loaded on
+    start.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.done = 0
+        self._finished = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            self.done = saved['rows_done']
+            self._finished = dict(saved.get('batches_done', []))
+
+    @classmethod
+    def from_skip(cls, skip):
+        """Returns a Checkpoint of the rows named by skip(), or of none if
+        skip is empty. A plain row count stands for that many leading rows.
+        Raises ValueError if skip is malformed."""
+        checkpoint = cls()
+        if skip:
+            parts = skip.split(',')
+            checkpoint.done = int(parts[0])
+            if checkpoint.done < 0:
+                raise ValueError("Invalid rows {!r}".format(parts[0]))
+            for part in parts[1:]:
+                start, end = map(int, part.split('-'))
+                if not checkpoint.done < start < end:
+                    raise ValueError("Invalid rows {!r}".format(part))
+                checkpoint._finished[start] = end - start
+        return checkpoint
+
+    def skip(self):
+        """Returns the stored rows as text for from_skip(): the count of
+        leading rows, followed by the start-end range of each batch stored
+        beyond them."""
+        with self._lock:
+            return ','.join([str(self.done)] + [
+                '{}-{}'.format(start, start + count)
+                for start, count in sorted(self._finished.items())])
+
+    def missing(self, start, count):
+        """Yields the (start, count) runs of the rows from start to start +
+        count that are not stored yet."""
+        with self._lock:
+            done = self.done
+            stored = sorted(self._finished.items())
+        end = start + count
+        start = max(start, done)
+        for first, length in stored:
+            if first >= end:
+                break
+            if first > start:
+                yield start, first - start
+            start = max(start, first + length)
+        if start < end:
+            yield start, end - start
+
+    def finished(self, start, count):
+        with self._lock:
+            self._finished[start] = count
+            while self.done in self._finished:
+                self.done += self._finished.pop(self.done)
+            if self.path:
+                self._save()
+
+    def _save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'rows_done': self.done,
+                       'batches_done': sorted(self._finished.items())}, f)
+        os.replace(tmp, self.path)
+
+
+def run_batches(batches, write, workers, finished=None):
+    """Calls write(batch) for each (key, batch) pair of batches on workers
+    threads, then finished(key, batch) once it succeeded.
+
+    Each worker may have one batch running and one queued, which bounds how
+    much of the input is held in memory. No new batches are started after a
+    write fails, and the first failure is raised once the running ones end.
+    Must be called within an app context, which the workers share.
+    """
+    app = current_app._get_current_object()
+    slots = threading.BoundedSemaphore(workers * 2)
+    errors = []
+
+    def run(key, batch):
+        try:
+            with app.app_context():
+                write(batch)
+            if finished is not None:
+                finished(key, batch)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for key, batch in batches:
+            if errors:
+                break
+            slots.acquire()
+            executor.submit(run, key, batch)
+
+    if errors:
+        raise errors[0]
+
+
+# [START import]
+def import_books(model, rows, batch_size=None, workers=None, checkpoint=None):
+    """Creates a book for every row, batch_size rows per create_many call on
+    workers threads. Returns the number of rows stored.
+
+    Rows the checkpoint holds as stored are skipped, so passing the
+    Checkpoint of a failed run resumes it without writing any row twice.
+    Must be called within an app context.
+    """
+    config = current_app.config
+    batch_size = batch_size or config['BULK_BATCH_SIZE']
+    workers = workers or config['BULK_WORKERS']
+    checkpoint = checkpoint or Checkpoint()
+
+    def numbered():
+        start = 0
+        for batch in _batches(rows, batch_size):
+            for first, count in checkpoint.missing(start, len(batch)):
+                yield first, batch[first - start:first - start + count]
+            start += len(batch)
+
+    run_batches(numbered(), model.create_many, workers,
+                lambda start, batch: checkpoint.finished(start, len(batch)))
+    return checkpoint.done
+# [END import]
+
+
+# [START export]
+def export_books(model, format, batch_size=None):
+    """Yields the whole catalog as chunks of CSV or JSON lines text, one
+    page of books per chunk.
+
+    Pass the backend module rather than the cached model, so that exporting
+    doesn't fill the cache with pages nobody else reads.
+    """
+    batch_size = batch_size or current_app.config['BULK_BATCH_SIZE']
+    fields = ('id',) + BOOK_FIELDS
+
+    if format == 'csv':
+        out = io.StringIO()
+        writer = csv.DictWriter(out, fields, extrasaction='ignore')
+        writer.writeheader()
+        yield out.getvalue()
+    elif format != 'jsonl':
+        raise ValueError("Unknown format {!r}".format(format))
+
+    cursor = None
+    while True:
+        books, cursor = model.list(limit=batch_size, cursor=cursor)
+        out = io.StringIO()
+        writer = csv.DictWriter(out, fields, extrasaction='ignore')
+        for book in books:
+            row = dict((field, book.get(field)) for field in fields)
+            if format == 'csv':
+                writer.writerow(row)
+            else:
+                out.write(json.dumps(row, default=str) + '\n')
+        yield out.getvalue()
+        if not cursor:
+            break
+# [END export]
+
+
+def init_app(app):
+    app.config.setdefault('BULK_BATCH_SIZE', 500)
+    app.config.setdefault('BULK_WORKERS', 4)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Bulk import or export the Bookshelf catalog.')
+    parser.add_argument('command', choices=('import', 'export'))
+    parser.add_argument('filename')
+    parser.add_argument('--format', choices=FORMATS,
+                        help='Default: from the file extension.')
+    parser.add_argument('--batch-size', type=int)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--checkpoint',
+                        help='Import progress file, for resuming.')
+    args = parser.parse_args(argv)
+    format = args.format or format_for(args.filename)
+
+    import bookshelf
+    import config
+    app = bookshelf.create_app(config)
+
+    with app.app_context():
+        model = bookshelf.get_model()
+        if args.command == 'import':
+            checkpoint = Checkpoint(args.checkpoint)
+            if checkpoint.skip() != '0':
+                print("Resuming, skipping rows {}".format(checkpoint.skip()))
+            with io.open(args.filename, encoding='utf-8', newline='') as f:
+                done = import_books(
+                    model, read_rows(f, format), args.batch_size,
+                    args.workers, checkpoint)
+            print("Imported {} rows".format(done))
+        else:
+            with io.open(args.filename, 'w', encoding='utf-8',
+                         newline='') as f:
+                for chunk in export_books(
+                        model.backend, format, args.batch_size):
+                    f.write(chunk)
+            print("Exported to {}".format(args.filename))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Read-through caching of books and list pages in front of the data model.
+
+CACHE_TYPE selects the store: 'memory' keeps an LRU in each process, 'redis'
+shares one store (at CACHE_REDIS_URL) between every worker and instance, and
+'none' turns caching off. With the per-process store, a write handled by one
+worker reaches the others' caches only when CACHE_TTL expires.
+"""
+
+import collections
+import copy
+import pickle
+import threading
+import time
+
+
+class LRUCache(object):
+    """A thread-safe in-process LRU cache whose entries expire after ttl
+    seconds.
+
+    Counters live apart from the cached entries so that they are never
+    evicted.
+    """
+
+    def __init__(self, max_entries=10000, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                del self._entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(entry[1])
+
+    def set(self, key, value):
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get_counter(self, key):
+        with self._lock:
+            return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'type': 'memory',
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+            }
+
+
+class RedisCache(object):
+    """A cache shared between processes, stored in Redis.
+
+    Requires the redis package. Evictions are those reported by the server,
+    which include keys dropped for every other user of the same database.
+    """
+
+    def __init__(self, url, ttl=60, prefix='bookshelf:'):
+        import redis
+
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self._client = redis.StrictRedis.from_url(url)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        raw = self._client.get(self.prefix + key)
+        with self._lock:
+            if raw is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return pickle.loads(raw)
+
+    def set(self, key, value):
+        self._client.setex(self.prefix + key, self.ttl, pickle.dumps(value))
+
+    def delete(self, key):
+        self._client.delete(self.prefix + key)
+
+    def get_counter(self, key):
+        return int(self._client.get(self.prefix + key) or 0)
+
+    def incr(self, key):
+        return self._client.incr(self.prefix + key)
+
+    def stats(self):
+        info = self._client.info('stats')
+        with self._lock:
+            return {
+                'type': 'redis',
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': info.get('evicted_keys', 0),
+            }
+
+
+class CachedModel(object):
+    """Wraps the data model with read-through caching of read() and list().
+
+    The wrapper is registered as a write listener on the ModelProxy it wraps:
+    a saved or deleted book is dropped from the cache, and every cached list
+    page is retired by bumping the list generation that is part of each page
+    key. All pages go at once because a new, renamed or deleted book shifts
+    the boundaries of every page after it.
+    """
+
+    LIST_GENERATION = 'list-generation'
+
+    def __init__(self, model, cache):
+        self.model = model
+        self.cache = cache
+        model.add_listener(self)
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def read(self, id):
+        key = 'book:{}'.format(id)
+        book = self.cache.get(key)
+        if book is None:
+            book = self.model.read(id)
+            if book is not None:
+                self.cache.set(key, book)
+        return book
+
+    def read_version(self, id):
+        """Answers from the cached book when there is one; otherwise asks the
+        model, which reads far less than a full book."""
+        book = self.cache.get('book:{}'.format(id))
+        if book is None:
+            return self.model.read_version(id)
+        return book.get('version'), book.get('updatedAt')
+
+    def list(self, limit=10, cursor=None, summary=False):
+        key = 'list:{}:{}:{}:{}'.format(
+            self.cache.get_counter(self.LIST_GENERATION), limit, cursor,
+            int(summary))
+        page = self.cache.get(key)
+        if page is None:
+            page = self.model.list(
+                limit=limit, cursor=cursor, summary=summary)
+            self.cache.set(key, page)
+        return page
+
+    def book_saved(self, book):
+        self._invalidate(book['id'])
+
+    def book_deleted(self, id):
+        self._invalidate(id)
+
+    def book_voted(self, id, counts):
+        # Votes change no list page, so only the book itself goes.
+        self.cache.delete('book:{}'.format(id))
+
+    def _invalidate(self, id):
+        self.cache.delete('book:{}'.format(id))
+        self.cache.incr(self.LIST_GENERATION)
+
+
+def init_app(app, model):
+    """Wraps the model in a CachedModel according to the app's CACHE_*
+    settings. Returns the model unchanged when caching is off."""
+    app.config.setdefault('CACHE_TYPE', 'memory')
+    app.config.setdefault('CACHE_TTL', 60)
+    app.config.setdefault('CACHE_MAX_ENTRIES', 10000)
+
+    cache_type = app.config['CACHE_TYPE']
+    if cache_type == 'memory':
+        cache = LRUCache(
+            max_entries=app.config['CACHE_MAX_ENTRIES'],
+            ttl=app.config['CACHE_TTL'])
+    elif cache_type == 'redis':
+        cache = RedisCache(
+            app.config['CACHE_REDIS_URL'], ttl=app.config['CACHE_TTL'])
+    elif cache_type in (None, 'none'):
+        return model
+    else:
+        raise ValueError(
+            "Unknown CACHE_TYPE {!r}. "
+            "Please specify memory, redis, or none".format(cache_type))
+
+    app.extensions['bookshelf.cache'] = cache
+    return CachedModel(model, cache)
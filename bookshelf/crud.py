@@ -12,38 +12,156 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from bookshelf import get_model
-from flask import Blueprint, redirect, render_template, request, url_for, session
+import hashlib
+import io
+import json
+
+from bookshelf import bulk, cache, fanout, fuzzy, get_model, search, \
+    suggest, users, votes
+from flask import abort, Blueprint, current_app, jsonify, redirect, \
+    render_template, request, Response, session, stream_with_context, url_for
+from markupsafe import escape, Markup
 
 
 crud = Blueprint('crud', __name__)
 
 
+# How many titles like it a book's page lists.
+SIMILAR_TITLES = 5
+
+
+def _revalidate(etag, last_modified=None):
+    """Starts a response carrying the given validators. If the client's copy
+    is still current it is already a complete 304; otherwise the caller fills
+    in the body.
+
+    Clients must revalidate before reusing a copy, since any write changes
+    what the page shows.
+    """
+    response = Response()
+    response.cache_control.no_cache = True
+    if etag:
+        response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    return response.make_conditional(request)
+
+
+# Rendered in place of the signed-in name on cached pages, and replaced by it
+# as each is served.
+NAME_SLOT = Markup('<!-- session name -->')
+
+
+def _page_cache_key(kind, *parts):
+    """Returns the cache key of a rendered page, or None if caching is off.
+
+    The key holds the list generation that every book write bumps, so a
+    write retires every cached page at once.
+    """
+    store = current_app.extensions.get('bookshelf.cache')
+    if store is None:
+        return None
+    return 'page:{}:{}:{}:{}'.format(
+        kind, store.get_counter(cache.CachedModel.LIST_GENERATION),
+        current_app.config['DATA_BACKEND'], ':'.join(map(str, parts)))
+
+
 # [START list]
 @crud.route("/")
 def list():
+    # The page token is an opaque cursor produced by the model's list(); it
+    # is handed back to the model exactly as it was received. The page only
+    # shows each book's title, author and rating, so only those are read.
     token = request.args.get('page_token', None)
-    if token:
-        token = token.encode('utf-8')
 
-    books, next_page_token = get_model().list(cursor=token)
-    if 'name' in session:
-        return render_template(
-        "list.html",
-        books=books,
-        next_page_token=next_page_token)
-    return render_template(
-        "list.html",
-        books=books,
-        next_page_token=next_page_token)
-        
+    # Pages are the same for everyone but for the signed-in name, so they
+    # are cached rendered, with the name spliced in per request. A cached
+    # page is served without reading a book or rendering a template.
+    key = _page_cache_key('list', token)
+    page = current_app.extensions['bookshelf.cache'].get(key) if key else None
+
+    if page is None:
+        try:
+            books, next_page_token = get_model().list(
+                cursor=token, summary=True)
+        except ValueError:
+            abort(400)
+        # The page is determined by its books' versions and the next token.
+        page = {'validator': json.dumps([
+            [[str(book['id']), book.get('version')] for book in books],
+            next_page_token])}
+
+    # Together with the signed-in name, the page's validator hashes to the
+    # ETag, and an unchanged page is answered without rendering it.
+    etag = json.dumps([page['validator'], session.get('name')])
+    response = _revalidate(hashlib.sha1(etag.encode('utf-8')).hexdigest())
+    response.vary.add('Cookie')
+    if response.status_code == 304:
+        return response
+    if 'html' not in page:
+        page['html'] = render_template(
+            "list.html",
+            books=books,
+            next_page_token=next_page_token,
+            name=NAME_SLOT)
+        if key:
+            current_app.extensions['bookshelf.cache'].set(key, page)
+    response.set_data(page['html'].replace(
+        NAME_SLOT, escape(session.get('name') or '')))
+    return response
 # [END list]
 
 
 @crud.route('/<id>',methods=['GET', 'POST'])
-def view(id):    
-    book = get_model().read(id)
-    return render_template("view.html", book=book)
+def view(id):
+    # Only the version is read to check the client's copy; the book itself
+    # is read and rendered when the copy is out of date. Votes this process
+    # hasn't flushed yet are counted in, and so are part of the ETag.
+    version, updated = get_model().read_version(id) or (None, None)
+    pending = votes.get_buffer().pending(id)
+    response = _revalidate(
+        'book-{}-{}-{}'.format(id, version, '.'.join(map(str, pending)))
+        if version else None, updated)
+    if response.status_code == 304:
+        return response
+    # The book and the titles like it are looked up at the same time. The
+    # titles aren't part of the ETag: a copy may list them as they were when
+    # the book last changed. The page never waits for the search index to be
+    # built; until it is, the page lists no titles.
+    book, similar = fanout.gather(
+        lambda: get_model().read(id),
+        lambda: search.get_index(wait=False).similar(
+            id, limit=SIMILAR_TITLES))
+    if book is not None:
+        likes, ratings, total = pending
+        book['likes'] = (book.get('likes') or 0) + likes
+        book['ratingCount'] = (book.get('ratingCount') or 0) + ratings
+        book['ratingTotal'] = (book.get('ratingTotal') or 0) + total
+    response.set_data(
+        render_template("view.html", book=book, similar=similar))
+    return response
+
+
+@crud.route('/<id>/like', methods=['POST'])
+def like(id):
+    if get_model().read_version(id) is None:
+        abort(404)
+    votes.get_buffer().add(id, likes=1)
+    return redirect(url_for('.view', id=id))
+
+
+@crud.route('/<id>/rate', methods=['POST'])
+def rate(id):
+    try:
+        rating = int(request.form.get('rating', ''))
+    except ValueError:
+        abort(400)
+    if not 1 <= rating <= 5:
+        abort(400)
+    if get_model().read_version(id) is None:
+        abort(404)
+    votes.get_buffer().add(id, rating=rating)
+    return redirect(url_for('.view', id=id))
 
 def userview(id):
     user = get_model().read(id)
@@ -67,8 +185,17 @@ def add():
 def signup():
     if request.method == 'POST':
         data = request.form.to_dict(flat=True)
-
-        user = get_model().createUser(data)
+        if not data.get('name'):
+            return render_template(
+                "signup.html", action='Sign up',
+                error="Please enter a name"), 400
+
+        try:
+            users.get_store().create(data)
+        except users.NameTaken:
+            return render_template(
+                "signup.html", action='Sign up',
+                error="That name is taken"), 409
         return redirect(url_for('.list'))
 
     return render_template("signup.html",action = 'Sign up')
@@ -82,7 +209,7 @@ def login():
         name = data['name']
         pwd = data['pwd']
         
-        user = get_model().getName(name)
+        user = users.get_store().get(name)
         
         if user is not None:
             print("log in success!")
@@ -108,54 +235,135 @@ def logout():
     return redirect(url_for('.list'))
 
 
+# [START search_start]
+# Maps the search form's categories onto fields of the search index.
+SEARCH_FIELDS = {
+    'Title': 'title',
+    'Author': 'author',
+    'Rating': 'rating',
+    'Description': 'description',
+    'Year': 'year',
+}
+
 
+# Numeric filters of the search form, as named by SearchIndex.query().
+SEARCH_RANGES = ('min_rating', 'max_rating', 'min_year', 'max_year')
 
 
+@crud.route('/search', methods=['GET', 'POST'])
+def search_start():
+    # The form posts the first page; the "More" and facet links ask for
+    # further pages and narrower queries with everything in the URL.
+    params = request.form if request.method == 'POST' else request.args
+    query = params.get('q', '')
+    category = params.get('Category')
+    filters = dict(
+        (name, params.get(name, type=int)) for name in SEARCH_RANGES)
+    filters['author'] = params.get('author')
+
+    if query and params.get('mode') == 'fuzzy':
+        # Fuzzy mode finds titles and authors despite typos. It returns the
+        # closest matches only, without filters, facets or further pages.
+        field = SEARCH_FIELDS.get(category)
+        booklist = fuzzy.get_index().search(
+            query, field=field if field in fuzzy.FIELDS else None)
+        return render_template(
+            "search.html", searchlist=booklist,
+            params={'q': query, 'Category': category, 'mode': 'fuzzy'})
+
+    if query or any(filters.values()):
+        try:
+            booklist, next_page_token, facets = search.get_index().query(
+                query, field=SEARCH_FIELDS.get(category), filters=filters,
+                cursor=params.get('page_token'))
+        except ValueError:
+            abort(400)
 
+        current = dict(filters, q=query, Category=category)
+        current = dict((name, value) for name, value in current.items()
+                       if value not in (None, ''))
 
+        def search_url(**changes):
+            """Links to this search with some parameters changed."""
+            return url_for('.search_start', **dict(current, **changes))
 
+        return render_template(
+            "search.html", searchlist=booklist, facets=facets,
+            next_page_token=next_page_token, params=current,
+            search_url=search_url)
 
-# [START search_start]
-@crud.route('/search', methods=['GET', 'POST'])
-def search_start():
-    if request.method == 'POST':
-        query = request.form["q"]
-        
-        if(query is not None):
-            category = request.form['Category']
+    return render_template("search.html", params={})
 
-            if category == 'Title':
-                booklist = get_model().searchByTitle(query)
-            
-            elif category == 'Author':
-                booklist = get_model().searchByAuthor(query)
-                
-            elif category == 'Rating':
-                booklist = get_model().searchByRating(query)
-            
-            elif category == 'Description':
-                booklist = get_model().searchByDescription(query)
-            
-            elif category == 'Year':
-                booklist = get_model().searchByYear(query)
-                
-            return render_template("search.html", searchlist=booklist)
-        
-    return render_template("search.html")
-    
 # [END search_start]
 
+
+@crud.route('/suggest')
+def typeahead():
+    """Returns completions of ?q= from book titles and authors as JSON,
+    optionally only from ?field=title or ?field=author."""
+    completions = suggest.get_index().suggest(
+        request.args.get('q', ''),
+        limit=request.args.get('limit', 10, type=int),
+        field=request.args.get('field'))
+    return jsonify(suggestions=completions)
+
+
+# [START bulk]
+@crud.route('/import', methods=['POST'])
+def bulk_import():
+    """Creates books from a CSV (Content-Type text/csv) or JSON lines body,
+    streamed in batches. After a failure the response reports the rows
+    stored as skip; sending the same body again with ?skip=<skip> resumes
+    the import without creating any of them twice.
+    """
+    format = request.args.get('format') or (
+        'csv' if request.mimetype == 'text/csv' else 'jsonl')
+    if format not in bulk.FORMATS:
+        abort(400)
+
+    try:
+        checkpoint = bulk.Checkpoint.from_skip(request.args.get('skip'))
+    except ValueError:
+        abort(400)
+    stream = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+    try:
+        bulk.import_books(
+            get_model(), bulk.read_rows(stream, format),
+            checkpoint=checkpoint)
+    except Exception as e:
+        return jsonify(error=str(e), rows_done=checkpoint.done,
+                       skip=checkpoint.skip()), 500
+    return jsonify(rows_done=checkpoint.done)
+
+
+@crud.route('/export')
+def bulk_export():
+    format = request.args.get('format', 'jsonl')
+    if format not in bulk.FORMATS:
+        abort(400)
+
+    chunks = bulk.export_books(get_model().backend, format)
+    return Response(
+        stream_with_context(chunks),
+        mimetype='text/csv' if format == 'csv' else 'application/x-ndjson',
+        headers={'Content-Disposition':
+                 'attachment; filename=books.{}'.format(format)})
+# [END bulk]
+
+
 @crud.route('/<id>/edit', methods=['GET', 'POST'])
 def edit(id):
-    book = get_model().read(id)
-
     if request.method == 'POST':
         data = request.form.to_dict(flat=True)
 
+        # The update returns the stored book, so it isn't read beforehand.
         book = get_model().update(data, id)
+        if book is None:
+            abort(404)
 
         return redirect(url_for('.view', id=book['id']))
 
+    book = get_model().read(id)
     return render_template("form.html", action="Edit", book=book)
 
 @crud.route('/<id>/delete')
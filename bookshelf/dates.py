@@ -0,0 +1,59 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Structured publication dates parsed from the free-form publishedDate.
+
+Books keep publishedDate exactly as entered. Each write also stores the
+integer publishedYear, which every backend indexes so that year searches are
+range scans, and publishedOn, the full date as a datetime, when the text
+names a day.
+"""
+
+import datetime
+import re
+
+
+# Formats publishedDate is tried against, most common first. The Google Books
+# API uses the ISO forms; people typing into the form use the rest.
+DATE_FORMATS = ('%Y-%m-%d', '%m/%d/%Y', '%Y/%m/%d', '%d.%m.%Y', '%B %d, %Y',
+                '%b %d, %Y', '%d %B %Y', '%d %b %Y')
+
+_YEAR_RE = re.compile(r'\b([12]\d{3})\b')
+
+
+def parse_published(text):
+    """Returns (year, datetime) for a publishedDate, either of which may be
+    None. Without a whole date, the year is the first four-digit number
+    from 1000 to 2999 in the text."""
+    text = u'{}'.format(text or u'').strip()
+    if not text:
+        return None, None
+    for format in DATE_FORMATS:
+        try:
+            published = datetime.datetime.strptime(text, format)
+        except ValueError:
+            continue
+        return published.year, published
+    match = _YEAR_RE.search(text)
+    return (int(match.group(1)) if match else None), None
+
+
+def with_published(data):
+    """Returns data with publishedYear and publishedOn set from its
+    publishedDate, or data itself if it has no publishedDate to parse."""
+    if 'publishedDate' not in data:
+        return data
+    year, published = parse_published(data['publishedDate'])
+    return dict(data, publishedYear=year, publishedOn=published)
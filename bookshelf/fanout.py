@@ -0,0 +1,125 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Independent lookups of one request, run at the same time.
+
+A page that needs a book and the titles like it would otherwise wait for one
+lookup and then the other. gather() runs the first call in the request's own
+thread and the rest on a thread pool shared by the process, so the request
+waits about as long as its slowest lookup rather than the sum of them.
+
+Every backend client here blocks (SQLAlchemy 1.3 has no asyncio engine, and
+pymongo and the Datastore client are synchronous), so the calls overlap on
+threads rather than on an event loop. Under the gevent worker those threads
+are greenlets. Each call runs in a copy of the request context with an app
+context of its own, so cloudsql gives it its own session, and its database
+calls are counted toward the request in /metrics.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+from flask import copy_current_request_context, current_app, \
+    has_request_context
+
+from . import metrics
+
+
+class FanOut(object):
+    """Runs calls concurrently on a pool of up to workers threads.
+
+    With workers of 0 or less the calls run one after another.
+    """
+
+    def __init__(self, app, workers=8):
+        self.app = app
+        self.workers = workers
+        self.batches = 0
+        self.calls = 0
+        self.inline = 0
+        self._executor = None
+        if workers > 0:
+            self._executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='fanout')
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def gather(self, *calls):
+        """Calls each of calls, functions of no arguments, and returns their
+        results in order. If any raise, the exception of the first of them
+        is raised once every call has finished."""
+        # Calls made from a pool thread run there, so that a nested gather
+        # can't wait on the threads it is holding.
+        if (len(calls) < 2 or self._executor is None or
+                getattr(self._local, 'active', False)):
+            with self._lock:
+                self.inline += len(calls)
+            return [call() for call in calls]
+
+        with self._lock:
+            self.batches += 1
+            self.calls += len(calls)
+        futures = [self._executor.submit(self._wrap(call))
+                   for call in calls[1:]]
+        try:
+            first = calls[0]()
+        finally:
+            # Nothing returns, or raises, while a call is still running in
+            # this request's context.
+            for future in futures:
+                future.exception()
+        return [first] + [future.result() for future in futures]
+
+    def _wrap(self, call):
+        stats = metrics.current_stats()
+
+        def run():
+            self._local.active = True
+            try:
+                metrics.share_stats(stats)
+                return call()
+            finally:
+                self._local.active = False
+
+        if has_request_context():
+            return copy_current_request_context(run)
+
+        def run_in_app():
+            with self.app.app_context():
+                return run()
+        return run_in_app
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'batches': self.batches,
+                'calls': self.calls,
+                'inline_calls': self.inline,
+            }
+
+
+def init_app(app):
+    """Creates the app's fan-out pool."""
+    app.config.setdefault('FANOUT_WORKERS', 8)
+    fanout = FanOut(app, workers=app.config['FANOUT_WORKERS'])
+    app.extensions['bookshelf.fanout'] = fanout
+    return fanout
+
+
+def gather(*calls):
+    """Runs calls concurrently on the current app's pool; see
+    FanOut.gather()."""
+    return current_app.extensions['bookshelf.fanout'].gather(*calls)
@@ -0,0 +1,201 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Typo-tolerant search of titles and authors.
+
+Every distinct title and author is indexed under its trigrams, the runs of
+three characters it contains. A query gathers the texts that share trigrams
+with it from those posting lists alone, skipping trigrams common to much of
+the catalog, so its cost depends on how many texts look alike rather than on
+the size of the catalog. The MAX_CANDIDATES texts sharing the most trigrams
+are then ranked by how many edits turn the query into some part of them, and
+those within a few edits are returned.
+
+Like the search index, each process keeps its own copy, built from the
+backend in the background and kept current through the write notifications
+of the model proxy.
+"""
+
+import heapq
+
+from flask import current_app
+
+from .search import fresh_index, LiveIndex, MAX_PAGE_SIZE, SUMMARY_FIELDS, \
+    warm
+
+
+# The fields fuzzy search looks in.
+FIELDS = ('title', 'author')
+
+# How many of the texts sharing the most trigrams with a query are compared
+# with it edit by edit.
+MAX_CANDIDATES = 100
+
+# Trigrams found in more than this fraction of all texts, such as " th", are
+# left out of a query that has rarer ones, the way stop words are. Reading
+# their posting lists would cost time in proportion to the catalog.
+COMMON_FRACTION = 0.05
+
+
+def _normalize(text):
+    return u' '.join(u'{}'.format(text or u'').lower().split())
+
+
+def trigrams(text):
+    """Returns the set of trigrams of a normalized text, padded so that short
+    texts and word starts have some too."""
+    padded = u'  {} '.format(text)
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def substring_distance(query, text):
+    """Returns the fewest single-character edits that turn query into some
+    substring of text, so a misspelled word matches inside a long title.
+    Swapping two adjacent characters counts as one edit."""
+    before, previous = None, [0] * (len(text) + 1)
+    for i, q in enumerate(query, 1):
+        current = [i]
+        for j, t in enumerate(text, 1):
+            cost = min(previous[j] + 1, current[j - 1] + 1,
+                       previous[j - 1] + (q != t))
+            if (before is not None and j > 1 and q == text[j - 2] and
+                    query[i - 2] == t):
+                cost = min(cost, before[j - 2] + 1)
+            current.append(cost)
+        before, previous = previous, current
+    return min(previous)
+
+
+def max_distance(query):
+    """The most edits a match may be away from the query: one per four
+    characters, at least one and at most three."""
+    return min(3, max(1, len(query) // 4))
+
+
+class FuzzyIndex(LiveIndex):
+    """A thread-safe trigram index of titles and authors.
+
+    Texts are indexed once however many books share them, each with the ids
+    of its books.
+    """
+
+    DATA_ATTRIBUTES = ('_grams', '_texts', '_book_texts', '_docs')
+    # The summaries hold the FIELDS too.
+    BUILD_FIELDS = SUMMARY_FIELDS
+
+    def __init__(self, max_age=None):
+        super(FuzzyIndex, self).__init__(max_age)
+        self._grams = {}
+        self._texts = {}
+        self._book_texts = {}
+        self._docs = {}
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, book):
+        """Indexes a book, replacing any previous version of it."""
+        doc_id = str(book['id'])
+        keys = [(field, _normalize(book.get(field))) for field in FIELDS]
+        keys = [key for key in keys if key[1]]
+        with self._lock:
+            self.remove(doc_id)
+            summary = dict((f, book.get(f)) for f in SUMMARY_FIELDS)
+            summary['id'] = book['id']
+            self._docs[doc_id] = summary
+            self._book_texts[doc_id] = keys
+            for key in keys:
+                if key not in self._texts:
+                    self._texts[key] = set()
+                    for gram in trigrams(key[1]):
+                        self._grams.setdefault(gram, set()).add(key)
+                self._texts[key].add(doc_id)
+
+    def remove(self, id):
+        doc_id = str(id)
+        with self._lock:
+            self._docs.pop(doc_id, None)
+            for key in self._book_texts.pop(doc_id, ()):
+                ids = self._texts[key]
+                ids.discard(doc_id)
+                if ids:
+                    continue
+                del self._texts[key]
+                for gram in trigrams(key[1]):
+                    texts = self._grams[gram]
+                    texts.discard(key)
+                    if not texts:
+                        del self._grams[gram]
+
+    def search(self, query, field=None, limit=10):
+        """Returns the summaries of up to limit books whose title or author,
+        or only the given field, is within max_distance edits of the query,
+        closest first. Each summary has the distance of its match added."""
+        query = _normalize(query)
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        if not query:
+            return []
+
+        with self._lock:
+            postings = [self._grams[gram] for gram in trigrams(query)
+                        if gram in self._grams]
+            common = max(MAX_CANDIDATES, COMMON_FRACTION * len(self._texts))
+            rare = [texts for texts in postings if len(texts) <= common]
+            shared = {}
+            for texts in rare or postings:
+                for key in texts:
+                    if field is None or key[0] == field:
+                        shared[key] = shared.get(key, 0) + 1
+            candidates = heapq.nlargest(
+                MAX_CANDIDATES, shared, key=shared.__getitem__)
+
+            allowed = max_distance(query)
+            matches = []
+            for key in candidates:
+                distance = substring_distance(query, key[1])
+                if distance <= allowed:
+                    matches.append(
+                        (distance, abs(len(key[1]) - len(query)), key))
+            matches.sort()
+
+            results = []
+            seen = set()
+            for distance, _, key in matches:
+                for doc_id in sorted(self._texts[key]):
+                    if doc_id in seen:
+                        continue
+                    seen.add(doc_id)
+                    summary = dict(self._docs[doc_id], distance=distance)
+                    results.append(summary)
+                    if len(results) == limit:
+                        return results
+        return results
+
+
+def init_app(app, model):
+    """Creates the app's fuzzy index and subscribes it to book writes on the
+    model proxy, starting its first build if INDEX_WARM is set."""
+    app.config.setdefault('FUZZY_INDEX_MAX_AGE', 300)
+    index = FuzzyIndex(max_age=app.config['FUZZY_INDEX_MAX_AGE'])
+    app.extensions['bookshelf.fuzzy'] = index
+    model.add_listener(index)
+    warm(app, index, model)
+    return index
+
+
+def get_index():
+    """Returns the current app's fuzzy index, starting a rebuild in the
+    background if it is empty or too old; see search.fresh_index()."""
+    return fresh_index(current_app.extensions['bookshelf.fuzzy'])
@@ -0,0 +1,400 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-request performance instrumentation.
+
+For every request to the crud and api blueprints this records the total
+latency by response status, the number of database round trips and the time
+spent in them, and the time spent rendering templates. A request that raises
+is recorded as it is torn down, with status 500 unless the exception carries
+another. Round trips are seen through SQLAlchemy
+engine events, pymongo command monitoring and TimedClient around the
+Datastore client. Everything is served in the Prometheus text format at
+/metrics.
+
+Requests slower than SLOW_REQUEST_THRESHOLD_MS are logged together with the
+database calls they made.
+"""
+
+import contextlib
+import functools
+import logging
+import threading
+import time
+
+from flask import current_app, g, has_request_context, request, Response, \
+    template_rendered
+from flask.signals import before_render_template
+from pymongo import monitoring
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.exceptions import HTTPException
+
+
+logger = logging.getLogger(__name__)
+
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+# Upper bounds of the buckets for database round trips per request.
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# Requests to these blueprints are measured.
+INSTRUMENTED_BLUEPRINTS = ('crud', 'api')
+
+# At most this many database calls are kept per request for the slow log.
+MAX_RECORDED_CALLS = 100
+
+
+class Histogram(object):
+    """A cumulative histogram in the Prometheus style, one series per label
+    value.
+
+    label may also be a tuple of label names, in which case each label value
+    is a tuple of as many values.
+    """
+
+    def __init__(self, name, help, label, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = {
+                    'buckets': [0] * len(self.buckets), 'count': 0, 'sum': 0.0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['count'] += 1
+            series['sum'] += value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            for label_value, series in sorted(self._series.items()):
+                label = self._format_label(label_value)
+                for bound, count in zip(self.buckets, series['buckets']):
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                        self.name, label, bound, count))
+                lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(
+                    self.name, label, series['count']))
+                lines.append('{}_sum{{{}}} {}'.format(
+                    self.name, label, series['sum']))
+                lines.append('{}_count{{{}}} {}'.format(
+                    self.name, label, series['count']))
+        return lines
+
+    def _format_label(self, label_value):
+        if not isinstance(self.label, tuple):
+            return '{}="{}"'.format(self.label, label_value)
+        return ','.join('{}="{}"'.format(name, value)
+                        for name, value in zip(self.label, label_value))
+
+
+class Registry(object):
+    """Holds an app's histograms and any extra collectors for /metrics.
+
+    A collector is a function returning a list of lines in the Prometheus
+    text format; other modules add one to publish their own counters.
+    """
+
+    def __init__(self):
+        self.request_latency = Histogram(
+            'bookshelf_request_seconds',
+            'Request latency by endpoint and status.', ('endpoint', 'status'))
+        self.db_calls = Histogram(
+            'bookshelf_db_calls_per_request',
+            'Database round trips per request by endpoint.', 'endpoint',
+            buckets=COUNT_BUCKETS)
+        self.db_time = Histogram(
+            'bookshelf_db_seconds_per_request',
+            'Time spent in database calls per request by endpoint.',
+            'endpoint')
+        self.render_time = Histogram(
+            'bookshelf_template_render_seconds',
+            'Template render time by template.', 'template')
+        self.collectors = []
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for histogram in (self.request_latency, self.db_calls, self.db_time,
+                          self.render_time):
+            lines.extend(histogram.render())
+        for collector in self.collectors:
+            lines.extend(collector())
+        return '\n'.join(lines) + '\n'
+
+
+class RequestStats(object):
+    """The database calls and render time of the current request."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.db_calls = 0
+        self.db_time = 0.0
+        self.calls = []
+        self.renders = {}
+        # Lookups fanned out by bookshelf.fanout record from several threads.
+        self._lock = threading.Lock()
+
+    def record_db_call(self, statement, seconds):
+        with self._lock:
+            self.db_calls += 1
+            self.db_time += seconds
+            if len(self.calls) < MAX_RECORDED_CALLS:
+                self.calls.append((statement, seconds))
+
+
+def _request_stats():
+    if not has_request_context():
+        return None
+    return g.get('_bookshelf_metrics')
+
+
+def current_stats():
+    """Returns the RequestStats of the current request, or None if it isn't
+    instrumented."""
+    return _request_stats()
+
+
+def share_stats(stats):
+    """Counts the database calls made in the current context toward stats,
+    the RequestStats of the request that started it."""
+    if stats is not None:
+        g._bookshelf_metrics = stats
+
+
+def record_db_call(statement, seconds):
+    """Attributes a database round trip to the current request, if any."""
+    stats = _request_stats()
+    if stats is not None:
+        stats.record_db_call(statement, seconds)
+
+
+@contextlib.contextmanager
+def db_call(statement):
+    """Times the enclosed block as one database round trip."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        record_db_call(statement, time.time() - start)
+
+
+class TimedClient(object):
+    """Wraps a client object, recording each call of the named methods as a
+    database round trip."""
+
+    def __init__(self, client, methods, prefix):
+        self._client = client
+        self._methods = frozenset(methods)
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name not in self._methods:
+            return attr
+
+        @functools.wraps(attr)
+        def timed(*args, **kwargs):
+            with db_call('{}.{}'.format(self._prefix, name)):
+                return attr(*args, **kwargs)
+        return timed
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('bookshelf_query_start', []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    start = conn.info['bookshelf_query_start'].pop()
+    record_db_call(statement, time.time() - start)
+
+
+def _handle_error(context):
+    # A failed statement gets no after_cursor_execute, so its start time is
+    # taken off the connection here. An error raised before the statement
+    # reached the cursor left none.
+    conn = context.connection
+    starts = conn.info.get('bookshelf_query_start') if conn is not None \
+        else None
+    if starts:
+        record_db_call(context.statement, time.time() - starts.pop())
+
+
+def _listen_to_sqlalchemy():
+    if not event.contains(Engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+
+
+class _MongoCommandListener(monitoring.CommandListener):
+    """Times Mongo commands. pymongo publishes command events on the thread
+    that issued the command, so the request is still current. The listener
+    is shared by every thread, so the commands in progress are kept under a
+    lock."""
+
+    def __init__(self):
+        self._started = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        with self._lock:
+            self._started[event.request_id] = time.time()
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        self._finish(event)
+
+    def _finish(self, event):
+        with self._lock:
+            start = self._started.pop(event.request_id, None)
+        if start is not None:
+            record_db_call(
+                'mongodb.{}'.format(event.command_name), time.time() - start)
+
+
+_mongo_listener = None
+
+
+def _listen_to_pymongo():
+    global _mongo_listener
+
+    if _mongo_listener is None:
+        _mongo_listener = _MongoCommandListener()
+        # Only clients created after this call are monitored, which is why
+        # init_app must run before the model's.
+        monitoring.register(_mongo_listener)
+
+
+def stats_collector(prefix, stats):
+    """Returns a collector that publishes every number in the dict returned
+    by stats() as a gauge named prefix_<key>."""
+    def collect():
+        lines = []
+        for key, value in sorted(stats().items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                name = '{}_{}'.format(prefix, key)
+                lines.append('# TYPE {} gauge'.format(name))
+                lines.append('{} {}'.format(name, value))
+        return lines
+    return collect
+
+
+def _before_request():
+    if request.blueprint in INSTRUMENTED_BLUEPRINTS:
+        g._bookshelf_metrics = RequestStats()
+
+
+def _after_request(response):
+    _record_request(response.status_code)
+    return response
+
+
+def _teardown_request(exception=None):
+    # Requests that raise skip _after_request, and are only seen here.
+    if isinstance(exception, HTTPException) and exception.code:
+        _record_request(exception.code)
+    else:
+        _record_request(500)
+
+
+def _record_request(status):
+    """Records the current request, once, as answered with status."""
+    stats = _request_stats()
+    if stats is None:
+        return
+    g.pop('_bookshelf_metrics')
+
+    registry = current_app.extensions['bookshelf.metrics']
+    endpoint = request.endpoint
+    elapsed = time.time() - stats.started
+    registry.request_latency.observe((endpoint, status), elapsed)
+    registry.db_calls.observe(endpoint, stats.db_calls)
+    registry.db_time.observe(endpoint, stats.db_time)
+    for template, seconds in stats.renders.items():
+        registry.render_time.observe(template, seconds)
+
+    threshold = current_app.config['SLOW_REQUEST_THRESHOLD_MS']
+    if threshold is not None and elapsed * 1000 > threshold:
+        logger.warning(
+            "Slow request: %s %s took %.0f ms, %d database calls "
+            "(%.0f ms):\n%s",
+            request.method, request.path, elapsed * 1000, stats.db_calls,
+            stats.db_time * 1000,
+            '\n'.join('  {:.1f} ms  {}'.format(seconds * 1000, statement)
+                      for statement, seconds in stats.calls))
+
+
+def _before_render(sender, template, context, **extra):
+    g._bookshelf_render_start = time.time()
+
+
+def _rendered(sender, template, context, **extra):
+    stats = _request_stats()
+    start = g.pop('_bookshelf_render_start', None)
+    if stats is not None and start is not None:
+        name = template.name or '<string>'
+        stats.renders[name] = (
+            stats.renders.get(name, 0.0) + time.time() - start)
+
+
+def init_app(app):
+    """Installs the instrumentation on app and adds the /metrics route.
+
+    Must be called before the data model's init_app so that the Mongo client
+    is created with command monitoring in place.
+    """
+    app.config.setdefault('SLOW_REQUEST_THRESHOLD_MS', 1000)
+
+    registry = Registry()
+    app.extensions['bookshelf.metrics'] = registry
+
+    backend = app.config['DATA_BACKEND']
+    if backend == 'cloudsql':
+        _listen_to_sqlalchemy()
+    elif backend == 'mongodb':
+        _listen_to_pymongo()
+
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(registry.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+    return registry
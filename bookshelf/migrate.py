@@ -0,0 +1,344 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Moves the catalog from one data backend to another.
+
+The migrator pages through the source with its list() cursors and writes
+each page to the target from several threads, so memory stays flat however
+big the catalog is. Writes are upserts wherever the book's id can be carried
+over, which makes reruns safe; a checkpoint file lets an interrupted run
+resume from the last page that was fully copied.
+
+To cut over without downtime, set DUAL_WRITE_BACKEND to the target while the
+app still serves from DATA_BACKEND: every book write is then mirrored to the
+target. Run the migrator, switch DATA_BACKEND over, clear DUAL_WRITE_BACKEND,
+and finally drop the tombstones with --clear-tombstones.
+
+A page the migrator read may reach the target after a mirrored write of the
+same book, so every write to the target is conditional on the version the
+ModelProxy stamps on each book write and vote: a copy never replaces a newer
+one, and a mirrored delete leaves a tombstone that keeps any earlier copy
+from bringing the book back. Writes and votes are mirrored as a fresh copy
+of the whole book, so vote totals are ordered the same way.
+
+Run from the repository root:
+
+    $ python -m bookshelf.migrate cloudsql mongodb --checkpoint migrate.ckpt
+"""
+
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+
+from bson.objectid import ObjectId
+from flask import current_app
+
+from . import bulk, get_backend
+
+
+logger = logging.getLogger(__name__)
+
+
+# The largest integer id each backend can store.
+MAX_IDS = {
+    'cloudsql': 2 ** 31 - 1,
+    'datastore': 2 ** 63 - 1,
+    'mongodb': 2 ** 63 - 1,
+}
+
+# Source and target pairs for which IdMapper carries every id over, which
+# dual writes depend on: ObjectIds don't fit in an integer id and Datastore
+# allocates ids too large for the cloudsql column.
+DUAL_WRITE_PAIRS = (
+    ('cloudsql', 'datastore'),
+    ('cloudsql', 'mongodb'),
+    ('datastore', 'mongodb'),
+)
+
+
+class IdMapper(object):
+    """Maps the ids of books in the source backend to ids in the target.
+
+    Integer ids are kept as they are, and become the ObjectId with the same
+    value in mongodb and back. Ids that can't be carried over get a new id
+    from the target; those pairs are remembered, and appended to path if
+    given, so that a rerun doesn't copy such books twice.
+    """
+
+    def __init__(self, source, target, path=None):
+        self.source = source
+        self.target = target
+        self.path = path
+        self._assigned = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    source_id, target_id = json.loads(line)
+                    self._assigned[source_id] = target_id
+
+    def _as_int(self, id):
+        try:
+            if self.source == 'mongodb':
+                value = int(str(id), 16)
+            else:
+                value = int(id)
+        except ValueError:
+            return None
+        return value if value <= MAX_IDS[self.target] else None
+
+    def target_id(self, id):
+        """Returns the id the book keeps in the target, or None if the target
+        has to assign it one."""
+        value = self._as_int(id)
+        if value is None:
+            return None
+        if self.target == 'mongodb':
+            return ObjectId('{:024x}'.format(value))
+        return value
+
+    def assigned(self, id):
+        """Returns the id the target assigned to a book, if it was copied."""
+        return self._assigned.get(str(id))
+
+    def record(self, pairs):
+        pairs = [(str(source_id), str(target_id))
+                 for source_id, target_id in pairs]
+        with self._lock:
+            self._assigned.update(pairs)
+            if self.path:
+                with open(self.path, 'a') as f:
+                    for pair in pairs:
+                        f.write(json.dumps(pair) + '\n')
+
+
+class CursorCheckpoint(object):
+    """Remembers the source cursor after the last page that was copied, along
+    with every page before it.
+
+    Pages are numbered as they are read and may finish out of order; the
+    checkpoint only moves past a page once all earlier ones are done.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.cursor = None
+        self.rows = 0
+        self._next = 0
+        self._finished = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            self.cursor = saved['cursor']
+            self.rows = saved['rows']
+
+    def finished(self, key, batch):
+        number, cursor = key
+        with self._lock:
+            self._finished[number] = (cursor, len(batch))
+            while self._next in self._finished:
+                self.cursor, count = self._finished.pop(self._next)
+                self.rows += count
+                self._next += 1
+                if self.path:
+                    self._save()
+
+    def _save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'cursor': self.cursor, 'rows': self.rows}, f)
+        os.replace(tmp, self.path)
+
+
+def _fields(book):
+    return dict((field, book[field]) for field in bulk.BOOK_FIELDS
+                if book.get(field) is not None)
+
+
+def pages(source, batch_size, cursor=None):
+    """Yields ((number, cursor after the page), books) for every page of the
+    source from cursor on."""
+    number = 0
+    while True:
+        books, cursor = source.list(limit=batch_size, cursor=cursor)
+        if books:
+            yield (number, cursor), books
+            number += 1
+        if not cursor:
+            return
+
+
+# [START migrate]
+def migrate(source, target, mapper, batch_size=None, workers=None,
+            checkpoint=None, report_every=10.0):
+    """Copies every book from the source to the target model module and
+    returns the number copied by this run.
+
+    Throughput is logged every report_every seconds. Must be called within
+    an app context in which both backends are initialized.
+    """
+    config = current_app.config
+    batch_size = batch_size or config['BULK_BATCH_SIZE']
+    workers = workers or config['BULK_WORKERS']
+    checkpoint = checkpoint or CursorCheckpoint()
+    started = time.time()
+    initial_rows = checkpoint.rows
+    last_report = [started]
+
+    def write(books):
+        keep, fresh = [], []
+        for book in books:
+            data = _fields(book)
+            target_id = mapper.target_id(book['id'])
+            if target_id is not None:
+                data['id'] = target_id
+                keep.append(data)
+            elif mapper.assigned(book['id']) is None:
+                fresh.append((book['id'], data))
+        if keep:
+            target.put_many_newer(keep)
+        if fresh:
+            created = target.create_many([data for _, data in fresh])
+            mapper.record(zip([id for id, _ in fresh],
+                              [book['id'] for book in created]))
+
+    def finished(key, books):
+        checkpoint.finished(key, books)
+        now = time.time()
+        if now - last_report[0] >= report_every:
+            last_report[0] = now
+            copied = checkpoint.rows - initial_rows
+            logger.info("Copied %d books, %.0f books/s", copied,
+                        copied / (now - started))
+
+    bulk.run_batches(pages(source, batch_size, checkpoint.cursor), write,
+                     workers, finished)
+
+    copied = checkpoint.rows - initial_rows
+    elapsed = time.time() - started
+    logger.info("Copied %d books in %.1f s, %.0f books/s", copied, elapsed,
+                copied / elapsed if elapsed else 0)
+    return copied
+# [END migrate]
+
+
+class DualWriter(object):
+    """A ModelProxy listener that mirrors every book write to a second
+    backend under the mapped id.
+
+    A write or vote is mirrored by copying the book as the source has it
+    then, with its vote totals, and only over an older copy in the target.
+    The primary backend stays the source of truth: a failed mirror write is
+    logged, not raised, and the next migrator run repairs it.
+    """
+
+    def __init__(self, source, target, mapper):
+        self.source = source
+        self.target = target
+        self.mapper = mapper
+
+    def _mirror(self, id):
+        book = self.source.read(id)
+        if book is not None:
+            self.target.put_many_newer([dict(
+                _fields(book), id=self.mapper.target_id(id))])
+
+    def book_saved(self, book):
+        try:
+            self._mirror(book['id'])
+        except Exception:
+            logger.exception("Dual write of book %s failed", book['id'])
+
+    def book_deleted(self, id):
+        try:
+            self.target.bury(self.mapper.target_id(id))
+        except Exception:
+            logger.exception("Dual delete of book %s failed", id)
+
+    def book_voted(self, id, counts):
+        try:
+            self._mirror(id)
+        except Exception:
+            logger.exception("Dual write of votes for book %s failed", id)
+
+
+def init_app(app, model):
+    """Turns on dual writes to DUAL_WRITE_BACKEND, if it is set."""
+    app.config.setdefault('DUAL_WRITE_BACKEND', None)
+    source = app.config['DATA_BACKEND']
+    target = app.config['DUAL_WRITE_BACKEND']
+    if not target:
+        return
+    if (source, target) not in DUAL_WRITE_PAIRS:
+        raise ValueError(
+            "Can't dual write from {} to {}: not every id can be carried "
+            "over. Supported: {}".format(source, target, ', '.join(
+                '{} to {}'.format(*pair) for pair in DUAL_WRITE_PAIRS)))
+
+    target_model = get_backend(target)
+    with app.app_context():
+        target_model.init_app(app)
+    model.add_listener(DualWriter(
+        model.backend, target_model, IdMapper(source, target)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Copy the Bookshelf catalog between data backends.')
+    backends = ('cloudsql', 'datastore', 'mongodb')
+    parser.add_argument('source', choices=backends)
+    parser.add_argument('target', choices=backends)
+    parser.add_argument('--batch-size', type=int)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--checkpoint', help='Progress file, for resuming.')
+    parser.add_argument(
+        '--id-map',
+        help='File of ids the target assigned, needed to rerun safely when '
+             'ids can\'t be carried over.')
+    parser.add_argument(
+        '--clear-tombstones', action='store_true',
+        help='Only delete the target\'s record of dual-written deletes; '
+             'run once DUAL_WRITE_BACKEND is cleared.')
+    args = parser.parse_args(argv)
+    if args.source == args.target:
+        parser.error('source and target must differ')
+
+    import bookshelf
+    import config
+    logging.basicConfig(level=logging.INFO)
+    app = bookshelf.create_app(
+        config, config_overrides={'DATA_BACKEND': args.source,
+                                  'DUAL_WRITE_BACKEND': None})
+    target = get_backend(args.target)
+
+    with app.app_context():
+        target.init_app(app)
+        if args.clear_tombstones:
+            target.clear_tombstones()
+            return
+        checkpoint = CursorCheckpoint(args.checkpoint)
+        if checkpoint.rows:
+            print("Resuming after {} books".format(checkpoint.rows))
+        migrate(bookshelf.get_model().backend, target,
+                IdMapper(args.source, args.target, args.id_map),
+                args.batch_size, args.workers, checkpoint)
+
+
+if __name__ == '__main__':
+    main()
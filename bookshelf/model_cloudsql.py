@@ -12,26 +12,144 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import logging
+import threading
+import time
+
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, bindparam, func, or_
+from sqlalchemy.exc import IntegrityError, TimeoutError
+from sqlalchemy.orm import load_only
+from sqlalchemy.pool import QueuePool
+
+from .model_proxy import supersedes
+from .pagination import decode_cursor, encode_cursor, INTEGER, OPTIONAL_TEXT
+from .users import DuplicateNames, NameTaken
 
 
 builtin_list = list
 
 
+logger = logging.getLogger(__name__)
+
+
+# The columns list and search pages render, plus the version their ETags are
+# built from. Summary reads load only these (and the id), leaving the long
+# description and the rest in the database.
+SUMMARY_FIELDS = ('title', 'author', 'rating', 'version')
+
+# The most books a searchBy* function returns in one page.
+MAX_SEARCH_PAGE_SIZE = 100
+
+
+# db.session is scoped to the app context, so each request thread or greenlet
+# gets its own session, drawing connections from the engine's pool.
 db = SQLAlchemy()
 
 
+class TimedQueuePool(QueuePool):
+    """A QueuePool that keeps count of checkouts, how long they waited for a
+    connection, and how many gave up after pool_timeout."""
+
+    def __init__(self, *args, **kwargs):
+        super(TimedQueuePool, self).__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        except TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.time() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+
 def init_app(app):
     # Disable track modifications, as it unnecessarily uses memory.
     app.config.setdefault('SQLALCHEMY_TRACK_MODIFICATIONS', False)
+    app.config.setdefault('CLOUDSQL_POOL_SIZE', 8)
+    app.config.setdefault('CLOUDSQL_MAX_OVERFLOW', 4)
+    app.config.setdefault('CLOUDSQL_POOL_TIMEOUT', 10)
+    app.config.setdefault('CLOUDSQL_POOL_RECYCLE', 1800)
+    app.config.setdefault('CLOUDSQL_POOL_PRE_PING', True)
+    app.config.setdefault('CLOUDSQL_POOL_WARM', 4)
+
+    # SQLite files get no pool from Flask-SQLAlchemy, and their connections
+    # can't move between threads anyway.
+    if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+        options.setdefault('poolclass', TimedQueuePool)
+        options.setdefault('pool_size', app.config['CLOUDSQL_POOL_SIZE'])
+        options.setdefault('max_overflow', app.config['CLOUDSQL_MAX_OVERFLOW'])
+        options.setdefault('pool_timeout', app.config['CLOUDSQL_POOL_TIMEOUT'])
+        options.setdefault('pool_recycle', app.config['CLOUDSQL_POOL_RECYCLE'])
+        options.setdefault(
+            'pool_pre_ping', app.config['CLOUDSQL_POOL_PRE_PING'])
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
     db.init_app(app)
+    _warm_pool(app, app.config['CLOUDSQL_POOL_WARM'])
+
+
+def _warm_pool(app, connections):
+    """Opens up to connections pooled connections now, so that the first
+    requests don't wait for the handshakes. A database that can't be
+    reached is logged and left for the requests to report."""
+    engine = db.get_engine(app)
+    if not connections or not isinstance(engine.pool, QueuePool):
+        return
+    opened = []
+    try:
+        for _ in range(min(connections, engine.pool.size())):
+            opened.append(engine.connect())
+    except Exception:
+        logger.warning("Couldn't warm the connection pool", exc_info=True)
+    finally:
+        for connection in opened:
+            connection.close()
+
+
+def pool_stats():
+    """Returns the state and checkout counters of the connection pool."""
+    pool = db.engine.pool
+    if not isinstance(pool, TimedQueuePool):
+        return {'type': type(pool).__name__}
+    with pool._stats_lock:
+        counters = {
+            'checkouts': pool.checkouts,
+            'timeouts': pool.timeouts,
+            'wait_seconds': pool.wait_seconds,
+            'max_wait_seconds': pool.max_wait_seconds,
+        }
+    counters.update({
+        'type': type(pool).__name__,
+        'size': pool.size(),
+        'checked_out': pool.checkedout(),
+        'checked_in': pool.checkedin(),
+        # overflow() counts up from -size as connections are opened.
+        'overflow': max(0, pool.overflow()),
+    })
+    return counters
 
 
 def from_sql(row):
     """Translates a SQLAlchemy model instance into a dictionary"""
+    # Reading the id first reloads any attributes expired by a commit, so
+    # records returned from create() and update() are complete.
+    id = row.id
     data = row.__dict__.copy()
-    data['id'] = row.id
+    data['id'] = id
     data.pop('_sa_instance_state')
     return data
 
@@ -44,6 +162,9 @@ class Book(db.Model):
     title = db.Column(db.String(255))
     author = db.Column(db.String(255))
     publishedDate = db.Column(db.String(255))
+    # Parsed from publishedDate on every write; see bookshelf.dates.
+    publishedYear = db.Column(db.Integer, index=True)
+    publishedOn = db.Column(db.DateTime)
     imageUrl = db.Column(db.String(255))
     description = db.Column(db.String(4096))
     rating = db.Column(db.Integer)
@@ -51,16 +172,41 @@ class Book(db.Model):
     createdBy = db.Column(db.String(255))
     createdById = db.Column(db.String(255))
 
+    # Stamped on every write by the ModelProxy; NULL for books saved before
+    # these columns existed.
+    version = db.Column(db.BigInteger)
+    updatedAt = db.Column(db.DateTime)
+
+    # Running vote totals, only ever changed by add_votes().
+    likes = db.Column(db.Integer)
+    ratingCount = db.Column(db.Integer)
+    ratingTotal = db.Column(db.Integer)
+
+    # list() pages through books in (title, id) order and seeks past the
+    # last row of the previous page, so it needs both columns in one index.
+    __table_args__ = (
+        db.Index('ix_books_title_id', 'title', 'id'),
+    )
+
     def __repr__(self):
         return "<Book(title='%s', author=%s)" % (self.title, self.author)
 # [END model]
 
+class Tombstone(db.Model):
+    """A book deleted while a migration copies the catalog into this
+    database, so that a copy read before the delete isn't written back."""
+    __tablename__ = 'tombstones'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+
 # [START model]
 class User(db.Model):
     __tablename__ = 'users'
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(255))
+    # Logins look users up by name, which must be unique.
+    name = db.Column(db.String(255), unique=True, index=True)
     pwd = db.Column(db.String(255))
     
     def __repr__(self):
@@ -68,45 +214,134 @@ class User(db.Model):
 # [END model]
 
 
-# [START list]
-def list(limit=10, cursor=None):
-    cursor = int(cursor) if cursor else 0
-    query = (Book.query
-             .order_by(Book.title)
-             .limit(limit)
-             .offset(cursor))
-    books = builtin_list(map(from_sql, query.all()))
-    next_page = cursor + limit if len(books) == limit else None
+def _after(title, id):
+    """Builds the keyset predicate for rows that sort after (title, id).
+
+    NULL titles sort first in MySQL (and SQLite), so a NULL cursor title
+    continues through the remaining NULL rows and then every titled row.
+    """
+    if title is None:
+        return or_(Book.title.isnot(None),
+                   and_(Book.title.is_(None), Book.id > id))
+    return or_(Book.title > title,
+               and_(Book.title == title, Book.id > id))
+
+
+def _books(summary=False, fields=None):
+    """Returns a query for books that loads every column, with summary only
+    the SUMMARY_FIELDS, or with fields only those of them that are columns.
+    The title is always loaded, since page cursors are made from it."""
+    if summary:
+        fields = SUMMARY_FIELDS
+    if fields is not None:
+        return Book.query.options(load_only('title', *[
+            field for field in fields
+            if field != 'title' and field in Book.__table__.columns]))
+    return Book.query
+
+
+def _page(query, limit, cursor):
+    """Reads one page of query in (title, id) order, seeking past cursor, and
+    returns it with the cursor of the next page."""
+    query = query.order_by(Book.title, Book.id)
+    position = decode_cursor(cursor, (OPTIONAL_TEXT, INTEGER))
+    if position:
+        query = query.filter(_after(*position))
+    books = builtin_list(map(from_sql, query.limit(limit).all()))
+    next_page = None
+    if len(books) == limit:
+        last = books[-1]
+        next_page = encode_cursor(last['title'], last['id'])
     return (books, next_page)
+
+
+# [START list]
+def list(limit=10, cursor=None, summary=False, fields=None):
+    """Returns a page of books in title order and the cursor of the next.
+    fields, if given, names the only fields read besides the id."""
+    return _page(_books(summary, fields), limit, cursor)
 # [END list]
 
 
 # [START read]
 def read(id):
-    result = Book.query.get(id)
+    """Returns a book, or None if it doesn't exist. Raises ValueError for an
+    id that isn't an integer."""
+    result = Book.query.get(int(id))
     if not result:
         return None
     return from_sql(result)
 # [END read]
 
 
+def read_many(ids):
+    """Reads several books with one SELECT ... WHERE id IN query.
+
+    Returns the books in the order of ids, with None for any that don't
+    exist. Raises ValueError for an id that isn't an integer.
+    """
+    ids = [int(id) for id in ids]
+    found = {}
+    if ids:
+        for row in Book.query.filter(Book.id.in_(set(ids))):
+            found[row.id] = from_sql(row)
+    return [found.get(id) for id in ids]
+
+
+def read_version(id):
+    """Returns a book's (version, updatedAt), reading only those columns, or
+    None if the book doesn't exist."""
+    row = db.session.query(Book.version, Book.updatedAt).filter_by(
+        id=id).first()
+    return tuple(row) if row else None
+
+
 # [START create]
 def create(data):
     book = Book(**data)
     db.session.add(book)
+    db.session.flush()
+    # Copy the row before the commit expires it, which would otherwise cost
+    # a SELECT to reload.
+    created = from_sql(book)
     db.session.commit()
-    return from_sql(book)
+    return created
 # [END create]
 
+
+def create_many(books):
+    """Creates several books in one transaction and returns them with their
+    new ids.
+
+    MySQL can't report the ids generated by a multi-row INSERT, so SQLAlchemy
+    still sends a row at a time, but everything shares a single flush and
+    commit instead of paying a commit per book.
+    """
+    rows = [Book(**data) for data in books]
+    db.session.add_all(rows)
+    db.session.flush()
+    # Copy the rows before the commit expires them, which would otherwise
+    # cost a SELECT per book to reload.
+    created = builtin_list(map(from_sql, rows))
+    db.session.commit()
+    return created
+
 # [START createUser]
 def createUser(data):
+    """Creates a user, raising NameTaken if the name is in use."""
     user = User(**data)
     db.session.add(user)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        raise NameTaken(data.get('name'))
     return from_sql(user)
 # [END createUser]
 
 def getName(name):
+    """Returns the user called name, or None, with one lookup of the unique
+    index on users.name."""
     user = User.query.filter_by(name = name).first()
     if user is not None:
         return from_sql(user)
@@ -114,37 +349,159 @@ def getName(name):
 
 # [START update]
 def update(data, id):
-    book = Book.query.get(id)
-    for k, v in data.items():
-        setattr(book, k, v)
+    """Sets the given fields of a book with a single UPDATE, without reading
+    it first, and returns the whole book, or None if there is no such book.
+
+    MySQL has no UPDATE ... RETURNING, so the book is read back within the
+    same transaction, before the commit would expire it.
+    """
+    columns = Book.__table__.columns
+    values = dict((k, v) for k, v in data.items()
+                  if k in columns and k != 'id')
+    if not Book.query.filter_by(id=id).update(
+            values, synchronize_session=False):
+        db.session.rollback()
+        return None
+    book = from_sql(Book.query.populate_existing().get(id))
+    db.session.commit()
+    return book
+# [END update]
+
+
+def add_votes(votes, changes=None):
+    """Adds votes, a dict of book id to (likes, ratings, rating total), to
+    the books' running totals and sets the fields in changes on each.
+
+    Every book gets one UPDATE ... SET likes = likes + ? statement, so the
+    database applies each increment atomically without a read, and all of
+    them go as a single executemany in one transaction.
+    """
+    if not votes:
+        return
+    table = Book.__table__
+
+    def increment(column):
+        return func.coalesce(column, 0) + bindparam('add_' + column.name)
+
+    statement = table.update().where(
+        table.c.id == bindparam('book_id')).values(
+            likes=increment(table.c.likes),
+            ratingCount=increment(table.c.ratingCount),
+            ratingTotal=increment(table.c.ratingTotal),
+            **(changes or {}))
+    db.session.execute(statement, [
+        {'book_id': id, 'add_likes': likes, 'add_ratingCount': ratings,
+         'add_ratingTotal': total}
+        for id, (likes, ratings, total) in votes.items()])
+    db.session.commit()
+
+
+def _replacement(data):
+    """Builds a Book that sets every column, so that merging it replaces the
+    stored row rather than keeping the columns data leaves out."""
+    return Book(**dict((column.key, data.get(column.key))
+                       for column in Book.__table__.columns))
+
+
+def put(data, id):
+    """Creates or replaces the book with the given id."""
+    book = db.session.merge(_replacement(dict(data, id=int(id))))
     db.session.commit()
     return from_sql(book)
-# [END update] 
+
+
+def put_many(books):
+    """Creates or replaces several books, each carrying its own id, in one
+    transaction."""
+    rows = [db.session.merge(_replacement(data)) for data in books]
+    db.session.flush()
+    saved = builtin_list(map(from_sql, rows))
+    db.session.commit()
+    return saved
+
+
+def put_many_newer(books):
+    """Creates or replaces several books, each carrying its own id, except
+    those stored with a newer version and those bury() deleted, in one
+    transaction. The stored rows are locked while they are compared.
+    Returns the books written."""
+    books = builtin_list(books)
+    ids = [int(data['id']) for data in books]
+    if not ids:
+        return []
+    stored = dict(db.session.query(Book.id, Book.version)
+                  .filter(Book.id.in_(ids)).with_for_update().all())
+    buried = set(id for id, in db.session.query(Tombstone.id)
+                 .filter(Tombstone.id.in_(ids)))
+    rows = [db.session.merge(_replacement(dict(data, id=id)))
+            for id, data in zip(ids, books)
+            if id not in buried and (
+                id not in stored or supersedes(data.get('version'),
+                                               stored[id]))]
+    db.session.flush()
+    saved = builtin_list(map(from_sql, rows))
+    db.session.commit()
+    return saved
+
+
+def bury(id):
+    """Deletes a book and keeps a tombstone of it, so that put_many_newer()
+    doesn't bring back a copy read before the delete."""
+    db.session.merge(Tombstone(id=int(id)))
+    Book.query.filter_by(id=id).delete()
+    db.session.commit()
+
+
+def clear_tombstones():
+    Tombstone.query.delete()
+    db.session.commit()
 
 
 def delete(id):
     Book.query.filter_by(id=id).delete()
     db.session.commit()
 
-def searchByTitle(title):
-    results = builtin_list(map(from_sql, Book.query.filter(Book.title.contains(title)).all()))
-    return results
 
-def searchByAuthor(author):
-    results = builtin_list(map(from_sql, Book.query.filter(Book.author.contains(author)).all()))
-    return results
+def delete_many(ids):
+    ids = builtin_list(ids)
+    if ids:
+        Book.query.filter(Book.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+def _search(criterion, limit, cursor, summary):
+    """Returns a page of the books matching criterion, with the same limit and
+    cursor contract as list() but never more than MAX_SEARCH_PAGE_SIZE
+    books."""
+    limit = max(1, min(limit, MAX_SEARCH_PAGE_SIZE))
+    return _page(_books(summary).filter(criterion), limit, cursor)
+
+
+def searchByTitle(title, limit=10, cursor=None, summary=False):
+    return _search(Book.title.contains(title), limit, cursor, summary)
+
+
+def searchByAuthor(author, limit=10, cursor=None, summary=False):
+    return _search(Book.author.contains(author), limit, cursor, summary)
 
-def searchByDescription(description):
-    results = builtin_list(map(from_sql, Book.query.filter(Book.description.contains(description)).all()))
-    return results
 
-def searchByRating(rating):
-    results = builtin_list(map(from_sql, Book.query.filter_by(rating = rating).all()))
-    return results
+def searchByDescription(description, limit=10, cursor=None, summary=False):
+    return _search(
+        Book.description.contains(description), limit, cursor, summary)
 
-def searchByYear(year):
-    results = builtin_list(map(from_sql, Book.query.filter(Book.publishedDate.contains(year)).all()))
-    return results
+
+def searchByRating(rating, limit=10, cursor=None, summary=False):
+    return _search(Book.rating == rating, limit, cursor, summary)
+
+
+def searchByYear(year, limit=10, cursor=None, summary=False):
+    return searchByYears(year, year, limit, cursor, summary)
+
+
+def searchByYears(first, last, limit=10, cursor=None, summary=False):
+    """Finds the books published from year first to year last, inclusive,
+    with a range scan of the publishedYear index."""
+    return _search(Book.publishedYear.between(int(first), int(last)),
+                   limit, cursor, summary)
 
 def _create_database():
     """
@@ -156,8 +513,56 @@ def _create_database():
     init_app(app)
     with app.app_context():
         db.create_all()
+        _create_missing_columns()
+        _create_missing_indexes()
     print("All tables created")
 
 
+def _create_missing_columns():
+    """create_all() doesn't alter existing tables, so add any column declared
+    on a model that an existing table does not have yet. Existing rows get
+    NULL in the new column."""
+    inspector = db.inspect(db.engine)
+    quote = db.engine.dialect.identifier_preparer
+    for table in db.metadata.sorted_tables:
+        existing = set(
+            column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                db.engine.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    quote.format_table(table), quote.format_column(column),
+                    column.type.compile(dialect=db.engine.dialect)))
+                print("Added column {}.{}".format(table.name, column.name))
+
+
+def _create_missing_indexes():
+    """create_all() only builds indexes along with new tables, so add any
+    index declared on a model that an existing table does not have yet.
+
+    A unique index is only built once no rows share its values; otherwise
+    DuplicateNames lists them, and no index is created.
+    """
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = set(
+            index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                if index.unique:
+                    _check_unique(index)
+                index.create(bind=db.engine)
+                print("Created index {}".format(index.name))
+
+
+def _check_unique(index):
+    """Raises DuplicateNames if rows share the values of index's columns."""
+    columns = builtin_list(index.columns)
+    duplicates = db.session.query(*columns).group_by(*columns).having(
+        func.count() > 1).all()
+    if duplicates:
+        raise DuplicateNames(
+            row[0] if len(row) == 1 else tuple(row) for row in duplicates)
+
+
 if __name__ == '__main__':
     _create_database()
@@ -12,19 +12,84 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import random
+import threading
+
 from flask import current_app
 from google.cloud import datastore
 
+from .metrics import db_call, TimedClient
+from .model_proxy import supersedes
+from .users import NameTaken
+from .votes import PartialVotes
+
 
 builtin_list = list
 
 
+# Datastore caps the number of keys in a single get_multi call and the number
+# of entities in a single put_multi or delete_multi call.
+MAX_GET_BATCH = 1000
+MAX_WRITE_BATCH = 500
+
+
+# Client methods that make a round trip to Datastore, timed per request.
+CLIENT_RPCS = ('get', 'get_multi', 'put', 'put_multi', 'delete',
+               'delete_multi')
+
+# Votes are counted on this many shard entities per book, children of the
+# book, so that concurrent votes rarely contend for the same entity. Each
+# transaction of add_votes() touches at most MAX_VOTE_TRANSACTION of them.
+# A vote stamps its shard with the version and updatedAt of the vote, so the
+# latest stamp of a book and its shards is the book's version.
+VOTE_SHARDS = 10
+VOTE_FIELDS = ('likes', 'ratingCount', 'ratingTotal')
+MAX_VOTE_TRANSACTION = 25
+
+# The properties list and search pages render, plus the version their ETags
+# are built from.
+SUMMARY_FIELDS = ('title', 'author', 'rating', 'version')
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
 def init_app(app):
-    pass
+    global _client
+
+    # The client itself is created on first use, after gunicorn has forked.
+    with _client_lock:
+        _client = None
 
 
 def get_client():
-    return datastore.Client(current_app.config['PROJECT_ID'])
+    """Returns the process-wide Datastore client, creating it on first use.
+
+    Building a client sets up credentials and a gRPC channel, so one client is
+    shared by every request and thread of a process. A process forked after
+    the client was created gets a new one, since channels don't survive
+    fork().
+    """
+    global _client, _client_pid
+
+    client = _client
+    if client is not None and _client_pid == os.getpid():
+        return client
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = TimedClient(
+                datastore.Client(current_app.config['PROJECT_ID']),
+                CLIENT_RPCS, 'datastore')
+            _client_pid = os.getpid()
+        return _client
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
 
 
 # [START from_datastore]
@@ -48,15 +113,38 @@ def from_datastore(entity):
 # [END from_datastore]
 
 
+def _summarize(entity, fields=SUMMARY_FIELDS):
+    """Trims a book down to its id and fields, SUMMARY_FIELDS by default.
+
+    Datastore projection queries need a composite index over every projected
+    property and skip entities that lack any of them, which would hide books
+    saved without an author or rating. So summaries are cut down here
+    instead, which still spares the templates and the cache the full record.
+    """
+    summary = dict((field, entity.get(field)) for field in fields)
+    summary['id'] = entity['id']
+    return summary
+
+
 # [START list]
-def list(limit=10, cursor=None):
+def list(limit=10, cursor=None, summary=False, fields=None):
+    """Returns a page of books in title order and the cursor of the next.
+    fields, if given, names the only fields returned besides the id; their
+    vote counts aren't read."""
     ds = get_client()
 
     query = ds.query(kind='Book', order=['title'])
     query_iterator = query.fetch(limit=limit, start_cursor=cursor)
-    page = next(query_iterator.pages)
+    with db_call('datastore.run_query'):
+        page = next(query_iterator.pages)
 
     entities = builtin_list(map(from_datastore, page))
+    if summary:
+        fields = SUMMARY_FIELDS
+    if fields is not None:
+        entities = [_summarize(entity, fields) for entity in entities]
+    else:
+        _with_votes(ds, entities)
     next_cursor = (
         query_iterator.next_page_token.decode('utf-8')
         if query_iterator.next_page_token else None)
@@ -64,15 +152,212 @@ def list(limit=10, cursor=None):
     return entities, next_cursor
 # [END list]
 
+def _tombstone_key(ds, key):
+    # A child of the book, so that it shares the book's entity group.
+    return ds.key('Tombstone', 1, parent=key)
+
+
+def _shard_keys(ds, key):
+    return [ds.key('VoteShard', n, parent=key)
+            for n in range(1, VOTE_SHARDS + 1)]
+
+
+def _add_shards(book, shards):
+    """Adds up a book entity's vote shards into its vote totals, and takes
+    the latest version and updatedAt of the book and the shards."""
+    for field in VOTE_FIELDS:
+        book[field] = sum(shard.get(field, 0) for shard in shards)
+    for field in ('version', 'updatedAt'):
+        stamps = [entity[field] for entity in [book] + shards
+                  if entity.get(field) is not None]
+        if stamps:
+            book[field] = max(stamps)
+
+
+def _with_votes(ds, entities):
+    """Adds up the vote shards of book entities, fetched with one get_multi
+    call per MAX_GET_BATCH keys."""
+    shards = dict((entity.key, []) for entity in entities)
+    keys = [key for parent in shards for key in _shard_keys(ds, parent)]
+    for batch in _chunks(keys, MAX_GET_BATCH):
+        for shard in ds.get_multi(batch):
+            shards[shard.key.parent].append(shard)
+    for entity in entities:
+        _add_shards(entity, shards[entity.key])
+
+
 def read(id):
+    """Reads a book together with its vote shards in one get_multi call, and
+    adds up the shards into its vote totals. Raises ValueError for an id
+    that isn't an integer."""
     ds = get_client()
-    key = ds.key('Book', int(id))
-    results = ds.get(key)
-    return from_datastore(results)
+    book, shards = _get_with_shards(ds, ds.key('Book', int(id)))
+    if book is None:
+        return None
+    _add_shards(book, shards)
+    return from_datastore(book)
+
+
+def _get_with_shards(ds, key):
+    """Returns the book entity of key, or None, and its vote shards, read
+    with one get_multi call."""
+    book, shards = None, []
+    for entity in ds.get_multi([key] + _shard_keys(ds, key)):
+        if entity.key == key:
+            book = entity
+        else:
+            shards.append(entity)
+    return book, shards
+
+
+def read_version(id):
+    """Returns a book's (version, updatedAt), or None if the book doesn't
+    exist.
+
+    A lookup by key can't be projected, so this still fetches the entity;
+    the saving for conditional requests is the render and the response.
+    Votes stamp their shards rather than the book, so this is the version
+    read() gives the book, as a cached copy has it.
+    """
+    book = read(id)
+    if book is None:
+        return None
+    return book.get('version'), book.get('updatedAt')
+
+
+def _split_votes(entity):
+    """Takes any vote totals out of a book entity about to be written, so
+    that the book itself never holds them and a later put, which replaces
+    the entity, can't lose them. Returns the totals."""
+    return dict((field, entity.pop(field)) for field in VOTE_FIELDS
+                if field in entity)
+
+
+def _store_votes(ds, books):
+    """Makes the totals given for each (key, totals) pair the book's only vote
+    shard, deleting the others so that no vote is counted twice."""
+    shards, stale = [], []
+    for key, totals in books:
+        keys = _shard_keys(ds, key)
+        shard = datastore.Entity(key=keys[0])
+        for field in VOTE_FIELDS:
+            shard[field] = totals.get(field) or 0
+        shards.append(shard)
+        stale.extend(keys[1:])
+    for batch in _chunks(shards, MAX_WRITE_BATCH):
+        ds.put_multi(batch)
+    for batch in _chunks(stale, MAX_WRITE_BATCH):
+        ds.delete_multi(batch)
+
+
+def _stamp(changes):
+    return dict((field, changes[field]) for field in ('version', 'updatedAt')
+                if changes and field in changes)
+
+
+def _versions(ds, keys):
+    """Returns the version of each existing book of keys, as read() has it,
+    reading the books and all their shards. Called within a transaction,
+    so the versions hold until it commits."""
+    lookup = builtin_list(keys)
+    for key in keys:
+        lookup.extend(_shard_keys(ds, key))
+    books, shards = {}, dict((key, []) for key in keys)
+    for entity in ds.get_multi(lookup):
+        if entity.key.kind == 'Book':
+            books[entity.key] = entity
+        else:
+            shards[entity.key.parent].append(entity)
+    for key, book in books.items():
+        _add_shards(book, shards[key])
+    return dict((key, book.get('version')) for key, book in books.items())
+
+
+def add_votes(votes, changes=None):
+    """Adds votes, a dict of book id to (likes, ratings, rating total), to a
+    randomly chosen vote shard of each book.
+
+    Each shard is read and written back in a transaction, so no increment is
+    lost. Books' own entities aren't written: the version and updatedAt of
+    changes go on the shard instead, and read() takes the latest.
+
+    Every MAX_VOTE_TRANSACTION books commit in a transaction of their own.
+    If one fails after others have committed, PartialVotes names the books
+    that were written.
+    """
+    ds = get_client()
+    items = builtin_list(votes.items())
+    applied = []
+    for batch in _chunks(items, MAX_VOTE_TRANSACTION):
+        keys = [random.choice(_shard_keys(ds, ds.key('Book', int(id))))
+                for id, _ in batch]
+        try:
+            with ds.transaction():
+                found = dict((entity.key, entity)
+                             for entity in ds.get_multi(keys))
+                shards = []
+                for key, (_, counts) in zip(keys, batch):
+                    shard = found.get(key) or datastore.Entity(key=key)
+                    for field, count in zip(VOTE_FIELDS, counts):
+                        shard[field] = shard.get(field, 0) + count
+                    shard.update(_stamp(changes))
+                    shards.append(shard)
+                ds.put_multi(shards)
+        except Exception as e:
+            if applied:
+                raise PartialVotes(applied, e)
+            raise
+        applied.extend(id for id, _ in batch)
+
+
+def read_many(ids):
+    """Reads several books with one get_multi call per MAX_GET_BATCH ids,
+    plus those for their vote shards.
+
+    Returns the books in the order of ids, with None for any that don't
+    exist. Raises ValueError for an id that isn't an integer.
+    """
+    ds = get_client()
+    ids = builtin_list(ids)
+    found = {}
+    for batch in _chunks(ids, MAX_GET_BATCH):
+        keys = [ds.key('Book', int(id)) for id in batch]
+        entities = ds.get_multi(keys)
+        _with_votes(ds, entities)
+        for entity in entities:
+            book = from_datastore(entity)
+            found[book['id']] = book
+    return [found.get(int(id)) for id in ids]
 
 
 # [START update]
-def update(data, id=None):
+def update(data, id):
+    """Sets the given fields of a book and returns the whole book, or None
+    if there is no such book. The book is read and written back in one
+    transaction, so an update neither creates a book nor undoes a write
+    that came between."""
+    ds = get_client()
+    key = ds.key('Book', int(id))
+    with ds.transaction():
+        book, shards = _get_with_shards(ds, key)
+        if book is None:
+            return None
+        book.update(data)
+        book.pop('id', None)
+        book.exclude_from_indexes.add('description')
+        totals = _split_votes(book)
+        ds.put(book)
+        if totals:
+            _store_votes(ds, [(key, totals)])
+    if totals:
+        return dict(from_datastore(book), **totals)
+    _add_shards(book, shards)
+    return from_datastore(book)
+
+
+def put(data, id=None):
+    """Stores data as the whole book of id, or as a new book without one,
+    replacing any book stored there."""
     ds = get_client()
     if id:
         key = ds.key('Book', int(id))
@@ -84,14 +369,148 @@ def update(data, id=None):
         exclude_from_indexes=['description'])
 
     entity.update(data)
+    totals = _split_votes(entity)
     ds.put(entity)
-    return from_datastore(entity)
+    if totals:
+        _store_votes(ds, [(entity.key, totals)])
+    return dict(from_datastore(entity), **totals)
 
-create = update
+create = put
 # [END update]
 
 
+def _put_many(books, key):
+    ds = get_client()
+    saved = []
+    for batch in _chunks(builtin_list(books), MAX_WRITE_BATCH):
+        entities, totals = [], []
+        for data in batch:
+            entity = datastore.Entity(
+                key=key(ds, data),
+                exclude_from_indexes=['description'])
+            entity.update(data)
+            entity.pop('id', None)
+            entities.append(entity)
+            totals.append(_split_votes(entity))
+        ds.put_multi(entities)
+        _store_votes(ds, [(entity.key, counts)
+                          for entity, counts in zip(entities, totals)
+                          if counts])
+        saved.extend(dict(from_datastore(entity), **counts)
+                     for entity, counts in zip(entities, totals))
+    return saved
+
+
+def create_many(books):
+    """Creates several books with one put_multi call per MAX_WRITE_BATCH
+    books, and returns them with their new ids."""
+    return _put_many(books, lambda ds, data: ds.key('Book'))
+
+
+def put_many(books):
+    """Creates or replaces several books, each carrying its own id, with one
+    put_multi call per MAX_WRITE_BATCH books."""
+    return _put_many(books, lambda ds, data: ds.key('Book', int(data['id'])))
+
+
+def put_many_newer(books):
+    """Creates or replaces several books, each carrying its own id, except
+    those stored with a newer version and those bury() deleted. Every
+    MAX_VOTE_TRANSACTION books are compared and written in a transaction.
+    Returns the books written."""
+    ds = get_client()
+    saved = []
+    for batch in _chunks(builtin_list(books), MAX_VOTE_TRANSACTION):
+        with ds.transaction():
+            keys = [ds.key('Book', int(data['id'])) for data in batch]
+            versions = _versions(ds, keys)
+            buried = set(entity.key.parent for entity in ds.get_multi(
+                [_tombstone_key(ds, key) for key in keys]))
+            entities, totals = [], []
+            for key, data in zip(keys, batch):
+                if key in buried or (key in versions and not supersedes(
+                        data.get('version'), versions[key])):
+                    continue
+                entity = datastore.Entity(
+                    key=key, exclude_from_indexes=['description'])
+                entity.update(data)
+                entity.pop('id', None)
+                entities.append(entity)
+                totals.append(_split_votes(entity))
+            if entities:
+                ds.put_multi(entities)
+                _store_votes(ds, [(entity.key, counts)
+                                  for entity, counts in zip(entities, totals)
+                                  if counts])
+        saved.extend(dict(from_datastore(entity), **counts)
+                     for entity, counts in zip(entities, totals))
+    return saved
+
+
+def bury(id):
+    """Deletes a book and keeps a tombstone of it, so that put_many_newer()
+    doesn't bring back a copy read before the delete."""
+    ds = get_client()
+    key = ds.key('Book', int(id))
+    with ds.transaction():
+        ds.put(datastore.Entity(key=_tombstone_key(ds, key)))
+        ds.delete_multi([key] + _shard_keys(ds, key))
+
+
+def clear_tombstones():
+    ds = get_client()
+    query = ds.query(kind='Tombstone')
+    query.keys_only()
+    keys = [entity.key for entity in query.fetch()]
+    for batch in _chunks(keys, MAX_WRITE_BATCH):
+        ds.delete_multi(batch)
+
+
 def delete(id):
     ds = get_client()
     key = ds.key('Book', int(id))
-    ds.delete(key)
+    ds.delete_multi([key] + _shard_keys(ds, key))
+
+
+def delete_many(ids):
+    """Deletes several books and their vote shards with one delete_multi
+    call per MAX_WRITE_BATCH keys."""
+    ds = get_client()
+    keys = []
+    for id in ids:
+        key = ds.key('Book', int(id))
+        keys.append(key)
+        keys.extend(_shard_keys(ds, key))
+    for batch in _chunks(keys, MAX_WRITE_BATCH):
+        ds.delete_multi(batch)
+
+
+def createUser(data):
+    """Creates a user keyed by name, raising NameTaken if the name is in use.
+
+    The key makes names unique without an index, and the transaction makes
+    the check and the write one step.
+    """
+    ds = get_client()
+    key = ds.key('User', data['name'])
+    with ds.transaction():
+        if ds.get(key) is not None:
+            raise NameTaken(data['name'])
+        entity = datastore.Entity(key=key)
+        entity.update(data)
+        ds.put(entity)
+    return _user(entity)
+
+
+def getName(name):
+    """Returns the user called name, or None, with one lookup by key."""
+    ds = get_client()
+    return _user(ds.get(ds.key('User', name)))
+
+
+def _user(entity):
+    if entity is None:
+        return None
+    user = dict(entity)
+    user['id'] = entity.key.name
+    return user
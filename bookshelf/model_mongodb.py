@@ -12,19 +12,71 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import logging
+import re
+
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
 from flask_pymongo import PyMongo
+import pymongo
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, \
+    PyMongoError
+
+from .pagination import decode_cursor, encode_cursor, OPTIONAL_TEXT, TEXT
+from .users import DuplicateNames, NameTaken
+from .votes import PartialVotes
 
 
 builtin_list = list
 
 
+logger = logging.getLogger(__name__)
+
+
+# One client per process, shared by every request thread or greenlet:
+# MongoClient is thread-safe and keeps its own connection pool.
 mongo = None
 
 
+# Sort order of list(); also the key of the index created by init_app().
+LIST_ORDER = [('title', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]
+
+# The fields list and search pages render, plus the version their ETags are
+# built from. Summary reads project onto these (and _id), leaving the long
+# description and the rest on the server.
+SUMMARY_FIELDS = ('title', 'author', 'rating', 'version')
+SUMMARY_PROJECTION = dict((field, True) for field in SUMMARY_FIELDS)
+
+# The fields of a user, as in the cloudsql users table. Nothing else a form
+# posts is stored, and lookups read only these.
+USER_FIELDS = ('name', 'pwd')
+USER_PROJECTION = dict((field, True) for field in USER_FIELDS)
+
+# The server's error code for a duplicate key.
+DUPLICATE_KEY = 11000
+
+# The most books a searchBy* function returns in one page.
+MAX_SEARCH_PAGE_SIZE = 100
+
+# The indexes of the books collection, by name. Equality searches are
+# followed by LIST_ORDER, so that their results come out of the index already
+# in page order.
+BOOK_INDEXES = {
+    'title_id': LIST_ORDER,
+    'author_title_id': [('author', pymongo.ASCENDING)] + LIST_ORDER,
+    'rating_title_id': [('rating', pymongo.ASCENDING)] + LIST_ORDER,
+    'publishedYear': [('publishedYear', pymongo.ASCENDING)],
+}
+
+
 def _id(id):
+    """Returns id as an ObjectId, raising ValueError if it isn't one."""
     if not isinstance(id, ObjectId):
-        return ObjectId(id)
+        try:
+            return ObjectId(id)
+        except (InvalidId, TypeError):
+            raise ValueError("Invalid id: {!r}".format(id))
     return id
 
 
@@ -45,42 +97,399 @@ def from_mongo(data):
 def init_app(app):
     global mongo
 
+    # PyMongo(app) already connects; calling init_app() on it again would
+    # open a second client, with its own pool and monitor threads.
     mongo = PyMongo(app)
-    mongo.init_app(app)
 
+    # list() sorts and seeks on (title, _id); without that index every page
+    # is an in-memory sort of the whole collection. create_index() does
+    # nothing for an index that already exists.
+    for name, keys in BOOK_INDEXES.items():
+        mongo.db.books.create_index(keys, name=name)
+    _create_user_index(mongo.db.users)
+
+    if app.config.get('MONGO_EXPLAIN_CHECK', True):
+        check_query_plans(mongo.db)
+
+
+def _create_user_index(users):
+    """Creates the unique index on user names, raising DuplicateNames if
+    existing users share names, in which case no index is created."""
+    if 'name' in users.index_information():
+        return
+    duplicates = users.aggregate([
+        {'$group': {'_id': '$name', 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+    ])
+    names = [duplicate['_id'] for duplicate in duplicates]
+    if names:
+        raise DuplicateNames(names)
+    users.create_index('name', name='name', unique=True)
+
+
+def _hot_queries(db):
+    """The queries behind every page view and login, as unexecuted cursors,
+    with placeholder values."""
+    return [
+        ('list', db.books.find({}).sort(LIST_ORDER).limit(10)),
+        ('list after cursor',
+         db.books.find(_after(u'', ObjectId())).sort(LIST_ORDER).limit(10)),
+        ('searchByAuthor', db.books.find(
+            {'author': _contains(u'a')}).sort(LIST_ORDER).limit(10)),
+        ('searchByRating', db.books.find(
+            {'rating': {'$in': [5, u'5']}}).sort(LIST_ORDER).limit(10)),
+        ('searchByYears', db.books.find(
+            {'publishedYear': {'$gte': 2000, '$lte': 2010}}
+        ).sort(LIST_ORDER).limit(10)),
+        ('getName', db.users.find({'name': u''}).limit(1)),
+    ]
+
+
+def _plan_stages(plan):
+    """Yields the stage names anywhere in an explain() document."""
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            for stage in _plan_stages(value):
+                yield stage
+    elif isinstance(plan, builtin_list):
+        for value in plan:
+            for stage in _plan_stages(value):
+                yield stage
+
+
+def check_query_plans(db):
+    """Explains each hot query and logs a warning for any that the server
+    would answer by scanning the whole collection, such as when an index is
+    missing or was dropped. Returns the names of those queries."""
+    scans = []
+    for name, cursor in _hot_queries(db):
+        explain = getattr(cursor, 'explain', None)
+        if explain is None:
+            # Stand-ins such as mongomock have no query planner to ask.
+            logger.info("Skipped the query plan check: %s cursors can't "
+                        "explain()", type(cursor).__name__)
+            return scans
+        try:
+            plan = explain().get('queryPlanner', {})
+        except (PyMongoError, NotImplementedError) as e:
+            logger.info("Couldn't explain the %s query: %s", name, e)
+            continue
+        if 'COLLSCAN' in _plan_stages(plan.get('winningPlan')):
+            logger.warning(
+                "The %s query scans the whole %s collection; are its "
+                "indexes missing?", name, plan.get('namespace', ''))
+            scans.append(name)
+    return scans
 
-# [START list]
-def list(limit=10, cursor=None):
-    cursor = int(cursor) if cursor else 0
 
-    results = mongo.db.books.find(skip=cursor, limit=10).sort('title')
+def _after(title, id):
+    """Builds the keyset filter for documents that sort after (title, id).
+
+    Missing and null titles sort before every string, so a null cursor title
+    continues through the remaining untitled documents first.
+    """
+    if title is None:
+        return {'$or': [
+            {'title': {'$ne': None}},
+            {'title': None, '_id': {'$gt': _id(id)}}]}
+    return {'$or': [
+        {'title': {'$gt': title}},
+        {'title': title, '_id': {'$gt': _id(id)}}]}
+
+
+def _page(query, limit, cursor, summary, fields=None):
+    """Reads one page of the books matching query in (title, _id) order,
+    seeking past cursor, and returns it with the cursor of the next page."""
+    position = decode_cursor(cursor, (OPTIONAL_TEXT, TEXT))
+    if position:
+        # A token's id is an ObjectId unless someone has tampered with it.
+        title, id = position
+        try:
+            position = title, _id(id)
+        except ValueError:
+            raise ValueError("Invalid page token: {!r}".format(cursor))
+        query = {'$and': [query, _after(*position)]} if query else \
+            _after(*position)
+    projection = SUMMARY_PROJECTION if summary else None
+    if fields is not None:
+        # The title is always read, since page cursors are made from it.
+        projection = dict(
+            (field, True) for field in ('title',) + tuple(fields))
+
+    results = (mongo.db.books.find(query, projection, limit=limit)
+               .sort(LIST_ORDER))
     books = builtin_list(map(from_mongo, results))
 
-    next_page = cursor + limit if len(books) == limit else None
+    next_page = None
+    if len(books) == limit:
+        last = books[-1]
+        next_page = encode_cursor(last.get('title'), last['id'])
     return (books, next_page)
+
+
+# [START list]
+def list(limit=10, cursor=None, summary=False, fields=None):
+    """Returns a page of books in title order and the cursor of the next.
+    fields, if given, names the only fields read besides the id."""
+    return _page({}, limit, cursor, summary, fields)
 # [END list]
 
 
 # [START read]
 def read(id):
+    """Returns a book, or None if it doesn't exist. Raises ValueError for an
+    id that isn't an ObjectId."""
     result = mongo.db.books.find_one({'_id': _id(id)})
     return from_mongo(result)
 # [END read]
 
 
+def read_many(ids):
+    """Reads several books with one $in query.
+
+    Returns the books in the order of ids, with None for any that don't
+    exist. Raises ValueError for an id that isn't an ObjectId.
+    """
+    ids = [_id(id) for id in ids]
+    found = {}
+    if ids:
+        for document in mongo.db.books.find({'_id': {'$in': ids}}):
+            found[document['_id']] = from_mongo(document)
+    return [found.get(id) for id in ids]
+
+
+def read_version(id):
+    """Returns a book's (version, updatedAt), fetching only those fields, or
+    None if the book doesn't exist."""
+    result = mongo.db.books.find_one(
+        {'_id': _id(id)}, {'version': True, 'updatedAt': True})
+    if result is None:
+        return None
+    return result.get('version'), result.get('updatedAt')
+
+
 # [START create]
 def create(data):
-    result = mongo.db.books.insert_one(data)
-    return read(result.inserted_id)
+    # insert_one sets the new _id on the document, which is then the book as
+    # stored, so there is nothing to read back.
+    document = dict(data)
+    mongo.db.books.insert_one(document)
+    return from_mongo(document)
 # [END create]
 
 
+def create_many(books):
+    """Creates several books with a single insert_many and returns them with
+    their new ids."""
+    books = builtin_list(books)
+    if not books:
+        return []
+    mongo.db.books.insert_many(books)
+    return builtin_list(map(from_mongo, books))
+
+
 # [START update]
 def update(data, id):
-    mongo.db.books.replace_one({'_id': _id(id)}, data)
-    return read(id)
+    """Sets the given fields of a book and returns the whole updated book, or
+    None if there is no such book, in a single round trip."""
+    fields = dict(data)
+    fields.pop('id', None)
+    fields.pop('_id', None)
+    result = mongo.db.books.find_one_and_update(
+        {'_id': _id(id)}, {'$set': fields},
+        return_document=ReturnDocument.AFTER)
+    return from_mongo(result)
 # [END update]
 
 
+def add_votes(votes, changes=None):
+    """Adds votes, a dict of book id to (likes, ratings, rating total), to
+    the books' running totals with $inc, which the server applies
+    atomically, and sets the fields in changes on each. All books go in a
+    single unordered bulk_write; if some of its updates fail, PartialVotes
+    names the books whose updates were applied."""
+    if not votes:
+        return
+    ids, requests = [], []
+    for id, (likes, ratings, total) in votes.items():
+        update = {'$inc': {'likes': likes, 'ratingCount': ratings,
+                           'ratingTotal': total}}
+        if changes:
+            update['$set'] = changes
+        ids.append(id)
+        requests.append(UpdateOne({'_id': _id(id)}, update))
+    try:
+        mongo.db.books.bulk_write(requests, ordered=False)
+    except BulkWriteError as e:
+        # Unordered, every update without a write error was applied.
+        failed = set(error['index']
+                     for error in e.details.get('writeErrors', ()))
+        raise PartialVotes(
+            [id for index, id in enumerate(ids) if index not in failed], e)
+
+
+def _document(data, id):
+    document = dict(data, _id=_id(id))
+    document.pop('id', None)
+    return document
+
+
+def put(data, id):
+    """Creates or replaces the book with the given id."""
+    document = _document(data, id)
+    mongo.db.books.replace_one({'_id': document['_id']}, document, upsert=True)
+    return from_mongo(document)
+
+
+def put_many(books):
+    """Creates or replaces several books, each carrying its own id, with a
+    single bulk_write."""
+    documents = [_document(data, data['id']) for data in books]
+    if documents:
+        mongo.db.books.bulk_write(
+            [ReplaceOne({'_id': doc['_id']}, doc, upsert=True)
+             for doc in documents],
+            ordered=False)
+    return builtin_list(map(from_mongo, documents))
+
+
+def _superseded_by(version):
+    """Matches the books a copy stamped with version may replace, as
+    model_proxy.supersedes() decides."""
+    if version is None:
+        return {'version': None}
+    return {'$or': [{'version': None}, {'version': {'$lte': version}}]}
+
+
+def _buried(ids):
+    return set(document['_id'] for document in mongo.db.tombstones.find(
+        {'_id': {'$in': builtin_list(ids)}}, {'_id': True}))
+
+
+def put_many_newer(books):
+    """Creates or replaces several books, each carrying its own id, except
+    those stored with a newer version and those bury() deleted. Returns the
+    books written.
+
+    Each replacement is conditional on the stored version, so a copy read
+    before a concurrent write can't overwrite it; the upsert of such a book
+    fails as a duplicate _id and is skipped.
+    """
+    documents = [_document(data, data['id']) for data in books]
+    buried = _buried(doc['_id'] for doc in documents)
+    documents = [doc for doc in documents if doc['_id'] not in buried]
+    if not documents:
+        return []
+    written = set(doc['_id'] for doc in documents)
+    try:
+        mongo.db.books.bulk_write(
+            [ReplaceOne(dict(_superseded_by(doc.get('version')),
+                             _id=doc['_id']), doc, upsert=True)
+             for doc in documents],
+            ordered=False)
+    except BulkWriteError as e:
+        errors = e.details.get('writeErrors', ())
+        if any(error['code'] != DUPLICATE_KEY for error in errors):
+            raise
+        for error in errors:
+            written.discard(documents[error['index']]['_id'])
+    # bury() stores the tombstone before it deletes, so a book deleted while
+    # this ran either was skipped above or has its tombstone by now.
+    late = _buried(written)
+    if late:
+        mongo.db.books.delete_many({'_id': {'$in': builtin_list(late)}})
+    return [from_mongo(doc) for doc in documents
+            if doc['_id'] in written and doc['_id'] not in late]
+
+
+def bury(id):
+    """Deletes a book and keeps a tombstone of it, so that put_many_newer()
+    doesn't bring back a copy read before the delete."""
+    mongo.db.tombstones.replace_one(
+        {'_id': _id(id)}, {'_id': _id(id)}, upsert=True)
+    delete(id)
+
+
+def clear_tombstones():
+    mongo.db.tombstones.delete_many({})
+
+
 def delete(id):
     mongo.db.books.delete_one({'_id': _id(id)})
+
+
+def delete_many(ids):
+    ids = [_id(id) for id in ids]
+    if ids:
+        mongo.db.books.delete_many({'_id': {'$in': ids}})
+
+
+def createUser(data):
+    """Creates a user from the USER_FIELDS of data, raising NameTaken if the
+    name is in use."""
+    document = dict((field, data.get(field)) for field in USER_FIELDS)
+    try:
+        mongo.db.users.insert_one(document)
+    except DuplicateKeyError:
+        raise NameTaken(data.get('name'))
+    return from_mongo(document)
+
+
+def getName(name):
+    """Returns the user called name, or None, with one lookup of the unique
+    index on name."""
+    return from_mongo(
+        mongo.db.users.find_one({'name': name}, USER_PROJECTION))
+
+
+def _search(query, limit, cursor, summary):
+    """Returns a page of the books matching query, with the same limit and
+    cursor contract as list() but never more than MAX_SEARCH_PAGE_SIZE
+    books."""
+    limit = max(1, min(limit, MAX_SEARCH_PAGE_SIZE))
+    return _page(query, limit, cursor, summary)
+
+
+def _contains(text):
+    """Matches text anywhere in a field, ignoring case, like the LIKE of
+    cloudsql. No index can seek to such a match: at best the server scans an
+    index's keys rather than the documents."""
+    return {'$regex': re.escape(u'{}'.format(text)), '$options': 'i'}
+
+
+def searchByTitle(title, limit=10, cursor=None, summary=False):
+    return _search({'title': _contains(title)}, limit, cursor, summary)
+
+
+def searchByAuthor(author, limit=10, cursor=None, summary=False):
+    return _search({'author': _contains(author)}, limit, cursor, summary)
+
+
+def searchByDescription(description, limit=10, cursor=None, summary=False):
+    """Descriptions aren't indexed, so this reads every document, in page
+    order, until it has a page of matches."""
+    return _search(
+        {'description': _contains(description)}, limit, cursor, summary)
+
+
+def searchByRating(rating, limit=10, cursor=None, summary=False):
+    """Ratings posted from the form are stored as strings, so both forms
+    of the number match. The rating_title_id index yields them in page
+    order."""
+    rating = int(rating)
+    return _search({'rating': {'$in': [rating, u'{}'.format(rating)]}},
+                   limit, cursor, summary)
+
+
+def searchByYear(year, limit=10, cursor=None, summary=False):
+    return searchByYears(year, year, limit, cursor, summary)
+
+
+def searchByYears(first, last, limit=10, cursor=None, summary=False):
+    """Finds the books published from year first to year last, inclusive,
+    with a range scan of the publishedYear index."""
+    return _search(
+        {'publishedYear': {'$gte': int(first), '$lte': int(last)}},
+        limit, cursor, summary)
@@ -0,0 +1,146 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import time
+
+from .dates import with_published
+from .votes import PartialVotes
+
+
+def stamp(data):
+    """Returns a copy of data with a new version and updatedAt.
+
+    The version is the write time in microseconds, so it changes with every
+    write without reading the old one first. updatedAt keeps whole seconds,
+    which is all an HTTP date or a MySQL DATETIME holds.
+    """
+    now = time.time()
+    return dict(data, version=int(now * 1000000),
+                updatedAt=datetime.datetime.utcfromtimestamp(int(now)))
+
+
+def supersedes(version, stored):
+    """Returns whether a copy of a book stamped with version may replace a
+    stored copy stamped with stored. None stands for a copy written before
+    books were stamped, which any stamped copy replaces."""
+    if stored is None:
+        return True
+    return version is not None and version >= stored
+
+
+def _prepare(data):
+    return stamp(with_published(data))
+
+
+class ModelProxy(object):
+    """Wraps one of the model_* backend modules.
+
+    Every attribute is looked up on the backend, so the proxy can be used
+    anywhere the module was. Book writes additionally notify the registered
+    listeners, which lets in-process structures such as the search index stay
+    in step with the database whichever backend is configured.
+
+    A listener is any object with two methods:
+
+        book_saved(book)    called with the record returned by create/update
+        book_deleted(id)    called with the id passed to delete
+
+    Listeners may also have book_voted(id, counts), called with the
+    (likes, ratings, rating total) add_votes added to each book.
+
+    Every book written through the proxy is stamped with a new version and
+    updatedAt, which the views use as ETag and Last-Modified, and gets the
+    publishedYear and publishedOn parsed from its publishedDate.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.listeners = []
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def create(self, data):
+        book = self.backend.create(_prepare(data))
+        self._saved(book)
+        return book
+
+    def update(self, data, id):
+        book = self.backend.update(_prepare(data), id)
+        self._saved(book)
+        return book
+
+    def put(self, data, id):
+        book = self.backend.put(_prepare(data), id)
+        self._saved(book)
+        return book
+
+    def create_many(self, books):
+        created = self.backend.create_many(
+            [_prepare(data) for data in books])
+        for book in created:
+            self._saved(book)
+        return created
+
+    def put_many(self, books):
+        saved = self.backend.put_many([_prepare(data) for data in books])
+        for book in saved:
+            self._saved(book)
+        return saved
+
+    def delete(self, id):
+        self.backend.delete(id)
+        self._deleted(id)
+
+    def delete_many(self, ids):
+        ids = list(ids)
+        self.backend.delete_many(ids)
+        for id in ids:
+            self._deleted(id)
+
+    def add_votes(self, votes):
+        """Adds votes, a dict of book id to (likes, ratings, rating total), to
+        the books' running totals, stamping each with a new version.
+        Listeners hear of the books whose votes were written even when
+        others failed with PartialVotes."""
+        if not votes:
+            return
+        try:
+            self.backend.add_votes(votes, stamp({}))
+        except PartialVotes as e:
+            self._voted(dict((id, votes[id]) for id in e.applied))
+            raise
+        self._voted(votes)
+
+    def _voted(self, votes):
+        for listener in self.listeners:
+            voted = getattr(listener, 'book_voted', None)
+            if voted is None:
+                continue
+            for id, counts in votes.items():
+                voted(id, counts)
+
+    def _saved(self, book):
+        if book is None:
+            return
+        for listener in self.listeners:
+            listener.book_saved(book)
+
+    def _deleted(self, id):
+        for listener in self.listeners:
+            listener.book_deleted(id)
@@ -0,0 +1,68 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Opaque keyset cursors shared by the paged reads of the models and the search
+index.
+
+A cursor records the sort key of the last row on a page, such as (title, id),
+so the next page can seek straight past it instead of skipping over every
+earlier row with OFFSET.
+"""
+
+import base64
+import json
+
+
+# The types a value of a key may have, for decode_cursor(): either a type or
+# a tuple of types, as for isinstance().
+TEXT = str
+OPTIONAL_TEXT = (str, type(None))
+INTEGER = int
+NUMBER = (int, float)
+
+
+def encode_cursor(*key):
+    """Packs the sort key of the last row into a URL-safe token."""
+    raw = json.dumps(key, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_cursor(token, types):
+    """Unpacks a token made by encode_cursor into a tuple with a value of each
+    of types, such as (OPTIONAL_TEXT, INTEGER) for (title, id).
+
+    Returns None for an empty token. Raises ValueError for anything that was
+    not produced by encode_cursor with a key of those types.
+    """
+    if not token:
+        return None
+    if isinstance(token, bytes):
+        token = token.decode('ascii')
+    try:
+        key = json.loads(
+            base64.urlsafe_b64decode(str(token)).decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError):
+        key = None
+    if not (isinstance(key, list) and len(key) == len(types) and
+            all(_is_a(value, kind) for value, kind in zip(key, types))):
+        raise ValueError("Invalid page token: {!r}".format(token))
+    return tuple(key)
+
+
+def _is_a(value, kind):
+    # JSON true and false decode to bools, which are ints to isinstance().
+    if isinstance(value, bool):
+        return False
+    return isinstance(value, kind)
@@ -0,0 +1,510 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+In-process full-text search over the book catalog.
+
+The index maps each (field, term) pair to a posting list of book ids, so a
+query only touches the books that contain its terms instead of scanning the
+whole table with LIKE '%q%'. It works the same for every backend: it is
+filled from the model's list() on first use and kept current through the
+write notifications of bookshelf.model_proxy.ModelProxy.
+
+Each process keeps its own copy. Writes served by another gunicorn worker
+reach this one when the index is next rebuilt, at most SEARCH_INDEX_MAX_AGE
+seconds later.
+
+Builds run on a thread of their own, reading only the fields the index
+needs, and queries are answered from the previous copy meanwhile. With
+INDEX_WARM the first build starts as the app is created, so it is usually
+done before the first query.
+"""
+
+import heapq
+import logging
+import math
+import re
+import threading
+import time
+
+from flask import current_app
+
+from .dates import parse_published
+from .pagination import decode_cursor, encode_cursor, NUMBER, TEXT
+
+
+logger = logging.getLogger(__name__)
+
+# Relative weight of a term match in each searchable field.
+FIELD_WEIGHTS = {
+    'title': 3.0,
+    'author': 2.0,
+    'description': 1.0,
+    'year': 1.0,
+    'rating': 1.0,
+}
+
+# The fields copied into each search result; enough to render search.html
+# without reading the book back from the database.
+SUMMARY_FIELDS = ('title', 'author', 'rating', 'publishedDate')
+
+STOP_WORDS = frozenset("""
+    a an and are as at be but by for from has in is it its of on or that the
+    to was were will with
+""".split())
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# The most results search() returns in one page, whatever limit is asked for.
+MAX_PAGE_SIZE = 100
+
+# The filters query() accepts, besides the text.
+FILTERS = ('author', 'min_rating', 'max_rating', 'min_year', 'max_year')
+
+# How many of the most frequent authors the author facet lists.
+TOP_AUTHORS = 10
+
+# Page size used when reading the catalog to build the index.
+_BUILD_PAGE_SIZE = 500
+
+
+def tokenize(text):
+    """Splits text into lower-cased terms, dropping stop words."""
+    if not text:
+        return []
+    return [term for term in _TOKEN_RE.findall(u'{}'.format(text).lower())
+            if term not in STOP_WORDS]
+
+
+def _year(book):
+    """Returns the year a book was published, parsing publishedDate for books
+    written before publishedYear was stored."""
+    if book.get('publishedYear') is not None:
+        return int(book['publishedYear'])
+    return parse_published(book.get('publishedDate'))[0]
+
+
+def _field_terms(book):
+    """Yields the (field, term) pairs a book is indexed under."""
+    for field in ('title', 'author', 'description'):
+        for term in tokenize(book.get(field)):
+            yield field, term
+    year = _year(book)
+    if year is not None:
+        yield 'year', u'{}'.format(year)
+    if book.get('rating') not in (None, ''):
+        yield 'rating', u'{}'.format(book['rating'])
+
+
+def _facet_values(book):
+    """Returns the (rating, year) a book is filtered and counted by, as
+    integers or None."""
+    try:
+        rating = int(book.get('rating'))
+    except (TypeError, ValueError):
+        rating = None
+    return rating, _year(book)
+
+
+def _within(value, low, high):
+    if low is None and high is None:
+        return True
+    return (value is not None and (low is None or value >= low) and
+            (high is None or value <= high))
+
+
+def _catalog(model, fields):
+    """Yields every book of model with only fields, reading it a page at a
+    time."""
+    cursor = None
+    while True:
+        books, cursor = model.list(
+            limit=_BUILD_PAGE_SIZE, cursor=cursor, fields=fields)
+        for book in books:
+            yield book
+        if not cursor:
+            break
+
+
+class LiveIndex(object):
+    """Base class of the in-process indexes of the catalog.
+
+    An index is filled from the model's list() when first used, rebuilt once
+    it is older than max_age, and kept current in between as a ModelProxy
+    listener. Subclasses implement add(book) and remove(id), and keep
+    everything they index in the attributes named by DATA_ATTRIBUTES, which
+    a rebuild swaps in as a whole. A rebuild reads only the BUILD_FIELDS of
+    each book.
+
+    Book ids are stored as strings so that the integer ids of cloudsql and
+    datastore match the string ids the crud views receive from the URL.
+    """
+
+    DATA_ATTRIBUTES = ()
+    BUILD_FIELDS = ()
+
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+        self.built_at = None
+        self._lock = threading.RLock()
+        self._build_lock = threading.Lock()
+        self._building = False
+        self._pending = []
+        self._refresher = None
+
+    # Listener interface for ModelProxy.
+
+    def book_saved(self, book):
+        with self._lock:
+            if self._building:
+                self._pending.append(('add', book))
+            if self.built_at is not None:
+                self.add(book)
+
+    def book_deleted(self, id):
+        with self._lock:
+            if self._building:
+                self._pending.append(('remove', id))
+            if self.built_at is not None:
+                self.remove(id)
+
+    # Index maintenance.
+
+    def add(self, book):
+        raise NotImplementedError
+
+    def remove(self, id):
+        raise NotImplementedError
+
+    def load(self, books):
+        """Indexes books into a new index that no other thread uses yet.
+        Subclasses may load in bulk faster than one add() per book."""
+        for book in books:
+            self.add(book)
+
+    def refresh(self, model, blocking=True):
+        """Rebuilds the index if it is stale and no other thread is already
+        doing so. With blocking, waits for a rebuild in progress instead."""
+        if not self._build_lock.acquire(blocking):
+            return
+        try:
+            if self.is_stale():
+                self.rebuild(model)
+        finally:
+            self._build_lock.release()
+
+    def refresh_in_background(self, app, model):
+        """Starts rebuilding the index on a thread of its own, in an app
+        context of app, if it is stale and no rebuild is running yet.
+        Returns that thread, or None if there is nothing to do."""
+        with self._lock:
+            if not self.is_stale():
+                return None
+            if self._refresher is not None:
+                return self._refresher
+
+            def run():
+                try:
+                    with app.app_context():
+                        self.refresh(model)
+                except Exception:
+                    logger.exception("Building the %s failed",
+                                     type(self).__name__)
+                finally:
+                    with self._lock:
+                        self._refresher = None
+
+            self._refresher = threading.Thread(
+                target=run, name='{}-build'.format(type(self).__name__))
+            self._refresher.daemon = True
+            self._refresher.start()
+            return self._refresher
+
+    def rebuild(self, model):
+        """Reloads the whole index from the model's list().
+
+        The catalog is read without holding the index lock, so queries keep
+        being answered from the old index meanwhile. Writes that arrive during
+        the read are replayed on the fresh index before it is swapped in.
+        """
+        with self._lock:
+            self._building = True
+            self._pending = []
+
+        try:
+            fresh = type(self)()
+            fresh.load(_catalog(model, self.BUILD_FIELDS))
+
+            with self._lock:
+                for method, arg in self._pending:
+                    getattr(fresh, method)(arg)
+                for name in self.DATA_ATTRIBUTES:
+                    setattr(self, name, getattr(fresh, name))
+                self.built_at = time.time()
+        finally:
+            with self._lock:
+                self._building = False
+                self._pending = []
+
+    def is_stale(self):
+        if self.built_at is None:
+            return True
+        return (self.max_age is not None and
+                time.time() - self.built_at > self.max_age)
+
+
+class SearchIndex(LiveIndex):
+    """A thread-safe inverted index of books."""
+
+    DATA_ATTRIBUTES = ('_postings', '_doc_terms', '_docs', '_facets')
+    BUILD_FIELDS = ('title', 'author', 'description', 'rating',
+                    'publishedDate', 'publishedYear')
+
+    def __init__(self, max_age=None):
+        super(SearchIndex, self).__init__(max_age)
+        self._postings = {}
+        self._doc_terms = {}
+        self._docs = {}
+        self._facets = {}
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, book):
+        """Indexes a book, replacing any previous version of it."""
+        doc_id = str(book['id'])
+        counts = {}
+        for key in _field_terms(book):
+            counts[key] = counts.get(key, 0) + 1
+
+        with self._lock:
+            self.remove(doc_id)
+            summary = dict((f, book.get(f)) for f in SUMMARY_FIELDS)
+            summary['id'] = book['id']
+            self._docs[doc_id] = summary
+            self._doc_terms[doc_id] = list(counts)
+            self._facets[doc_id] = _facet_values(book)
+            for key, tf in counts.items():
+                self._postings.setdefault(key, {})[doc_id] = tf
+
+    def remove(self, id):
+        doc_id = str(id)
+        with self._lock:
+            self._docs.pop(doc_id, None)
+            self._facets.pop(doc_id, None)
+            for key in self._doc_terms.pop(doc_id, ()):
+                postings = self._postings.get(key)
+                if postings is None:
+                    continue
+                postings.pop(doc_id, None)
+                if not postings:
+                    del self._postings[key]
+
+    # Queries.
+
+    def search(self, query, field=None, limit=10, cursor=None):
+        """Returns a page of the summaries of books matching every term of the
+        query, best match first, and a cursor for the next page (or None).
+
+        With a field, only that field is searched; otherwise a term may match
+        in any of them. Scores are tf-idf weighted by FIELD_WEIGHTS.
+        """
+        if not query:
+            return [], None
+        results, next_page, _ = self.query(
+            query, field, limit=limit, cursor=cursor, facets=False)
+        return results, next_page
+
+    def similar(self, id, limit=5):
+        """Returns the summaries of up to limit other books that share the
+        most words of a book's title, rare words counting for more, best
+        match first. A book the index doesn't hold has none."""
+        doc_id = str(id)
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        with self._lock:
+            total = float(len(self._docs)) or 1.0
+            scores = {}
+            for key in self._doc_terms.get(doc_id, ()):
+                postings = self._postings.get(key)
+                if key[0] != 'title' or not postings:
+                    continue
+                idf = math.log(1.0 + total / len(postings))
+                for other in postings:
+                    if other != doc_id:
+                        scores[other] = scores.get(other, 0.0) + idf
+            best = heapq.nsmallest(limit, (
+                (-score, self._docs[other]['title'] or u'', other)
+                for other, score in scores.items()))
+            return [dict(self._docs[key[2]]) for key in best]
+
+    def query(self, text=None, field=None, filters=None, limit=10,
+              cursor=None, facets=True):
+        """Runs a compound query and returns a page of summaries, the cursor
+        of the next page (or None), and the facets of every match.
+
+        text is matched as by search(), and orders the results by score;
+        without it they are in title order. filters may hold any of FILTERS:
+        every term of author must appear in the author field, and ratings
+        and publication years must lie within the given bounds. A book must
+        pass all of them.
+
+        The facets are the number of matching books per rating and per year,
+        and for the TOP_AUTHORS most frequent authors, as lists of (value,
+        count) pairs. They are counted in the same pass over the matches
+        that picks the page, with a bounded heap, so only limit + 1 results
+        are ever held in order. At most MAX_PAGE_SIZE results are returned
+        however large limit is.
+        """
+        filters = filters or {}
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        position = decode_cursor(cursor, (NUMBER, TEXT, TEXT))
+        ratings = (filters.get('min_rating'), filters.get('max_rating'))
+        years = (filters.get('min_year'), filters.get('max_year'))
+        counts = {'rating': {}, 'year': {}, 'author': {}}
+
+        with self._lock:
+            scores = None
+            if text:
+                scores = self._text_scores(text, field)
+            author_terms = tokenize(filters.get('author'))
+            if author_terms:
+                scores = self._require(scores, 'author', author_terms)
+            if scores is None:
+                matches = ((doc_id, 0.0) for doc_id in self._docs)
+            else:
+                matches = scores.items()
+
+            # Results are ordered by score, then title, then id, so that the
+            # sort key of the last result is a cursor to seek past.
+            def keys():
+                for doc_id, score in matches:
+                    rating, year = self._facets[doc_id]
+                    if not (_within(rating, *ratings) and
+                            _within(year, *years)):
+                        continue
+                    doc = self._docs[doc_id]
+                    if facets:
+                        for name, value in (('rating', rating),
+                                            ('year', year),
+                                            ('author', doc['author'])):
+                            if value is not None:
+                                counts[name][value] = (
+                                    counts[name].get(value, 0) + 1)
+                    key = (-score, doc['title'] or u'', doc_id)
+                    if position is None or key > position:
+                        yield key
+
+            page = heapq.nsmallest(limit + 1, keys())
+            results = [dict(self._docs[key[2]]) for key in page[:limit]]
+
+        next_page = None
+        if len(page) > limit:
+            next_page = encode_cursor(*page[limit - 1])
+        if not facets:
+            return results, next_page, None
+        return results, next_page, {
+            'rating': sorted(counts['rating'].items(), reverse=True),
+            'year': sorted(counts['year'].items(), reverse=True),
+            'author': sorted(counts['author'].items(),
+                             key=lambda item: (-item[1], item[0]))[
+                                 :TOP_AUTHORS],
+        }
+
+    def _text_scores(self, text, field):
+        """Scores the books matching every term of text by tf-idf. Must be
+        called with the lock held."""
+        if field in ('year', 'rating'):
+            terms = [u'{}'.format(text).strip()]
+        else:
+            terms = tokenize(text)
+        fields = (field,) if field else tuple(FIELD_WEIGHTS)
+        total = float(len(self._docs)) or 1.0
+        scores = None
+        for term in set(terms):
+            term_scores = {}
+            for f in fields:
+                postings = self._postings.get((f, term))
+                if not postings:
+                    continue
+                idf = math.log(1.0 + total / len(postings))
+                weight = FIELD_WEIGHTS[f] * idf
+                for doc_id, tf in postings.items():
+                    term_scores[doc_id] = (
+                        term_scores.get(doc_id, 0.0) + weight * tf)
+
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = dict(
+                    (doc_id, score + term_scores[doc_id])
+                    for doc_id, score in scores.items()
+                    if doc_id in term_scores)
+            if not scores:
+                return {}
+        return scores or {}
+
+    def _require(self, scores, field, terms):
+        """Narrows scores, or every book if scores is None, to the books with
+        each of terms in field. Must be called with the lock held."""
+        for term in terms:
+            postings = self._postings.get((field, term), {})
+            if scores is None:
+                scores = dict.fromkeys(postings, 0.0)
+            else:
+                scores = dict((doc_id, score)
+                              for doc_id, score in scores.items()
+                              if doc_id in postings)
+        return scores
+
+
+def init_app(app, model):
+    """Creates the app's search index and subscribes it to book writes on the
+    model proxy, starting its first build if INDEX_WARM is set."""
+    app.config.setdefault('SEARCH_INDEX_MAX_AGE', 300)
+    index = SearchIndex(max_age=app.config['SEARCH_INDEX_MAX_AGE'])
+    app.extensions['bookshelf.search'] = index
+    model.add_listener(index)
+    warm(app, index, model)
+    return index
+
+
+def warm(app, index, model):
+    """Starts the first build of index from model's backend in the
+    background if the app's INDEX_WARM is set."""
+    app.config.setdefault('INDEX_WARM', False)
+    if app.config['INDEX_WARM']:
+        index.refresh_in_background(app, model.backend)
+
+
+def get_index(wait=True):
+    """Returns the current app's search index, starting a rebuild in the
+    background if it is empty or too old; see fresh_index()."""
+    return fresh_index(current_app.extensions['bookshelf.search'], wait)
+
+
+def fresh_index(index, wait=True):
+    """Returns index, first starting a rebuild from the current app's
+    backend in the background if it is empty or too old.
+
+    A stale index is returned at once, to be queried while the rebuild runs.
+    One that was never built has nothing to answer from: with wait, the
+    caller waits for the build, otherwise it gets the empty index.
+    """
+    if index.is_stale():
+        thread = index.refresh_in_background(
+            current_app._get_current_object(),
+            current_app.extensions['bookshelf.model'].backend)
+        if wait and thread is not None and index.built_at is None:
+            thread.join()
+    return index
@@ -0,0 +1,169 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Typeahead completions of book titles and authors.
+
+Completions come from a sorted array searched with bisect, so a lookup costs
+O(log n) plus the few entries it reads, and never reaches the database. The
+array holds every title and author lower-cased, and also each tail of them
+that starts at a later word, so that "pot" completes to "Harry Potter".
+
+Like the search index, each process keeps its own copy, built from the
+backend in the background and kept current through the write notifications
+of the model proxy. Until the first build is done there are no completions,
+rather than keystrokes waiting for it.
+"""
+
+import bisect
+
+from flask import current_app
+
+from .search import fresh_index, LiveIndex, warm
+
+
+# The fields completions are drawn from.
+FIELDS = ('title', 'author')
+
+# The most completions suggest() returns.
+MAX_SUGGESTIONS = 20
+
+# At most this many entries are read per lookup, which bounds the cost of a
+# one-letter prefix. Completions are ranked among those.
+SCAN_LIMIT = 200
+
+
+def _normalize(text):
+    return u' '.join(u'{}'.format(text).lower().split())
+
+
+def _entries(book):
+    """Returns the (key, field, text) entries a book is found under."""
+    entries = set()
+    for field in FIELDS:
+        text = u'{}'.format(book.get(field) or u'').strip()
+        words = _normalize(text).split()
+        for start in range(len(words)):
+            entries.add((u' '.join(words[start:]), field, text))
+    return entries
+
+
+class PrefixIndex(LiveIndex):
+    """A thread-safe sorted array of title and author completions.
+
+    Entries are shared by every book with the same title or author and
+    counted, so an entry leaves the array with the last book that has it.
+    """
+
+    DATA_ATTRIBUTES = ('_keys', '_counts', '_book_entries')
+    BUILD_FIELDS = FIELDS
+
+    def __init__(self, max_age=None):
+        super(PrefixIndex, self).__init__(max_age)
+        self._keys = []
+        self._counts = {}
+        self._book_entries = {}
+
+    def __len__(self):
+        return len(self._book_entries)
+
+    def add(self, book):
+        """Indexes a book, replacing any previous version of it."""
+        doc_id = str(book['id'])
+        entries = _entries(book)
+        with self._lock:
+            self.remove(doc_id)
+            self._book_entries[doc_id] = entries
+            for entry in entries:
+                count = self._counts.get(entry, 0)
+                if not count:
+                    bisect.insort(self._keys, entry)
+                self._counts[entry] = count + 1
+
+    def load(self, books):
+        """Indexes books into a new index, sorting the array once at the end
+        rather than inserting each entry in place, which would make the
+        build quadratic."""
+        with self._lock:
+            for book in books:
+                doc_id = str(book['id'])
+                for entry in self._book_entries.pop(doc_id, ()):
+                    self._counts[entry] -= 1
+                entries = _entries(book)
+                self._book_entries[doc_id] = entries
+                for entry in entries:
+                    self._counts[entry] = self._counts.get(entry, 0) + 1
+            self._counts = dict(
+                (entry, count) for entry, count in self._counts.items()
+                if count)
+            self._keys = sorted(self._counts)
+
+    def remove(self, id):
+        with self._lock:
+            for entry in self._book_entries.pop(str(id), ()):
+                count = self._counts.pop(entry) - 1
+                if count:
+                    self._counts[entry] = count
+                else:
+                    del self._keys[bisect.bisect_left(self._keys, entry)]
+
+    def suggest(self, prefix, limit=10, field=None):
+        """Returns up to limit completions of prefix, optionally only those of
+        one field, as dicts of the field, the text and the number of books
+        that have it. Completions shared by more books come first, then
+        those that start with the prefix rather than have a later word that
+        does."""
+        prefix = _normalize(prefix)
+        limit = max(1, min(limit, MAX_SUGGESTIONS))
+        if not prefix:
+            return []
+
+        found = {}
+        with self._lock:
+            start = bisect.bisect_left(self._keys, (prefix,))
+            end = min(len(self._keys), start + SCAN_LIMIT)
+            for i in range(start, end):
+                entry = self._keys[i]
+                key, entry_field, text = entry
+                if not key.startswith(prefix):
+                    break
+                if field and entry_field != field:
+                    continue
+                # A text may match at more than one word; rank it by its
+                # best match.
+                rank = (-self._counts[entry], key != _normalize(text),
+                        text.lower())
+                found[entry_field, text] = min(
+                    found.get((entry_field, text), rank), rank)
+
+        ranked = sorted(found.items(), key=lambda item: item[1])
+        return [{'field': entry_field, 'text': text, 'books': -rank[0]}
+                for (entry_field, text), rank in ranked[:limit]]
+
+
+def init_app(app, model):
+    """Creates the app's prefix index and subscribes it to book writes on the
+    model proxy, starting its first build if INDEX_WARM is set."""
+    app.config.setdefault('SUGGEST_INDEX_MAX_AGE', 300)
+    index = PrefixIndex(max_age=app.config['SUGGEST_INDEX_MAX_AGE'])
+    app.extensions['bookshelf.suggest'] = index
+    model.add_listener(index)
+    warm(app, index, model)
+    return index
+
+
+def get_index():
+    """Returns the current app's prefix index, starting a rebuild in the
+    background if it is empty or too old. Never waits for the build."""
+    return fresh_index(current_app.extensions['bookshelf.suggest'], wait=False)
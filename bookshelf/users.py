@@ -0,0 +1,103 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+User accounts, looked up by name through a short-lived cache.
+
+Every backend stores users under a unique name: an indexed unique column in
+cloudsql, a unique index in mongodb, and the entity key in datastore. So a
+lookup is one index or key read however many users there are.
+
+Login bursts repeat the same names, so the UserStore keeps what each lookup
+found for USER_CACHE_TTL seconds, and that a name doesn't exist for
+USER_NEGATIVE_TTL seconds. Each process has its own cache, so the negative
+time is kept short: a new user may fail to log in on another worker for that
+long.
+"""
+
+from flask import current_app
+
+from .cache import LRUCache
+
+
+class NameTaken(ValueError):
+    """Raised by createUser() when a user of that name already exists."""
+
+
+class DuplicateNames(RuntimeError):
+    """Raised when the unique index on user names can't be built because
+    existing users share names. names lists each shared name once."""
+
+    def __init__(self, names):
+        self.names = list(names)
+        super(DuplicateNames, self).__init__(
+            "Several users are called {}; rename or remove all but one of "
+            "each before the unique index on user names can be built".format(
+                ', '.join(repr(name) for name in self.names)))
+
+
+class UserStore(object):
+    """Creates users through the model and caches lookups by name."""
+
+    def __init__(self, model, ttl=30, negative_ttl=5, max_entries=10000):
+        self.model = model
+        self._found = LRUCache(max_entries=max_entries, ttl=ttl)
+        self._missing = LRUCache(max_entries=max_entries, ttl=negative_ttl)
+
+    def get(self, name):
+        """Returns the user called name, or None."""
+        user = self._found.get(name)
+        if user is not None:
+            return user
+        if self._missing.get(name) is not None:
+            return None
+        user = self.model.getName(name)
+        if user is None:
+            self._missing.set(name, True)
+        else:
+            self._found.set(name, user)
+        return user
+
+    def create(self, data):
+        """Creates a user, raising NameTaken if the name is in use."""
+        user = self.model.createUser(data)
+        self._missing.delete(user['name'])
+        self._found.set(user['name'], user)
+        return user
+
+    def stats(self):
+        found = self._found.stats()
+        missing = self._missing.stats()
+        return {
+            'hits': found['hits'] + missing['hits'],
+            'misses': missing['misses'],
+            'negative_hits': missing['hits'],
+            'entries': found['entries'] + missing['entries'],
+        }
+
+
+def init_app(app, model):
+    """Creates the app's user store in front of model."""
+    app.config.setdefault('USER_CACHE_TTL', 30)
+    app.config.setdefault('USER_NEGATIVE_TTL', 5)
+    store = UserStore(
+        model, ttl=app.config['USER_CACHE_TTL'],
+        negative_ttl=app.config['USER_NEGATIVE_TTL'],
+        max_entries=app.config.get('CACHE_MAX_ENTRIES', 10000))
+    app.extensions['bookshelf.users'] = store
+    return store
+
+
+def get_store():
+    return current_app.extensions['bookshelf.users']
@@ -0,0 +1,183 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Write-behind buffering of likes and ratings.
+
+Votes are added up per book in memory and handed to the model's add_votes()
+every VOTE_FLUSH_INTERVAL seconds by a background thread, so a burst of votes
+on a popular book becomes one increment of its row, document or shard rather
+than one write each, and the request that casts a vote never waits for the
+database. The backends apply the increments atomically, so buffers in any
+number of processes can flush at once.
+
+Votes still in a buffer are lost if the process dies; they are flushed when
+it exits normally. Pages count them in through pending() in the process that
+took them.
+"""
+
+import atexit
+import logging
+import threading
+
+from flask import current_app
+
+
+logger = logging.getLogger(__name__)
+
+
+_NO_VOTES = (0, 0, 0)
+
+
+class PartialVotes(Exception):
+    """Raised by a backend's add_votes() when it wrote the votes of only some
+    of the books before failing. applied holds the ids of those books, as
+    given, and cause the original exception."""
+
+    def __init__(self, applied, cause):
+        super(PartialVotes, self).__init__(
+            'Votes of {} books applied before: {}'.format(len(applied), cause))
+        self.applied = frozenset(applied)
+        self.cause = cause
+
+
+def _add(counts, more):
+    return tuple(a + b for a, b in zip(counts, more))
+
+
+def _count(votes, ids):
+    """The likes and ratings in votes of the books in ids."""
+    return sum(votes[id][0] + votes[id][1] for id in ids)
+
+
+class VoteBuffer(object):
+    """Coalesces votes per book and flushes them to the model in batches.
+
+    Votes are kept as (likes, ratings, rating total) per book id. With an
+    interval of 0 or less every vote is written as it is added. Otherwise a
+    daemon thread, started by the first vote, flushes every interval seconds,
+    and early once max_pending books have votes waiting.
+    """
+
+    def __init__(self, model, interval=1.0, max_pending=1000, app=None):
+        self.model = model
+        self.interval = interval
+        self.max_pending = max_pending
+        self.app = app
+        self.flushes = 0
+        self.flushed_votes = 0
+        self.failures = 0
+        self._pending = {}
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def add(self, id, likes=0, rating=None):
+        """Adds likes and, if given, one rating to a book."""
+        counts = (likes, 1 if rating else 0, rating or 0)
+        id = str(id)
+        if self.interval <= 0:
+            self.model.add_votes({id: counts})
+            return
+        with self._lock:
+            self._pending[id] = _add(self._pending.get(id, _NO_VOTES), counts)
+            full = len(self._pending) >= self.max_pending
+            if self._thread is None:
+                self._start()
+        if full:
+            self._wake.set()
+
+    def pending(self, id):
+        """Returns the (likes, ratings, rating total) of a book that are not
+        in the database yet."""
+        id = str(id)
+        with self._lock:
+            return _add(self._pending.get(id, _NO_VOTES),
+                        self._flushing.get(id, _NO_VOTES))
+
+    def flush(self):
+        """Writes every buffered vote with one add_votes call and returns the
+        number of books written. On failure the votes that weren't written
+        go back into the buffer for the next flush; those of books the
+        model reports applied through PartialVotes are not written again."""
+        with self._flush_lock:
+            with self._lock:
+                votes = self._flushing = self._pending
+                self._pending = {}
+            if not votes:
+                return 0
+            try:
+                self.model.add_votes(votes)
+            except Exception as e:
+                applied = e.applied if isinstance(e, PartialVotes) else ()
+                logger.exception("Flushing votes for %d books failed, %d "
+                                 "applied", len(votes), len(applied))
+                with self._lock:
+                    for id, counts in votes.items():
+                        if id not in applied:
+                            self._pending[id] = _add(
+                                self._pending.get(id, _NO_VOTES), counts)
+                    self._flushing = {}
+                    self.failures += 1
+                    self.flushed_votes += _count(votes, applied)
+                return len(applied)
+            with self._lock:
+                self._flushing = {}
+                self.flushes += 1
+                self.flushed_votes += _count(votes, votes)
+            return len(votes)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': len(self._pending),
+                'flushes': self.flushes,
+                'flushed_votes': self.flushed_votes,
+                'failures': self.failures,
+            }
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name='vote-flush')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self._flush_in_app)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self._flush_in_app()
+
+    def _flush_in_app(self):
+        if self.app is None:
+            return self.flush()
+        with self.app.app_context():
+            return self.flush()
+
+
+def init_app(app, model):
+    """Creates the app's vote buffer in front of model."""
+    app.config.setdefault('VOTE_FLUSH_INTERVAL', 1.0)
+    app.config.setdefault('VOTE_MAX_PENDING', 1000)
+    buffer = VoteBuffer(
+        model, interval=app.config['VOTE_FLUSH_INTERVAL'],
+        max_pending=app.config['VOTE_MAX_PENDING'], app=app)
+    app.extensions['bookshelf.votes'] = buffer
+    return buffer
+
+
+def get_buffer():
+    return current_app.extensions['bookshelf.votes']
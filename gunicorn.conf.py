@@ -0,0 +1,67 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Gunicorn settings, from the SERVER_* values in config.py. The environment
+variables GUNICORN_WORKER_CLASS, GUNICORN_WORKERS and GUNICORN_THREADS
+override them for a single deployment or benchmark run.
+
+    $ gunicorn -c gunicorn.conf.py -b :8080 main:app
+
+Each worker process serves SERVER_THREADS requests at once, as threads
+('gthread') or greenlets ('gevent', which needs `pip install gevent`). The
+data model is safe for either:
+
+    cloudsql    db.session is scoped to the app context, so every thread or
+                greenlet has its own session; connections come from the
+                engine's pool, shared by the process.
+    mongodb     one MongoClient per process, which is thread-safe and pools
+                its connections.
+    datastore   one client per process, created on first use after the fork.
+                Under gevent, gRPC is switched to cooperative polling below.
+"""
+
+import multiprocessing
+import os
+
+# Imported by name: gunicorn reads every global here as a setting, and
+# "config" is one.
+from config import SERVER_THREADS, SERVER_WORKER_CLASS, SERVER_WORKERS
+
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', SERVER_WORKER_CLASS)
+workers = int(os.environ.get('GUNICORN_WORKERS') or SERVER_WORKERS or
+              multiprocessing.cpu_count())
+threads = int(os.environ.get('GUNICORN_THREADS') or SERVER_THREADS)
+
+# gevent workers take their concurrency from worker_connections.
+if worker_class == 'gevent':
+    worker_connections = threads
+
+# Every worker builds its own app after the fork: database clients,
+# connection pools and background threads don't survive fork().
+preload_app = False
+
+
+def post_worker_init(worker):
+    # The gevent worker has monkey-patched the standard library by now, but
+    # gRPC's own polling needs switching separately before the Datastore
+    # client opens a channel.
+    if worker_class != 'gevent':
+        return
+    try:
+        from grpc.experimental import gevent as grpc_gevent
+    except ImportError:
+        return
+    grpc_gevent.init_gevent()
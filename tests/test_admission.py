@@ -0,0 +1,102 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+from bookshelf import admission
+from bookshelf.admission import Limiter
+from flask import Flask
+
+
+def test_limiter_rejects_beyond_queue():
+    limiter = Limiter(1, queue=0)
+    assert limiter.acquire()
+    assert not limiter.acquire()
+    limiter.release()
+    assert limiter.acquire()
+    assert limiter.stats() == {'in_flight': 1, 'waiting': 0, 'admitted': 2,
+                               'rejected': 1, 'timed_out': 0}
+
+
+def test_limiter_queue_waits_until_deadline():
+    limiter = Limiter(1, queue=1, timeout=0.1)
+    assert limiter.acquire()
+    start = time.time()
+    assert not limiter.acquire()
+    assert time.time() - start >= 0.1
+    assert limiter.stats()['timed_out'] == 1
+
+    threading.Timer(0.05, limiter.release).start()
+    limiter.timeout = 5
+    assert limiter.acquire()
+    assert limiter.stats()['in_flight'] == 1
+
+
+def test_demand_within_queue_is_never_rejected():
+    # As many callers as the limiter serves and queues, each acquiring again
+    # straight after it releases.
+    limiter = Limiter(2, queue=2, timeout=5)
+
+    def client():
+        for _ in range(30):
+            assert limiter.acquire()
+            time.sleep(0.001)
+            limiter.release()
+
+    threads = [threading.Thread(target=client) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = limiter.stats()
+    assert stats['admitted'] == 120
+    assert stats['rejected'] == 0
+    assert stats['in_flight'] == 0 and stats['waiting'] == 0
+
+
+def test_expensive_endpoint_sheds_load_alone():
+    app = Flask(__name__)
+    release = threading.Event()
+
+    @app.route('/slow')
+    def slow():
+        release.wait(5)
+        return 'slow'
+
+    @app.route('/cheap')
+    def cheap():
+        return 'cheap'
+
+    app.config['ADMISSION_LIMITS'] = {
+        'slow': {'endpoints': ['slow'], 'concurrency': 1}}
+    app.config['ADMISSION_RETRY_AFTER'] = 3
+    control = admission.init_app(app)
+
+    first = threading.Thread(target=app.test_client().get, args=('/slow',))
+    first.start()
+    while control.stats()['slow_in_flight'] == 0:
+        time.sleep(0.01)
+
+    client = app.test_client()
+    response = client.get('/slow')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '3'
+    assert client.get('/cheap').data == b'cheap'
+
+    release.set()
+    first.join()
+    assert control.stats()['slow_in_flight'] == 0
+    assert control.stats()['slow_rejected'] == 1
+    assert client.get('/slow').status_code == 200
@@ -0,0 +1,103 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+import bookshelf
+from bookshelf import model_cloudsql, model_mongodb
+import config
+from conftest import flaky_filter
+from flaky import flaky
+import pytest
+
+
+@flaky(rerun_filter=flaky_filter)
+@pytest.mark.usefixtures('app', 'model')
+class TestApi(object):
+
+    def test_list_and_stream(self, app, model):
+        for i in range(1, 13):
+            model.create({'title': u'Book {0}'.format(i)})
+
+        with app.test_client() as c:
+            page = c.get('/api/books?limit=5').get_json()
+            stream = c.get('/api/books?stream=1')
+
+        assert len(page['books']) == 5
+        assert page['next_page_token']
+        assert stream.mimetype == 'application/x-ndjson'
+        lines = stream.data.decode('utf-8').splitlines()
+        assert len(set(json.loads(line)['id'] for line in lines)) == 12
+
+    def test_read_and_batch(self, app, model):
+        first = model.create({'title': u'First'})
+        second = model.create({'title': u'Second'})
+        ids = [str(second['id']), str(first['id'])]
+
+        with app.test_client() as c:
+            book = c.get('/api/books/%s' % first['id']).get_json()
+            batch = c.post('/api/books/batch', json={'ids': ids}).get_json()
+            empty = c.get('/api/books/batch')
+
+        assert book['title'] == u'First'
+        assert [b['title'] for b in batch['books']] == [u'Second', u'First']
+        assert empty.status_code == 400
+
+    def test_search(self, app, model):
+        model.create({'title': u'Python Tricks', 'rating': 5})
+
+        with app.test_client() as c:
+            rv = c.get('/api/books/search?q=python&facets=1').get_json()
+
+        assert rv['books'][0]['title'] == u'Python Tricks'
+        assert rv['facets']['rating'] == [[5, 1]]
+
+
+@pytest.fixture(params=['cloudsql', 'mongodb'])
+def local_app(request, monkeypatch, tmpdir):
+    """An app on SQLite or mongomock, for tests that need no live backend."""
+    if request.param == 'mongodb':
+        mongomock = pytest.importorskip('mongomock')
+
+        class MockPyMongo(object):
+            def __init__(self, app=None):
+                self.db = mongomock.MongoClient().bookshelf_api
+
+        monkeypatch.setattr(model_mongodb, 'PyMongo', MockPyMongo)
+    app = bookshelf.create_app(config, testing=True, config_overrides={
+        'DATA_BACKEND': request.param, 'INDEX_WARM': False,
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///{}'.format(
+            tmpdir.join('bookshelf.db'))})
+    if request.param == 'cloudsql':
+        with app.app_context():
+            model_cloudsql.db.create_all()
+    return app
+
+
+def test_malformed_ids(local_app):
+    with local_app.app_context():
+        book = bookshelf.get_model().create({'title': u'Dune'})
+
+    with local_app.test_client() as c:
+        assert c.get('/api/books/not-an-id').status_code == 404
+        assert c.get('/api/books/{}'.format(book['id'])).status_code == 200
+
+        assert c.get('/api/books/batch?ids={},x'.format(
+            book['id'])).status_code == 400
+        for ids in (['x'], [None], [{'id': 1}], [True]):
+            rv = c.post('/api/books/batch', json={'ids': ids})
+            assert rv.status_code == 400
+            assert rv.get_json()['error'] == 'Invalid id'
+        rv = c.get('/api/books/batch?ids={}'.format(book['id']))
+        assert rv.get_json()['books'][0]['title'] == u'Dune'
@@ -0,0 +1,98 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import threading
+
+from bookshelf.bulk import Checkpoint, import_books, read_rows
+from flask import Flask
+import pytest
+
+
+def test_read_rows_keeps_book_fields():
+    stream = io.StringIO(u'title,author,junk,rating\nDune,Herbert,x,\n')
+    assert list(read_rows(stream, 'csv')) == [
+        {'title': u'Dune', 'author': u'Herbert'}]
+
+    stream = io.StringIO(u'{"title": "Dune", "rating": 5}\n\n')
+    assert list(read_rows(stream, 'jsonl')) == [
+        {'title': u'Dune', 'rating': 5}]
+
+
+def test_checkpoint_advances_over_contiguous_batches(tmpdir):
+    path = str(tmpdir.join('import.ckpt'))
+    checkpoint = Checkpoint(path)
+    checkpoint.finished(10, 10)
+    assert checkpoint.done == 0
+
+    checkpoint.finished(0, 10)
+    assert checkpoint.done == 20
+    assert Checkpoint(path).done == 20
+
+
+class FlakyModel(object):
+    """Stores books by title. The batch starting with fail_title fails once,
+    after the next batch is stored."""
+
+    def __init__(self, fail_title):
+        self.fail_title = fail_title
+        self.titles = []
+        self._lock = threading.Lock()
+        self._failed = False
+        self._later_stored = threading.Event()
+
+    def create_many(self, books):
+        first = books[0]['title']
+        if first == self.fail_title and not self._failed:
+            self._failed = True
+            self._later_stored.wait(5)
+            raise IOError('Connection reset')
+        with self._lock:
+            self.titles.extend(book['title'] for book in books)
+        if int(first) > int(self.fail_title):
+            self._later_stored.set()
+
+
+def test_resumed_import_skips_batches_stored_after_a_failure(tmpdir):
+    rows = [{'title': str(i)} for i in range(50)]
+    model = FlakyModel(fail_title='10')
+    app = Flask(__name__)
+    path = str(tmpdir.join('import.ckpt'))
+
+    with app.app_context():
+        checkpoint = Checkpoint(path)
+        with pytest.raises(IOError):
+            import_books(model, rows, batch_size=5, workers=2,
+                         checkpoint=checkpoint)
+        assert checkpoint.done == 10
+        assert len(model.titles) > 10
+
+        # From the file, and as the import page hands it back.
+        for resumed in (Checkpoint(path),
+                        Checkpoint.from_skip(checkpoint.skip())):
+            assert resumed.skip() == checkpoint.skip()
+
+        assert import_books(model, rows, batch_size=7, workers=2,
+                            checkpoint=Checkpoint(path)) == 50
+    assert sorted(model.titles, key=int) == [row['title'] for row in rows]
+
+
+def test_skip_parsing():
+    checkpoint = Checkpoint.from_skip('10,20-25,30-35')
+    assert list(checkpoint.missing(0, 40)) == [(10, 10), (25, 5), (35, 5)]
+    assert Checkpoint.from_skip('7').done == 7
+    assert Checkpoint.from_skip(None).skip() == '0'
+    for skip in ('x', '-1', '10,5-8', '10,20', '10,25-20'):
+        with pytest.raises(ValueError):
+            Checkpoint.from_skip(skip)
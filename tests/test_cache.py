@@ -0,0 +1,93 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+from bookshelf.cache import CachedModel, LRUCache
+from bookshelf.model_proxy import ModelProxy
+
+
+class FakeBackend(object):
+    """A dictionary-backed stand-in for a model module that counts reads."""
+
+    def __init__(self):
+        self.books = {}
+        self.reads = 0
+
+    def read(self, id):
+        self.reads += 1
+        return self.books.get(str(id))
+
+    def list(self, limit=10, cursor=None, summary=False):
+        self.reads += 1
+        return sorted(self.books.values(), key=lambda b: b['title']), None
+
+    def create(self, data):
+        book = dict(data, id=len(self.books) + 1)
+        self.books[str(book['id'])] = book
+        return book
+
+    def update(self, data, id):
+        self.books[str(id)].update(data)
+        return self.books[str(id)]
+
+    def delete(self, id):
+        self.books.pop(str(id), None)
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.stats()['evictions'] == 1
+
+
+def test_lru_expires_entries():
+    cache = LRUCache(ttl=0.01)
+    cache.set('a', 1)
+    time.sleep(0.02)
+    assert cache.get('a') is None
+    assert cache.stats()['misses'] == 1
+
+
+def test_lru_returns_copies():
+    cache = LRUCache()
+    cache.set('a', {'title': 'x'})
+    cache.get('a')['title'] = 'y'
+    assert cache.get('a') == {'title': 'x'}
+
+
+def test_cached_model_invalidates_on_write():
+    backend = FakeBackend()
+    model = CachedModel(ModelProxy(backend), LRUCache())
+    book = model.create({'title': 'A'})
+
+    model.read(book['id'])
+    model.read(book['id'])
+    model.list()
+    model.list()
+    assert backend.reads == 2
+
+    model.update({'title': 'B'}, book['id'])
+    assert model.read(book['id'])['title'] == 'B'
+    assert model.list()[0][0]['title'] == 'B'
+
+    model.delete(book['id'])
+    assert model.read(book['id']) is None
+    assert model.list()[0] == []
@@ -0,0 +1,52 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bookshelf
+from bookshelf import model_cloudsql
+from bookshelf.users import DuplicateNames
+import config
+import pytest
+
+
+@pytest.fixture
+def db(tmpdir):
+    app = bookshelf.create_app(config, testing=True, config_overrides={
+        'DATA_BACKEND': 'cloudsql',
+        'INDEX_WARM': False,
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///{}'.format(
+            tmpdir.join('bookshelf.db')),
+    })
+    with app.app_context():
+        model_cloudsql.db.create_all()
+        yield model_cloudsql.db
+
+
+def test_unique_index_waits_for_duplicate_names(db):
+    # A users table from before names were unique.
+    db.engine.execute('DROP INDEX ix_users_name')
+    for name in ('ann', 'bob', 'ann'):
+        db.engine.execute(
+            "INSERT INTO users (name, pwd) VALUES ('{}', 'x')".format(name))
+
+    with pytest.raises(DuplicateNames) as raised:
+        model_cloudsql._create_missing_indexes()
+    assert raised.value.names == ['ann']
+    assert 'ann' in str(raised.value)
+    assert 'ix_users_name' not in [
+        index['name'] for index in db.inspect(db.engine).get_indexes('users')]
+
+    db.engine.execute("DELETE FROM users WHERE id = 3")
+    model_cloudsql._create_missing_indexes()
+    assert [index['unique'] for index in db.inspect(db.engine).get_indexes(
+        'users') if index['name'] == 'ix_users_name'] == [1]
@@ -13,7 +13,12 @@
 # limitations under the License.
 
 import re
+import threading
 
+import bookshelf
+from bookshelf import model_mongodb
+from bookshelf.search import SearchIndex
+import config
 from conftest import flaky_filter
 from flaky import flaky
 import pytest
@@ -44,6 +49,36 @@ class TestCrudActions(object):
             "Should not show more than 10 books")
         assert 'More' in body, "Should have more than one page"
 
+    def test_list_cached_per_name(self, app, model):
+        model.create({'title': u'Book 1'})
+
+        with app.test_client() as c:
+            first = c.get('/books/').data.decode('utf-8')
+            with c.session_transaction() as session:
+                session['name'] = u'<ann>'
+            signed_in = c.get('/books/').data.decode('utf-8')
+            model.create({'title': u'Book 2'})
+            written = c.get('/books/').data.decode('utf-8')
+
+        assert 'Name: </h5>' in first
+        assert 'Name: &lt;ann&gt;</h5>' in signed_in
+        assert 'Book 2' in written
+
+    def test_list_pages(self, app, model):
+        for i in range(1, 26):
+            model.create({'title': u'Book {0}'.format(i % 5)})
+
+        seen = []
+        token = None
+        while True:
+            books, token = model.list(limit=10, cursor=token)
+            seen.extend(book['id'] for book in books)
+            if not token:
+                break
+
+        assert len(seen) == 25
+        assert len(set(seen)) == 25, "Pages should not overlap"
+
     def test_add(self, app):
         data = {
             'title': 'Test Book',
@@ -86,3 +121,80 @@ class TestCrudActions(object):
 
         assert rv.status == '200 OK'
         assert not model.read(existing['id'])
+
+    def test_view_revalidates(self, app, model):
+        existing = model.create({'title': "Temp Title"})
+        url = '/books/%s' % existing['id']
+
+        with app.test_client() as c:
+            rv = c.get(url)
+            etag = rv.headers['ETag']
+            assert rv.headers['Last-Modified']
+
+            rv = c.get(url, headers={'If-None-Match': etag})
+            assert rv.status_code == 304
+            assert not rv.data
+
+            c.post(url + '/edit', data={'title': 'Updated Title'})
+            rv = c.get(url, headers={'If-None-Match': etag})
+
+        assert rv.status == '200 OK'
+        assert rv.headers['ETag'] != etag
+        assert 'Updated Title' in rv.data.decode('utf-8')
+
+    def test_like_and_rate(self, app, model):
+        existing = model.create({'title': "Temp Title"})
+        url = '/books/%s' % existing['id']
+
+        with app.test_client() as c:
+            etag = c.get(url).headers['ETag']
+            c.post(url + '/like')
+            c.post(url + '/rate', data={'rating': '4'})
+            c.post(url + '/rate', data={'rating': '2'})
+            assert c.post(url + '/rate', data={'rating': '6'}).status_code \
+                == 400
+            rv = c.get(url)
+
+        assert rv.headers['ETag'] != etag
+        body = rv.data.decode('utf-8')
+        assert '1 likes' in body
+        assert 'rated 3.0' in body
+
+
+def test_view_never_waits_for_the_search_index(monkeypatch):
+    mongomock = pytest.importorskip('mongomock')
+
+    class MockPyMongo(object):
+        def __init__(self, app=None):
+            self.db = mongomock.MongoClient().bookshelf_view
+
+    monkeypatch.setattr(model_mongodb, 'PyMongo', MockPyMongo)
+    app = bookshelf.create_app(config, testing=True, config_overrides={
+        'DATA_BACKEND': 'mongodb', 'INDEX_WARM': False})
+
+    # The index build takes until it is released, or 10 seconds.
+    released = threading.Event()
+    rebuild = SearchIndex.rebuild
+
+    def slow_rebuild(index, model):
+        released.wait(10)
+        rebuild(index, model)
+    monkeypatch.setattr(SearchIndex, 'rebuild', slow_rebuild)
+
+    with app.app_context():
+        book = bookshelf.get_model().create({'title': u'Python Cookbook'})
+        bookshelf.get_model().create({'title': u'Fluent Python'})
+    index = app.extensions['bookshelf.search']
+
+    with app.test_client() as c:
+        url = '/books/{}'.format(book['id'])
+        rv = c.get(url)
+        assert rv.status_code == 200
+        assert 'Similar titles' not in rv.data.decode('utf-8')
+        # Served while the build was still held.
+        assert index.built_at is None
+
+        builder = index._refresher
+        released.set()
+        builder.join()
+        assert 'Fluent Python' in c.get(url).data.decode('utf-8')
@@ -0,0 +1,115 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+
+from bookshelf import model_datastore
+from google.cloud import datastore
+import pytest
+
+
+class FakeClient(object):
+    """Just enough of a Datastore client, in memory."""
+
+    def __init__(self):
+        self.entities = {}
+        self._next_id = 1000
+
+    def key(self, *path, **kwargs):
+        if len(path) % 2:
+            path += (self._next_id,)
+            self._next_id += 1
+        return datastore.Key(*path, parent=kwargs.get('parent'),
+                             project='test')
+
+    def get(self, key):
+        found = self.get_multi([key])
+        return found[0] if found else None
+
+    def get_multi(self, keys):
+        # Copies, as a real client reads them afresh.
+        found = []
+        for key in keys:
+            if key in self.entities:
+                stored = self.entities[key]
+                entity = datastore.Entity(
+                    key=key,
+                    exclude_from_indexes=list(stored.exclude_from_indexes))
+                entity.update(stored)
+                found.append(entity)
+        return found
+
+    def put(self, entity):
+        self.entities[entity.key] = entity
+
+    def put_multi(self, entities):
+        for entity in entities:
+            self.put(entity)
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.entities.pop(key, None)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        yield
+
+
+@pytest.fixture
+def ds(monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(model_datastore, 'get_client', lambda: client)
+    return client
+
+
+def test_votes_stamp_the_book_version():
+    book = {'title': u'Fluent Python', 'version': 10, 'updatedAt': 1}
+    shards = [{'likes': 2, 'ratingCount': 1, 'ratingTotal': 4,
+               'version': 30, 'updatedAt': 3},
+              {'likes': 1, 'ratingCount': 0, 'ratingTotal': 0}]
+    model_datastore._add_shards(book, shards)
+    assert (book['likes'], book['ratingCount'], book['ratingTotal']) == (
+        3, 1, 4)
+    assert (book['version'], book['updatedAt']) == (30, 3)
+
+    # An edit after the votes is newer than every shard.
+    book = {'version': 40}
+    model_datastore._add_shards(book, shards)
+    assert book['version'] == 40 and book['likes'] == 3
+
+
+def test_stale_copies_do_not_replace_newer_books(ds):
+    model_datastore.put({'title': u'New', 'version': 5}, 1)
+    written = model_datastore.put_many_newer([
+        {'id': 1, 'title': u'Stale', 'version': 3},
+        {'id': 2, 'title': u'Fresh', 'version': 1}])
+    assert [book['id'] for book in written] == [2]
+    assert model_datastore.read(1)['title'] == u'New'
+
+    model_datastore.bury(1)
+    assert model_datastore.put_many_newer(
+        [{'id': 1, 'title': u'Zombie', 'version': 9}]) == []
+    assert model_datastore.read(1) is None
+
+
+def test_update_leaves_missing_books_missing(ds):
+    assert model_datastore.update({'title': u'Ghost'}, 7) is None
+    assert model_datastore.read(7) is None
+
+    model_datastore.put({'title': u'Dune', 'author': u'Herbert'}, 1)
+    model_datastore.add_votes({1: (2, 1, 5)})
+    book = model_datastore.update({'id': 1, 'title': u'Dune Messiah'}, 1)
+    assert (book['title'], book['author'], book['likes']) == (
+        u'Dune Messiah', u'Herbert', 2)
+    assert model_datastore.read(1)['title'] == u'Dune Messiah'
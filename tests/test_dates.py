@@ -0,0 +1,36 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+
+from bookshelf.dates import parse_published, with_published
+
+
+def test_parse_published():
+    assert parse_published(u'2015-11-16') == (
+        2015, datetime.datetime(2015, 11, 16))
+    assert parse_published(u'11/16/2015') == (
+        2015, datetime.datetime(2015, 11, 16))
+    assert parse_published(u'November 16, 2015') == (
+        2015, datetime.datetime(2015, 11, 16))
+    assert parse_published(u'Spring 1999, 2nd printing') == (1999, None)
+    assert parse_published(u'Test Date Published') == (None, None)
+    assert parse_published(None) == (None, None)
+
+
+def test_with_published():
+    assert with_published({'title': u'x'}) == {'title': u'x'}
+    data = with_published({'publishedDate': u'1999'})
+    assert data['publishedYear'] == 1999
+    assert data['publishedOn'] is None
@@ -0,0 +1,76 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+from bookshelf.fanout import FanOut
+from flask import Flask, g
+import pytest
+
+
+def test_calls_overlap():
+    app = Flask(__name__)
+    fanout = FanOut(app, workers=4)
+    with app.app_context():
+        start = time.time()
+        results = fanout.gather(*[
+            (lambda n=n: time.sleep(0.2) or n) for n in range(4)])
+    assert results == [0, 1, 2, 3]
+    assert time.time() - start < 0.6
+    assert fanout.stats()['batches'] == 1
+
+
+def test_calls_get_an_app_context():
+    app = Flask(__name__)
+    fanout = FanOut(app, workers=2)
+
+    def call():
+        g.seen = threading.current_thread().name
+        return g.seen
+
+    with app.test_request_context():
+        g.seen = 'request'
+        names = fanout.gather(call, call)
+        assert names[0] == threading.current_thread().name
+        assert names[1].startswith('fanout')
+
+
+def test_first_error_is_raised_after_every_call():
+    app = Flask(__name__)
+    fanout = FanOut(app, workers=2)
+    finished = []
+
+    def fail():
+        raise KeyError('missing')
+
+    def slow():
+        time.sleep(0.1)
+        finished.append(True)
+
+    with app.app_context():
+        with pytest.raises(KeyError):
+            fanout.gather(fail, slow)
+    assert finished == [True]
+
+
+def test_nested_and_disabled_run_inline():
+    app = Flask(__name__)
+    fanout = FanOut(app, workers=1)
+    with app.app_context():
+        assert fanout.gather(
+            lambda: 1,
+            lambda: fanout.gather(lambda: 2, lambda: 3)) == [1, [2, 3]]
+    assert fanout.stats()['inline_calls'] == 2
+    assert FanOut(app, workers=0).gather(lambda: 1, lambda: 2) == [1, 2]
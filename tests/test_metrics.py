@@ -0,0 +1,85 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bookshelf import metrics
+from bookshelf.metrics import Histogram, stats_collector
+from flask import abort, Blueprint, Flask
+import pytest
+import sqlalchemy
+from sqlalchemy.exc import OperationalError
+
+
+def test_histogram_render():
+    histogram = Histogram('latency', 'Latency.', 'endpoint',
+                          buckets=(0.1, 1.0))
+    histogram.observe('crud.list', 0.05)
+    histogram.observe('crud.list', 0.5)
+    lines = histogram.render()
+
+    assert 'latency_bucket{endpoint="crud.list",le="0.1"} 1' in lines
+    assert 'latency_bucket{endpoint="crud.list",le="1.0"} 2' in lines
+    assert 'latency_bucket{endpoint="crud.list",le="+Inf"} 2' in lines
+    assert 'latency_count{endpoint="crud.list"} 2' in lines
+
+
+def test_stats_collector_skips_non_numbers():
+    collect = stats_collector('cache', lambda: {'hits': 3, 'type': 'memory'})
+    assert collect() == ['# TYPE cache_hits gauge', 'cache_hits 3']
+
+
+def test_histogram_with_several_labels():
+    histogram = Histogram('latency', 'Latency.', ('endpoint', 'status'),
+                          buckets=(1.0,))
+    histogram.observe(('crud.list', 200), 0.5)
+    assert 'latency_count{endpoint="crud.list",status="200"} 1' in (
+        histogram.render())
+
+
+def test_failed_statements_leave_no_start_times():
+    metrics._listen_to_sqlalchemy()
+    engine = sqlalchemy.create_engine('sqlite://')
+    connection = engine.connect()
+    for _ in range(3):
+        with pytest.raises(OperationalError):
+            connection.execute('SELECT * FROM missing')
+    assert connection.info['bookshelf_query_start'] == []
+    connection.execute('SELECT 1')
+    assert connection.info['bookshelf_query_start'] == []
+
+
+def test_requests_that_raise_are_recorded():
+    app = Flask(__name__)
+    app.config.update(DATA_BACKEND='datastore', TESTING=True)
+    registry = metrics.init_app(app)
+    crud = Blueprint('crud', __name__)
+
+    @crud.route('/fails')
+    def fails():
+        raise RuntimeError('boom')
+
+    @crud.route('/missing')
+    def missing():
+        abort(404)
+
+    app.register_blueprint(crud)
+    client = app.test_client()
+    with pytest.raises(RuntimeError):
+        client.get('/fails')
+    assert client.get('/missing').status_code == 404
+
+    lines = registry.request_latency.render()
+    assert ('bookshelf_request_seconds_count'
+            '{endpoint="crud.fails",status="500"} 1') in lines
+    assert ('bookshelf_request_seconds_count'
+            '{endpoint="crud.missing",status="404"} 1') in lines
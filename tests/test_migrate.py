@@ -0,0 +1,104 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bookshelf import model_mongodb
+from bookshelf.migrate import CursorCheckpoint, DualWriter, IdMapper, migrate
+from bson.objectid import ObjectId
+from flask import Flask
+import pytest
+
+
+def test_integer_ids_round_trip_through_objectids():
+    to_mongo = IdMapper('cloudsql', 'mongodb')
+    oid = to_mongo.target_id(42)
+    assert oid == ObjectId('00000000000000000000002a')
+    assert IdMapper('mongodb', 'cloudsql').target_id(str(oid)) == 42
+
+
+def test_ids_the_target_cannot_store_are_assigned(tmpdir):
+    path = str(tmpdir.join('ids.jsonl'))
+    mapper = IdMapper('datastore', 'cloudsql', path)
+    assert mapper.target_id(5629499534213120) is None
+    assert mapper.target_id(7) == 7
+
+    mapper.record([(5629499534213120, 1)])
+    assert IdMapper('datastore', 'cloudsql', path).assigned(
+        5629499534213120) == '1'
+
+
+def test_cursor_checkpoint_waits_for_earlier_pages(tmpdir):
+    path = str(tmpdir.join('migrate.ckpt'))
+    checkpoint = CursorCheckpoint(path)
+    checkpoint.finished((1, 'b'), [{}] * 3)
+    assert checkpoint.cursor is None
+
+    checkpoint.finished((0, 'a'), [{}] * 2)
+    assert (checkpoint.cursor, checkpoint.rows) == ('b', 5)
+    assert CursorCheckpoint(path).cursor == 'b'
+
+
+class FakeSource(object):
+    """A source backend whose list() calls during_read after taking its
+    snapshot of the page, before the migrator writes it."""
+
+    def __init__(self, books):
+        self.books = books
+        self.during_read = None
+
+    def list(self, limit=10, cursor=None):
+        page = [dict(book, id=id) for id, book in sorted(self.books.items())]
+        if self.during_read is not None:
+            self.during_read()
+        return page, None
+
+    def read(self, id):
+        book = self.books.get(id)
+        return dict(book, id=id) if book is not None else None
+
+
+def test_stale_pages_lose_to_dual_writes(monkeypatch):
+    mongomock = pytest.importorskip('mongomock')
+
+    class MockPyMongo(object):
+        db = mongomock.MongoClient().bookshelf
+
+    monkeypatch.setattr(model_mongodb, 'mongo', MockPyMongo())
+    source = FakeSource({
+        1: {'title': u'Old', 'version': 1},
+        2: {'title': u'Liked', 'version': 1, 'likes': 0},
+        3: {'title': u'Deleted', 'version': 1},
+    })
+    mapper = IdMapper('cloudsql', 'mongodb')
+    writer = DualWriter(source, model_mongodb, mapper)
+
+    def edit_vote_and_delete():
+        source.books[1] = {'title': u'New', 'version': 2}
+        writer.book_saved(dict(source.books[1], id=1))
+        source.books[2] = dict(source.books[2], likes=1, version=2)
+        writer.book_voted(2, (1, 0, 0))
+        del source.books[3]
+        writer.book_deleted(3)
+
+    source.during_read = edit_vote_and_delete
+    app = Flask(__name__)
+    app.config.update(BULK_BATCH_SIZE=10, BULK_WORKERS=2)
+    with app.app_context():
+        migrate(source, model_mongodb, mapper)
+        # A rerun copies the same versions again, changing nothing.
+        source.during_read = None
+        migrate(source, model_mongodb, mapper)
+
+    assert model_mongodb.read(mapper.target_id(1))['title'] == u'New'
+    assert model_mongodb.read(mapper.target_id(2))['likes'] == 1
+    assert model_mongodb.read(mapper.target_id(3)) is None
@@ -0,0 +1,110 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bookshelf
+from bookshelf import model_mongodb
+from bookshelf.pagination import encode_cursor
+from bookshelf.users import DuplicateNames
+import config
+import pytest
+
+
+class FakeCursor(object):
+    def __init__(self, plan):
+        self.plan = plan
+
+    def sort(self, keys):
+        return self
+
+    def limit(self, limit):
+        return self
+
+    def explain(self):
+        return {'queryPlanner': {'namespace': 'bookshelf.books',
+                                 'winningPlan': self.plan}}
+
+
+class FakeCollection(object):
+    def __init__(self, plan):
+        self.plan = plan
+
+    def find(self, query):
+        return FakeCursor(self.plan)
+
+
+class FakeDatabase(object):
+    def __init__(self, books_plan, users_plan):
+        self.books = FakeCollection(books_plan)
+        self.users = FakeCollection(users_plan)
+
+
+def test_check_query_plans_reports_collection_scans():
+    indexed = {'stage': 'LIMIT', 'inputStage': {
+        'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}}}
+    # Newer servers nest the plan under queryPlan.
+    scan = {'queryPlan': {'stage': 'SORT', 'inputStage': {
+        'stage': 'COLLSCAN'}}}
+
+    assert model_mongodb.check_query_plans(
+        FakeDatabase(indexed, indexed)) == []
+    assert model_mongodb.check_query_plans(
+        FakeDatabase(indexed, scan)) == ['getName']
+    assert 'searchByRating' in model_mongodb.check_query_plans(
+        FakeDatabase(scan, indexed))
+
+
+def test_app_starts_on_mongomock(monkeypatch):
+    mongomock = pytest.importorskip('mongomock')
+
+    class MockPyMongo(object):
+        def __init__(self, app=None):
+            self.db = mongomock.MongoClient().bookshelf
+
+    monkeypatch.setattr(model_mongodb, 'PyMongo', MockPyMongo)
+    app = bookshelf.create_app(
+        config, testing=True, config_overrides={
+            'DATA_BACKEND': 'mongodb', 'INDEX_WARM': False})
+    with app.app_context():
+        book = bookshelf.get_model().create({'title': u'Fluent Python'})
+        assert bookshelf.get_model().read(book['id'])['title'] == (
+            u'Fluent Python')
+    assert model_mongodb.check_query_plans(model_mongodb.mongo.db) == []
+
+
+def test_tampered_cursor_ids_are_invalid(monkeypatch):
+    mongomock = pytest.importorskip('mongomock')
+
+    class MockPyMongo(object):
+        db = mongomock.MongoClient().bookshelf
+
+    monkeypatch.setattr(model_mongodb, 'mongo', MockPyMongo())
+
+    for id in ('not-an-object-id', 7):
+        with pytest.raises(ValueError):
+            model_mongodb.list(cursor=encode_cursor(u'Dune', id))
+
+
+def test_user_index_waits_for_duplicate_names():
+    mongomock = pytest.importorskip('mongomock')
+    users = mongomock.MongoClient().bookshelf.users
+    users.insert_many([{'name': name} for name in ('ann', 'bob', 'ann')])
+
+    with pytest.raises(DuplicateNames) as raised:
+        model_mongodb._create_user_index(users)
+    assert raised.value.names == ['ann']
+    assert 'name' not in users.index_information()
+
+    users.delete_one({'name': 'ann'})
+    model_mongodb._create_user_index(users)
+    assert users.index_information()['name']['unique']
@@ -0,0 +1,38 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bookshelf.model_cloudsql import TimedQueuePool
+import pytest
+import sqlalchemy
+from sqlalchemy.exc import TimeoutError
+
+
+def test_counts_checkouts_and_timeouts(tmpdir):
+    engine = sqlalchemy.create_engine(
+        'sqlite:///{}'.format(tmpdir.join('pool.db')),
+        poolclass=TimedQueuePool, pool_size=1, max_overflow=0,
+        pool_timeout=0.05, connect_args={'check_same_thread': False})
+    pool = engine.pool
+
+    connection = engine.connect()
+    assert pool.checkedout() == 1
+    with pytest.raises(TimeoutError):
+        engine.connect()
+    connection.close()
+    engine.connect().close()
+
+    assert pool.checkouts == 3
+    assert pool.timeouts == 1
+    assert pool.max_wait_seconds >= 0.05
+    assert pool.checkedout() == 0
@@ -0,0 +1,253 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+from bookshelf.fuzzy import FuzzyIndex
+from bookshelf.pagination import encode_cursor
+from bookshelf.search import fresh_index, MAX_PAGE_SIZE, SearchIndex, \
+    tokenize
+from bookshelf.suggest import PrefixIndex
+from flask import Flask
+import pytest
+
+
+BOOKS = [
+    {'id': 1, 'title': u'The Go Programming Language', 'author': u'Donovan',
+     'publishedDate': u'11/16/2015', 'rating': 5},
+    {'id': 2, 'title': u'Python Cookbook', 'author': u'Beazley',
+     'description': u'Recipes for mastering Python 3', 'rating': u'4'},
+    {'id': 3, 'title': u'Fluent Python', 'author': u'Ramalho',
+     'publishedDate': u'2015', 'rating': 5},
+]
+
+
+def make_index():
+    index = SearchIndex()
+    for book in BOOKS:
+        index.add(book)
+    return index
+
+
+class FakeBackend(object):
+    """Lists BOOKS, recording the fields asked for, and holds each list()
+    until released is set."""
+
+    def __init__(self, books=BOOKS):
+        self.books = books
+        self.fields = []
+        self.released = threading.Event()
+        self.released.set()
+
+    def list(self, limit=10, cursor=None, summary=False, fields=None):
+        self.released.wait()
+        self.fields.append(fields)
+        return [dict((field, book.get(field)) for field in fields + ('id',))
+                for book in self.books], None
+
+
+class FakeModel(object):
+    def __init__(self, backend):
+        self.backend = backend
+
+
+def make_app(backend):
+    app = Flask(__name__)
+    app.extensions['bookshelf.model'] = FakeModel(backend)
+    return app
+
+
+def ids(index, query, **kwargs):
+    books, _ = index.search(query, **kwargs)
+    return [book['id'] for book in books]
+
+
+def test_tokenize():
+    assert tokenize(u'The Go Programming-Language!') == [
+        u'go', u'programming', u'language']
+    assert tokenize(None) == []
+
+
+def test_search_ranks_title_matches_first():
+    assert ids(make_index(), u'python') == [2, 3]
+
+
+def test_search_requires_every_term():
+    index = make_index()
+    assert ids(index, u'fluent python') == [3]
+    assert index.search(u'fluent go') == ([], None)
+
+
+def test_search_by_field():
+    index = make_index()
+    assert ids(index, u'python', field='author') == []
+    # Equal scores fall back to title order.
+    assert ids(index, u'2015', field='year') == [3, 1]
+    assert ids(index, u'4', field='rating') == [2]
+
+
+def test_update_and_remove():
+    index = make_index()
+    index.add({'id': 3, 'title': u'Fluent Rust'})
+    assert ids(index, u'python') == [2]
+    index.remove('2')
+    assert ids(index, u'python') == []
+    assert len(index) == 2
+
+
+def test_search_pages():
+    index = SearchIndex()
+    for i in range(25):
+        index.add({'id': i, 'title': u'Book {}'.format(i % 5)})
+
+    seen = []
+    cursor = None
+    while True:
+        books, cursor = index.search(u'book', limit=10, cursor=cursor)
+        assert len(books) <= 10
+        seen.extend(book['id'] for book in books)
+        if not cursor:
+            break
+
+    assert sorted(seen) == list(range(25)), "Pages should not overlap"
+
+
+def test_search_page_size_is_bounded():
+    index = SearchIndex()
+    for i in range(MAX_PAGE_SIZE + 5):
+        index.add({'id': i, 'title': u'Book'})
+
+    books, cursor = index.search(u'book', limit=MAX_PAGE_SIZE * 10)
+    assert len(books) == MAX_PAGE_SIZE
+    assert cursor
+
+
+def test_similar_titles():
+    index = make_index()
+    index.add({'id': 4, 'title': u'Python Programming Language'})
+    assert [book['id'] for book in index.similar(4)] == [1, 3, 2]
+    assert [book['id'] for book in index.similar(2)] == [3, 4]
+    assert index.similar(2, limit=1)[0]['title'] == u'Fluent Python'
+    assert index.similar(99) == []
+
+
+def test_query_filters_and_facets():
+    index = make_index()
+    index.add({'id': 4, 'title': u'Python Tricks', 'author': u'Bader',
+               'publishedDate': u'2017', 'rating': 3})
+
+    books, _, facets = index.query(u'python', filters={'min_rating': 4})
+    assert [book['id'] for book in books] == [2, 3]
+    assert facets['rating'] == [(5, 1), (4, 1)]
+    assert facets['year'] == [(2015, 1)]
+
+    books, _, facets = index.query(filters={'min_year': 2015,
+                                            'author': u'ramalho'})
+    assert [book['id'] for book in books] == [3]
+    assert facets['author'] == [(u'Ramalho', 1)]
+
+
+def test_query_rejects_cursors_of_the_wrong_types():
+    index = make_index()
+    _, cursor, _ = index.query(u'python', limit=1)
+    assert index.query(u'python', limit=1, cursor=cursor)[0]
+
+    for key in ([1, u'x', None], [-1.0, u'x', 3], [None, u'x', u'3'],
+                [True, u'x', u'3'], [-1.0, u'x']):
+        with pytest.raises(ValueError):
+            index.query(u'python', cursor=encode_cursor(*key))
+
+
+def test_suggest():
+    index = PrefixIndex()
+    for book in BOOKS:
+        index.add(book)
+    index.add({'id': 4, 'title': u'Python Tricks', 'author': u'Ramalho'})
+
+    assert [s['text'] for s in index.suggest(u'pyt')] == [
+        u'Python Cookbook', u'Python Tricks', u'Fluent Python']
+    assert [s['text'] for s in index.suggest(u'ram')] == [u'Ramalho']
+    assert index.suggest(u'ram')[0]['books'] == 2
+    assert [s['text'] for s in index.suggest(u'lang')] == [
+        u'The Go Programming Language']
+
+    index.remove(4)
+    assert index.suggest(u'tricks') == []
+    assert index.suggest(u'ram')[0]['books'] == 1
+
+
+def test_suggest_load_matches_adds():
+    # A book read twice counts once, as it was last read.
+    books = BOOKS + [
+        {'id': 4, 'title': u'Python Tricks', 'author': u'Bader'},
+        {'id': 4, 'title': u'Python Tricks', 'author': u'Ramalho'}]
+    added = PrefixIndex()
+    for book in books:
+        added.add(book)
+    loaded = PrefixIndex()
+    loaded.load(books)
+
+    assert loaded._keys == added._keys
+    assert loaded._counts == added._counts
+    assert loaded.suggest(u'bad') == []
+    loaded.remove(4)
+    assert loaded.suggest(u'tricks') == []
+
+
+def test_fuzzy_search():
+    index = FuzzyIndex()
+    for book in BOOKS:
+        index.add(book)
+
+    # Both are one edit away; the shorter title is the closer match.
+    assert [book['id'] for book in index.search(u'pyhton')] == [3, 2]
+    assert [book['id'] for book in index.search(u'donavan')] == [1]
+    assert index.search(u'donavan', field='title') == []
+    assert index.search(u'xyzzy') == []
+
+    index.remove(2)
+    assert [book['id'] for book in index.search(u'cookbok')] == []
+
+
+def test_stale_index_is_rebuilt_in_the_background():
+    backend = FakeBackend()
+    index = SearchIndex(max_age=0)
+    with make_app(backend).app_context():
+        # The first build is waited for, and reads only what is indexed.
+        assert len(fresh_index(index)) == 3
+        assert backend.fields == [SearchIndex.BUILD_FIELDS]
+        assert 'description' in SearchIndex.BUILD_FIELDS
+
+        # Later ones run while the old copy keeps answering.
+        backend.books = BOOKS[:1]
+        backend.released.clear()
+        assert len(fresh_index(index)) == 3
+        builder = index._refresher
+        assert builder is not None and builder.is_alive()
+        backend.released.set()
+        builder.join()
+    assert len(index) == 1
+
+
+def test_cold_index_can_be_used_without_waiting():
+    backend = FakeBackend()
+    backend.released.clear()
+    index = PrefixIndex()
+    with make_app(backend).app_context():
+        assert fresh_index(index, wait=False).suggest(u'pyt') == []
+        builder = index._refresher
+        backend.released.set()
+        builder.join()
+        assert fresh_index(index, wait=False).suggest(u'pyt')
+    assert backend.fields == [('title', 'author')]
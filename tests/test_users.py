@@ -0,0 +1,55 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bookshelf.users import NameTaken, UserStore
+import pytest
+
+
+class FakeModel(object):
+    def __init__(self):
+        self.users = {}
+        self.lookups = 0
+
+    def getName(self, name):
+        self.lookups += 1
+        return self.users.get(name)
+
+    def createUser(self, data):
+        if data['name'] in self.users:
+            raise NameTaken(data['name'])
+        self.users[data['name']] = dict(data, id=len(self.users) + 1)
+        return self.users[data['name']]
+
+
+def test_caches_lookups():
+    model = FakeModel()
+    store = UserStore(model)
+    store.create({'name': 'ann', 'pwd': 'x'})
+
+    for _ in range(10):
+        assert store.get('ann')['pwd'] == 'x'
+        assert store.get('bob') is None
+    assert model.lookups == 1
+    assert store.stats()['negative_hits'] == 9
+
+
+def test_create_clears_missing_name():
+    model = FakeModel()
+    store = UserStore(model)
+    assert store.get('bob') is None
+    store.create({'name': 'bob', 'pwd': 'y'})
+    assert store.get('bob')['pwd'] == 'y'
+
+    with pytest.raises(NameTaken):
+        store.create({'name': 'bob', 'pwd': 'z'})
@@ -0,0 +1,99 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bookshelf.model_proxy import ModelProxy
+from bookshelf.votes import PartialVotes, VoteBuffer
+
+
+class FakeModel(object):
+    def __init__(self):
+        self.calls = []
+        self.fail = False
+        self.fail_after = None
+
+    def add_votes(self, votes, changes=None):
+        if self.fail:
+            raise IOError('down')
+        if self.fail_after is not None:
+            applied = sorted(votes)[:self.fail_after]
+            self.calls.append(dict((id, votes[id]) for id in applied))
+            raise PartialVotes(applied, IOError('down'))
+        self.calls.append(votes)
+
+
+def test_coalesces_votes():
+    model = FakeModel()
+    buffer = VoteBuffer(model, interval=3600)
+    for _ in range(100):
+        buffer.add(1, likes=1)
+    buffer.add(1, rating=5)
+    buffer.add(2, rating=3)
+
+    assert not model.calls
+    assert buffer.pending(1) == (100, 1, 5)
+    assert buffer.flush() == 2
+    assert model.calls == [{'1': (100, 1, 5), '2': (0, 1, 3)}]
+    assert buffer.pending(1) == (0, 0, 0)
+    assert buffer.flush() == 0
+
+
+def test_failed_flush_keeps_votes():
+    model = FakeModel()
+    buffer = VoteBuffer(model, interval=3600)
+    buffer.add(1, likes=1)
+    model.fail = True
+    assert buffer.flush() == 0
+    buffer.add(1, likes=1)
+    assert buffer.pending(1) == (2, 0, 0)
+
+    model.fail = False
+    buffer.flush()
+    assert model.calls == [{'1': (2, 0, 0)}]
+    assert buffer.stats()['failures'] == 1
+
+
+class Listener(object):
+    def __init__(self):
+        self.voted = {}
+
+    def book_voted(self, id, counts):
+        self.voted[id] = counts
+
+
+def test_partial_flush_keeps_only_unwritten_votes():
+    backend = FakeModel()
+    model = ModelProxy(backend)
+    listener = Listener()
+    model.add_listener(listener)
+    buffer = VoteBuffer(model, interval=3600)
+    for id in (1, 2, 3):
+        buffer.add(id, likes=id)
+
+    backend.fail_after = 2
+    assert buffer.flush() == 2
+    assert listener.voted == {'1': (1, 0, 0), '2': (2, 0, 0)}
+    assert buffer.pending(1) == (0, 0, 0)
+    assert buffer.pending(3) == (3, 0, 0)
+
+    backend.fail_after = None
+    assert buffer.flush() == 1
+    assert backend.calls[-1] == {'3': (3, 0, 0)}
+    assert buffer.stats()['flushed_votes'] == 6
+
+
+def test_write_through():
+    model = FakeModel()
+    buffer = VoteBuffer(model, interval=0)
+    buffer.add(1, likes=1)
+    assert model.calls == [{'1': (1, 0, 0)}]